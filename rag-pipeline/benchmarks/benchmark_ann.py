@@ -0,0 +1,94 @@
+"""Measure the recall and latency of the approximate FAISS indexes against the exact flat index.
+
+Vectors are drawn from a mixture of Gaussians, which clusters like sentence embeddings do,
+so the benchmark does not need to embed a large corpus first. Recall@k is the fraction of
+the exact k nearest neighbours that an index returns.
+
+Usage (from `rag-pipeline/`):
+    python benchmarks/benchmark_ann.py --sizes 10000 100000 --output ann.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from ann_index import INDEX_TYPES, convert_index
+
+def make_vectors(num_vectors: int, dim: int, num_clusters: int, rng: np.random.Generator) -> np.ndarray:
+    centers = rng.standard_normal((num_clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, num_clusters, num_vectors)
+    vectors = centers[labels] + 0.5 * rng.standard_normal((num_vectors, dim)).astype(np.float32)
+    # Sentence embeddings are unit vectors
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def run(num_vectors: int, dim: int, num_queries: int, k: int, index_types: list, seed: int = 0) -> list:
+    """Build every index type on the same vectors and search them with the same queries.
+
+    Returns:
+        list: One result per index type with build time, search latency and recall@k.
+    """
+    import faiss
+
+    rng = np.random.default_rng(seed)
+    vectors = make_vectors(num_vectors, dim, max(1, num_vectors // 100), rng)
+    queries = make_vectors(num_queries, dim, max(1, num_vectors // 100), rng)
+
+    flat_index = faiss.IndexFlatL2(dim)
+    flat_index.add(vectors)
+    _, exact_ids = flat_index.search(queries, k)
+
+    results = []
+    for index_type in index_types:
+        start_time = time.time()
+        index, params = convert_index(flat_index, index_type)
+        build_seconds = time.time() - start_time
+
+        latencies = []
+        ids = np.empty_like(exact_ids)
+        for i, query in enumerate(queries):
+            start_time = time.perf_counter()
+            _, ids[i:i + 1] = index.search(query[None, :], k)
+            latencies.append(time.perf_counter() - start_time)
+
+        recall = np.mean([len(set(ids[i]) & set(exact_ids[i])) / k for i in range(num_queries)])
+        latencies_ms = np.array(latencies) * 1000
+        results.append({
+            "num_vectors": num_vectors,
+            "params": params,
+            "build_seconds": build_seconds,
+            "index_bytes": int(faiss.serialize_index(index).nbytes),
+            f"recall_at_{k}": float(recall),
+            "latency_p50_ms": float(np.percentile(latencies_ms, 50)),
+            "latency_p95_ms": float(np.percentile(latencies_ms, 95)),
+        })
+        print(
+            f"{num_vectors:>8} {index_type:>7}: recall@{k} {recall:.3f} | "
+            f"p50 {results[-1]['latency_p50_ms']:.3f} ms | p95 {results[-1]['latency_p95_ms']:.3f} ms | "
+            f"build {build_seconds:.1f} s | {results[-1]['index_bytes'] / 1024 ** 2:.1f} MB"
+        )
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark approximate FAISS indexes against the flat baseline.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="Numbers of vectors.")
+    parser.add_argument("--dim", type=int, default=384, help="Vector dimension, 384 for all-MiniLM-L6-v2.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=2, help="Neighbours per query, as used by the retriever.")
+    parser.add_argument("--index-types", type=str, nargs="+", default=list(INDEX_TYPES))
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report to this file.")
+    args = parser.parse_args()
+
+    results = []
+    for num_vectors in args.sizes:
+        results.extend(run(num_vectors, args.dim, args.queries, args.k, args.index_types))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"dim": args.dim, "k": args.k, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
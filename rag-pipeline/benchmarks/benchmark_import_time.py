@@ -0,0 +1,100 @@
+"""Measure the import time of the server modules and fail when one regresses.
+
+Every module is imported in a fresh interpreter with `python -X importtime`, so that
+modules cached by earlier imports do not hide their cost. The report lists the cumulative
+import time of each module, its heaviest top-level dependencies, and whether it loaded a
+module that should only be imported on first use, e.g. torch.
+
+Usage (from `rag-pipeline/`):
+    python benchmarks/benchmark_import_time.py --threshold-ms 3000 --output import_time.json
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+MODULES = ("utils", "data_extraction", "model_setup", "model_server", "corpus", "batching", "ingestion", "data_pipeline", "main")
+# Loaded on first use, importing a server module must not load them
+LAZY_MODULES = ("torch", "transformers", "langchain_huggingface", "langchain.chains")
+
+def parse_importtime(stderr: str) -> list:
+    """Parse the `-X importtime` report.
+
+    Returns:
+        list: (module, self µs, cumulative µs, nesting level) of every import, in report order.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), level))
+    return imports
+
+def measure(module: str, top: int = 5) -> dict:
+    """Import a module in a fresh interpreter."""
+    env = {**os.environ, "PYTHONPATH": SRC_DIR}
+    code = f"import sys, json, {module}; print(json.dumps(sorted(sys.modules)))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=SRC_DIR, env=env, capture_output=True, text=True, check=True
+    )
+    imports = parse_importtime(result.stderr)
+    loaded = set(json.loads(result.stdout.strip().splitlines()[-1]))
+    total_us = next(cumulative_us for name, _, cumulative_us, _ in reversed(imports) if name == module)
+    # Third-party packages and local modules, the standard library is imported by the interpreter anyway
+    dependencies = [
+        (name, cumulative_us) for name, _, cumulative_us, _ in imports
+        if "." not in name and name != module and name not in sys.stdlib_module_names
+    ]
+    dependencies.sort(key=lambda item: -item[1])
+    return {
+        "import_ms": total_us / 1000,
+        "heaviest_imports": [{"module": name, "import_ms": us / 1000} for name, us in dependencies[:top]],
+        "lazy_modules_loaded": [name for name in LAZY_MODULES if name in loaded],
+    }
+
+def run(modules: list, repeats: int, threshold_ms: float) -> tuple:
+    """Measure every module and check it against the threshold.
+
+    Returns:
+        tuple: The results per module and the list of regressions.
+    """
+    results, regressions = {}, []
+    for module in modules:
+        runs = [measure(module) for _ in range(repeats)]
+        result = runs[-1]
+        result["import_ms"] = float(np.median([run["import_ms"] for run in runs]))
+        results[module] = result
+        if threshold_ms and result["import_ms"] > threshold_ms:
+            regressions.append(f"{module} imports in {result['import_ms']:.0f} ms, over {threshold_ms:.0f} ms")
+        if result["lazy_modules_loaded"]:
+            regressions.append(f"{module} loads {', '.join(result['lazy_modules_loaded'])} on import")
+        heaviest = ", ".join(f"{item['module']} {item['import_ms']:.0f} ms" for item in result["heaviest_imports"][:3])
+        print(f"{module:>16}: {result['import_ms']:>7.0f} ms | {heaviest}")
+    return results, regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the server modules.")
+    parser.add_argument("--modules", type=str, nargs="+", default=list(MODULES))
+    parser.add_argument("--repeats", type=int, default=3, help="Imports per module, the median is reported.")
+    parser.add_argument("--threshold-ms", type=float, default=3000,
+                        help="Fail when a module takes longer to import. 0 disables the check.")
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report to this file.")
+    args = parser.parse_args()
+
+    results, regressions = run(args.modules, args.repeats, args.threshold_ms)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"threshold_ms": args.threshold_ms, "results": results, "regressions": regressions}, f, indent=2)
+    for regression in regressions:
+        print(f"Regression: {regression}")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+"""Load test the FastAPI app end to end with tiny stand-in models, without network access.
+
+A randomly initialized causal LM with a character level tokenizer, and a small sentence
+embedder built the same way, are saved in a temporary project root (`PROJECT_ROOT`). The
+server is started on them with `python src/main.py`, then driven in two phases:
+
+- upload: every user uploads a PDF through `/api/upload_pdf` and the ingestion is polled to completion.
+- chat: questions are sent to `/api/chat` (or `/api/chat/stream` with `--stream`), either by
+  `--concurrency` clients in a closed loop, or at a Poisson arrival rate of `--rate` requests per second.
+
+The report holds the throughput, latency percentiles, time to first response (first body
+byte for streamed answers) and errors of each phase, and the peak RSS of the server and its
+worker processes. It is tagged with the git commit, so that reports can be compared across
+commits with `--compare`.
+
+Usage (from `rag-pipeline/`):
+    python benchmarks/benchmark_load.py --users 4 --requests 64 --concurrency 8 --output load.json
+    python benchmarks/benchmark_load.py --rate 2 --stream --compare load.json
+    python benchmarks/benchmark_load.py --server-args="--inference-workers 2"
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+RAG_PIPELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(RAG_PIPELINE_DIR, "tests"))
+
+from stand_in import build_stand_in_tokenizer, save_stand_in_model
+
+DEFAULT_MODEL_NAME = "Qwen/Qwen2.5-0.5B-Instruct"
+QUESTIONS = (
+    "What is this document about?",
+    "Summarize the main findings.",
+    "Which methods are described?",
+    "What are the limitations?",
+)
+
+def build_stand_in_models(root_dir: str, seed: int = 0) -> tuple:
+    """Save a tiny random causal LM and sentence embedder under `root_dir`.
+
+    The LM is saved where `get_model_dir()` looks for the default model, so the server loads
+    it instead of downloading Qwen.
+
+    Returns:
+        tuple: Directories of the LM and of the embedder.
+    """
+    from transformers import BertConfig, BertModel
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers.models import Pooling, Transformer
+
+    model_dir = save_stand_in_model(
+        os.path.join(root_dir, "rag-pipeline", "models", DEFAULT_MODEL_NAME), hidden_size=64, intermediate_size=128, seed=seed
+    )
+    tokenizer = build_stand_in_tokenizer()
+
+    embedder_dir = os.path.join(root_dir, "embedder")
+    encoder_dir = os.path.join(root_dir, "embedder-encoder")
+    tokenizer.save_pretrained(encoder_dir)
+    BertModel(BertConfig(
+        vocab_size=len(tokenizer), hidden_size=64, intermediate_size=128, num_hidden_layers=2,
+        num_attention_heads=4, max_position_embeddings=1024
+    )).save_pretrained(encoder_dir)
+    encoder = Transformer(encoder_dir, max_seq_length=512)
+    SentenceTransformer(modules=[encoder, Pooling(encoder.get_word_embedding_dimension())]).save(embedder_dir)
+    return model_dir, embedder_dir
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class RSSMonitor(threading.Thread):
+    def __init__(self, pid: int, interval: float = 0.1):
+        """Sample the RSS of a process and its children, e.g. inference and ingestion workers."""
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_bytes = 0
+        self._stop_event = threading.Event()
+
+    def sample(self) -> int:
+        import psutil
+        try:
+            process = psutil.Process(self.pid)
+            processes = [process] + process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            return 0
+        total = 0
+        for process in processes:
+            try:
+                total += process.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.peak_bytes = max(self.peak_bytes, self.sample())
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+def start_server(root_dir: str, embedder_dir: str, port: int, server_args: list, timeout: float) -> subprocess.Popen:
+    """Start the app on the stand-in models and wait until it is healthy."""
+    import httpx
+
+    env = {
+        **os.environ,
+        "PROJECT_ROOT": root_dir,
+        "EMBEDDING_MODEL": embedder_dir,
+        "HF_HUB_OFFLINE": "1",
+        "DISABLE_TRACING": "true",
+    }
+    log = open(os.path.join(root_dir, "server.log"), "w")
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(RAG_PIPELINE_DIR, "src", "main.py"), "--port", str(port), *server_args],
+        cwd=root_dir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with code {server.returncode}, see {log.name}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health", timeout=1).status_code == 200:
+                return server
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.25)
+    server.terminate()
+    raise TimeoutError(f"Server not healthy after {timeout} s, see {log.name}")
+
+def summarize(results: list, duration: float) -> dict:
+    """Aggregate request results of a phase.
+
+    Args:
+        results (list): Dicts with `status`, `latency` and `ttfr` of every request, in seconds.
+        duration (float): Wall time of the phase.
+    """
+    succeeded = [result for result in results if result["status"] == 200]
+    latencies_ms = np.array([result["latency"] for result in succeeded]) * 1000
+    ttfr_ms = np.array([result["ttfr"] for result in succeeded]) * 1000
+    statuses = {}
+    for result in results:
+        statuses[str(result["status"])] = statuses.get(str(result["status"]), 0) + 1
+    summary = {
+        "requests": len(results),
+        "errors": len(results) - len(succeeded),
+        "statuses": statuses,
+        "duration_seconds": duration,
+        "throughput_rps": len(succeeded) / duration if duration > 0 else 0.0,
+    }
+    for name, values in (("latency", latencies_ms), ("ttfr", ttfr_ms)):
+        for percentile in (50, 95, 99):
+            summary[f"{name}_p{percentile}_ms"] = float(np.percentile(values, percentile)) if len(values) else None
+    return summary
+
+def run_phase(send, num_requests: int, concurrency: int, rate: float = None, seed: int = 0) -> dict:
+    """Send requests in a closed loop of `concurrency` clients, or at a Poisson arrival rate.
+
+    Args:
+        send (Callable): Sends request `i` and returns its result dict.
+        num_requests (int): Number of requests.
+        concurrency (int): Clients of the closed loop, or maximum requests in flight at a fixed rate.
+        rate (float, optional): Arrival rate in requests per second. Defaults to a closed loop.
+    """
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        if rate:
+            # Arrivals do not wait for earlier requests, unlike the closed loop
+            arrivals = np.cumsum(np.random.default_rng(seed).exponential(1 / rate, num_requests))
+            futures = []
+            for i, arrival in enumerate(arrivals):
+                time.sleep(max(0.0, start_time + arrival - time.perf_counter()))
+                futures.append(executor.submit(send, i))
+            results = [future.result() for future in futures]
+        else:
+            results = list(executor.map(send, range(num_requests)))
+    return summarize(results, time.perf_counter() - start_time)
+
+def make_upload(client, base_url: str, pdf_path: str, users: list, poll_interval: float = 0.2):
+    def upload(i: int) -> dict:
+        start_time = time.perf_counter()
+        with open(pdf_path, "rb") as f:
+            response = client.post(
+                f"{base_url}/api/upload_pdf", params={"user_id": users[i]},
+                files={"file": (os.path.basename(pdf_path), f, "application/pdf")}
+            )
+        ttfr = time.perf_counter() - start_time
+        if response.status_code != 200:
+            return {"status": response.status_code, "latency": ttfr, "ttfr": ttfr}
+        # The upload is complete once the document is ingested and searchable
+        job_id = response.json()["job_id"]
+        while True:
+            status = client.get(f"{base_url}/api/upload_status/{job_id}").json()
+            if status["status"] in ("done", "failed"):
+                break
+            time.sleep(poll_interval)
+        return {
+            "status": 200 if status["status"] == "done" else 500,
+            "latency": time.perf_counter() - start_time,
+            "ttfr": ttfr,
+        }
+    return upload
+
+def make_chat(client, base_url: str, users: list, stream: bool, bypass_cache: bool):
+    def chat(i: int) -> dict:
+        # Distinct questions, so that the answer cache only serves them if it is allowed to
+        payload = {"messages": f"{QUESTIONS[i % len(QUESTIONS)]} ({i})", "bypass_cache": bypass_cache}
+        params = {"user_id": users[i % len(users)]}
+        start_time = time.perf_counter()
+        if not stream:
+            response = client.post(f"{base_url}/api/chat", params=params, json=payload)
+            latency = time.perf_counter() - start_time
+            return {"status": response.status_code, "latency": latency, "ttfr": latency}
+        ttfr = None
+        with client.stream("POST", f"{base_url}/api/chat/stream", params=params, json=payload) as response:
+            for chunk in response.iter_bytes():
+                if ttfr is None and chunk:
+                    ttfr = time.perf_counter() - start_time
+        latency = time.perf_counter() - start_time
+        return {"status": response.status_code, "latency": latency, "ttfr": ttfr if ttfr is not None else latency}
+    return chat
+
+def get_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], cwd=RAG_PIPELINE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(report: dict, baseline: dict):
+    """Print the relative change of the main figures against an earlier report."""
+    print(f"Compared to {baseline.get('commit')}:")
+    for phase in ("upload", "chat"):
+        for key in ("throughput_rps", "latency_p50_ms", "latency_p95_ms", "latency_p99_ms", "ttfr_p50_ms"):
+            old, new = baseline.get(phase, {}).get(key), report[phase].get(key)
+            if old and new is not None:
+                print(f"  {phase} {key}: {old:.1f} -> {new:.1f} ({(new - old) / old:+.1%})")
+    old, new = baseline.get("peak_rss_mb"), report["peak_rss_mb"]
+    if old:
+        print(f"  peak_rss_mb: {old:.0f} -> {new:.0f} ({(new - old) / old:+.1%})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the FastAPI app with tiny stand-in models.")
+    parser.add_argument("--users", type=int, default=4, help="Users uploading a PDF, then chatting over it.")
+    parser.add_argument("--pdf", type=str, default=os.path.join(RAG_PIPELINE_DIR, "examples", "example.pdf"))
+    parser.add_argument("--requests", type=int, default=32, help="Number of chat requests.")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Concurrent clients, or maximum requests in flight with --rate.")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Poisson arrival rate of chat requests per second. Defaults to a closed loop.")
+    parser.add_argument("--stream", action="store_true", help="Chat through /api/chat/stream.")
+    parser.add_argument("--allow-answer-cache", action="store_true",
+                        help="Let the server answer from its semantic answer cache.")
+    parser.add_argument("--server-args", type=str, default="",
+                        help='Extra arguments of main.py, e.g. "--inference-workers 2".')
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report to this file.")
+    parser.add_argument("--compare", type=str, default=None, help="Earlier JSON report to compare with.")
+    args = parser.parse_args()
+
+    import httpx
+
+    with tempfile.TemporaryDirectory() as root_dir:
+        _, embedder_dir = build_stand_in_models(root_dir)
+        port = get_free_port()
+        startup_time = time.perf_counter()
+        server = start_server(root_dir, embedder_dir, port, shlex.split(args.server_args), args.startup_timeout)
+        startup_seconds = time.perf_counter() - startup_time
+        monitor = RSSMonitor(server.pid)
+        monitor.start()
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            users = [f"load-user-{i}" for i in range(args.users)]
+            limits = httpx.Limits(max_connections=max(args.concurrency, args.users))
+            with httpx.Client(timeout=None, limits=limits) as client:
+                upload = run_phase(make_upload(client, base_url, args.pdf, users), args.users, args.users)
+                print(f"upload: {json.dumps(upload)}")
+                chat = run_phase(
+                    make_chat(client, base_url, users, args.stream, not args.allow_answer_cache),
+                    args.requests, args.concurrency, args.rate
+                )
+                print(f"chat: {json.dumps(chat)}")
+        finally:
+            monitor.stop()
+            server.terminate()
+            server.wait()
+
+    report = {
+        "commit": get_commit(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "startup_seconds": startup_seconds,
+        "upload": upload,
+        "chat": chat,
+        "peak_rss_mb": monitor.peak_bytes / 1024 ** 2,
+    }
+    print(f"startup {startup_seconds:.1f} s | peak RSS {report['peak_rss_mb']:.0f} MB")
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(report, json.load(f))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""Compare loading a corpus from the pickled docstore with memory-mapping it, across worker processes.
+
+A synthetic corpus is saved once with `CorpusStore`. Then several worker processes load it
+at the same time, either pickled (`CorpusStore.load`) or memory-mapped (`CorpusStore.load_read_only`),
+and run the same searches. Memory is measured while every worker is still alive: USS is the
+memory unique to a worker, PSS splits shared pages between the workers that map them.
+
+Usage (from `rag-pipeline/`):
+    python benchmarks/benchmark_mmap.py --chunks 100000 --workers 4 --output mmap.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from benchmark_ann import make_vectors
+
+MODES = ("pickle", "mmap")
+USER_ID = "benchmark"
+
+def build_corpus(root_dir: str, num_chunks: int, num_documents: int, dim: int):
+    """Save a corpus of random unit vectors and filler text of about the size of a real chunk."""
+    from langchain_community.vectorstores import FAISS
+    from langchain_core.embeddings import FakeEmbeddings
+    from corpus import CorpusStore
+
+    rng = np.random.default_rng(0)
+    embeddings = FakeEmbeddings(size=dim)
+    store = CorpusStore(root_dir)
+    vectors = make_vectors(num_chunks, dim, max(1, num_chunks // 100), rng)
+    for doc_index, document_vectors in enumerate(np.array_split(vectors, num_documents)):
+        texts = [f"Document {doc_index} chunk {i}. " + "lorem ipsum " * 40 for i in range(len(document_vectors))]
+        vector_store = FAISS.from_embeddings(list(zip(texts, document_vectors.tolist())), embeddings)
+        store.add_document(USER_ID, f"doc{doc_index}", vector_store, embeddings)
+    # Workers load a single base version rather than a base and its latest deltas
+    store.wait_for_compactions()
+    store.compact(USER_ID, embeddings)
+
+def run_worker(root_dir: str, mode: str, dim: int, num_queries: int, k: int):
+    """Load the corpus, search it, then report memory once the parent says every worker is loaded."""
+    import psutil
+    from langchain_core.embeddings import FakeEmbeddings
+    from corpus import CorpusStore
+
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+    store = CorpusStore(root_dir)
+    start_time = time.perf_counter()
+    if mode == "pickle":
+        corpus = store.load(USER_ID, FakeEmbeddings(size=dim))
+    else:
+        corpus = store.load_read_only(USER_ID, FakeEmbeddings(size=dim))
+    load_seconds = time.perf_counter() - start_time
+
+    # The first pass faults in the pages of the memory-mapped corpus
+    queries = make_vectors(num_queries, dim, 10, np.random.default_rng(1))
+    report = {"load_seconds": load_seconds}
+    for name in ("cold", "warm"):
+        latencies = []
+        for query in queries:
+            start_time = time.perf_counter()
+            corpus.similarity_search_with_score_by_vector(query.tolist(), k=k)
+            latencies.append(time.perf_counter() - start_time)
+        report[f"search_{name}_p50_ms"] = float(np.percentile(latencies, 50) * 1000)
+    print(json.dumps(report), flush=True)
+
+    sys.stdin.readline()
+    memory = process.memory_full_info()
+    print(json.dumps({
+        "rss_mb": (memory.rss - rss_before) / 1024 ** 2,
+        "uss_mb": memory.uss / 1024 ** 2,
+        "pss_mb": memory.pss / 1024 ** 2,
+    }), flush=True)
+
+def read_report(worker: subprocess.Popen) -> dict:
+    # FAISS logs to stdout when it opens on-disk inverted lists
+    line = worker.stdout.readline()
+    while not line.startswith("{"):
+        line = worker.stdout.readline()
+    return json.loads(line)
+
+def run_mode(root_dir: str, mode: str, args) -> dict:
+    """Start the workers of one mode at the same time and aggregate their reports."""
+    workers = [
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker", mode, "--root-dir", root_dir,
+             "--dim", str(args.dim), "--queries", str(args.queries), "--k", str(args.k)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True
+        )
+        for _ in range(args.workers)
+    ]
+    reports = [read_report(worker) for worker in workers]
+    for worker, report in zip(workers, reports):
+        worker.stdin.write("\n")
+        worker.stdin.flush()
+        report.update(read_report(worker))
+        worker.wait()
+
+    result = {"mode": mode, "workers": args.workers}
+    for key in reports[0]:
+        result[f"{key}_mean"] = float(np.mean([report[key] for report in reports]))
+    result["pss_total_mb"] = float(sum(report["pss_mb"] for report in reports))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark pickled and memory-mapped corpus loading across processes.")
+    parser.add_argument("--chunks", type=int, default=100000, help="Number of chunks in the corpus.")
+    parser.add_argument("--documents", type=int, default=10, help="Number of documents the chunks are split into.")
+    parser.add_argument("--dim", type=int, default=384, help="Vector dimension, 384 for all-MiniLM-L6-v2.")
+    parser.add_argument("--workers", type=int, default=4, help="Number of processes loading the corpus.")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--k", type=int, default=2, help="Neighbours per query, as used by the retriever.")
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report to this file.")
+    # Internal: load the corpus in this process and report
+    parser.add_argument("--worker", type=str, choices=MODES, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--root-dir", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args.root_dir, args.worker, args.dim, args.queries, args.k)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as root_dir:
+        start_time = time.time()
+        build_corpus(root_dir, args.chunks, args.documents, args.dim)
+        print(f"Saved a corpus of {args.chunks} chunks in {time.time() - start_time:.1f} s")
+        for mode in MODES:
+            results.append(run_mode(root_dir, mode, args))
+            row = results[-1]
+            print(
+                f"{mode:>6} x{args.workers}: load {row['load_seconds_mean'] * 1000:8.1f} ms | "
+                f"search p50 cold {row['search_cold_p50_ms_mean']:6.2f} ms, warm {row['search_warm_p50_ms_mean']:6.2f} ms | USS {row['uss_mb_mean']:7.1f} MB/worker | "
+                f"PSS {row['pss_total_mb']:7.1f} MB total"
+            )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"chunks": args.chunks, "dim": args.dim, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Compare the fp32, bf16 and dynamic-int8 precisions of the local LLM on CPU.
+
+Every precision is loaded in a fresh process, so resident memory is not shared between runs,
+and answers the same RAG prompts built from `examples/example.pdf` with greedy decoding.
+The report gives load time, tokens/sec, RSS and the answer drift against fp32.
+
+Usage (from `rag-pipeline/`):
+    python benchmarks/benchmark_precision.py --output precision.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from difflib import SequenceMatcher
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+DEFAULT_MODEL_NAME = "Qwen/Qwen2.5-0.5B-Instruct"
+DEFAULT_PDF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "examples", "example.pdf")
+DEFAULT_QUESTIONS = [
+    "What is this document about?",
+    "Summarize the main contributions.",
+    "What method is proposed?",
+    "What are the results of the experiments?",
+]
+
+def build_prompts(pdf_path: str, questions: list) -> list:
+    """Retrieve the context of each question once, so that every precision answers the same prompts.
+
+    Args:
+        pdf_path (str): PDF file to answer questions about.
+        questions (list): Questions to ask.
+
+    Returns:
+        list: RAG prompts.
+    """
+    from data_preparation import prepare_retriever
+    from resources import resources
+
+    retriever = prepare_retriever(file_path=pdf_path)
+    prompts = []
+    for question in questions:
+        context = "\n\n".join(doc.page_content for doc in retriever.invoke(question))
+        prompts.append(resources.get_prompt().format(context=context, question=question))
+    return prompts
+
+def run_precision(model_name: str, local_dir: str, precision: str, prompts: list, max_new_tokens: int) -> dict:
+    """Load the model with one precision and answer every prompt with greedy decoding.
+
+    Returns:
+        dict: Load time, tokens/sec, RSS and the generated token ids of each answer.
+    """
+    import psutil
+    import torch
+    from transformers import AutoTokenizer
+    from model_setup import load_model
+
+    process = psutil.Process(os.getpid())
+    start_time = time.time()
+    model = load_model(model_name=model_name, local_dir=local_dir, precision=precision)
+    load_seconds = time.time() - start_time
+    rss_after_load = process.memory_info().rss
+    tokenizer = AutoTokenizer.from_pretrained(local_dir)
+
+    answers, new_tokens, generate_seconds = [], 0, 0.0
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt")
+        start_time = time.time()
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                do_sample=False,
+                max_new_tokens=max_new_tokens,
+                pad_token_id=tokenizer.pad_token_id or tokenizer.eos_token_id
+            )
+        generate_seconds += time.time() - start_time
+        answer_ids = output[0, inputs["input_ids"].shape[1]:].tolist()
+        new_tokens += len(answer_ids)
+        answers.append({"token_ids": answer_ids, "text": tokenizer.decode(answer_ids, skip_special_tokens=True)})
+
+    return {
+        "precision": precision,
+        "load_seconds": load_seconds,
+        "tokens_per_second": new_tokens / generate_seconds if generate_seconds else 0.0,
+        "new_tokens": new_tokens,
+        "rss_after_load_mb": rss_after_load / 1024 ** 2,
+        "rss_peak_mb": process.memory_info().rss / 1024 ** 2,
+        "answers": answers,
+    }
+
+def answer_drift(reference: list, answers: list) -> dict:
+    """Compare answers with the fp32 reference answers.
+
+    Returns:
+        dict: Fraction of identical answers and mean token-level similarity.
+    """
+    exact = [ref["token_ids"] == ans["token_ids"] for ref, ans in zip(reference, answers)]
+    similarity = [
+        SequenceMatcher(None, ref["token_ids"], ans["token_ids"]).ratio() for ref, ans in zip(reference, answers)
+    ]
+    return {
+        "exact_match": sum(exact) / len(exact),
+        "token_similarity": sum(similarity) / len(similarity),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the precisions of the local LLM on CPU.")
+    parser.add_argument("--model", type=str, default=DEFAULT_MODEL_NAME, help="Model name to download.")
+    parser.add_argument("--local-dir", type=str, default=None, help="Local model directory. Defaults to `get_model_dir`.")
+    parser.add_argument("--pdf", type=str, default=DEFAULT_PDF, help="PDF file the questions are asked about.")
+    parser.add_argument("--precisions", type=str, nargs="+", default=["fp32", "bf16", "dynamic-int8"])
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--output", type=str, default=None, help="Write the JSON report to this file.")
+    # Internal: run one precision in this process and write its result
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    from utils import get_model_dir
+    local_dir = args.local_dir or get_model_dir(args.model)
+
+    if args.worker:
+        request = json.load(sys.stdin)
+        result = run_precision(args.model, local_dir, args.worker, request["prompts"], args.max_new_tokens)
+        with open(request["output"], "w") as f:
+            json.dump(result, f)
+        return
+
+    prompts = build_prompts(args.pdf, DEFAULT_QUESTIONS)
+    if "fp32" not in args.precisions:
+        args.precisions.insert(0, "fp32")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for precision in args.precisions:
+            output = os.path.join(tmp_dir, f"{precision}.json")
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--worker", precision, "--model", args.model,
+                 "--local-dir", local_dir, "--max-new-tokens", str(args.max_new_tokens)],
+                input=json.dumps({"prompts": prompts, "output": output}), text=True, check=True
+            )
+            with open(output, "r") as f:
+                results[precision] = json.load(f)
+
+    report = []
+    for precision, result in results.items():
+        row = {key: value for key, value in result.items() if key != "answers"}
+        row.update(answer_drift(results["fp32"]["answers"], result["answers"]))
+        report.append(row)
+        print(
+            f"{precision:>13}: {row['tokens_per_second']:7.1f} tok/s | load {row['load_seconds']:6.1f} s | "
+            f"RSS {row['rss_peak_mb']:7.0f} MB | exact match {row['exact_match']:.2f} | "
+            f"token similarity {row['token_similarity']:.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"model": args.model, "pdf": args.pdf, "results": report}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
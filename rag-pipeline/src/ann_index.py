@@ -0,0 +1,139 @@
+import os
+import math
+import time
+import faiss
+import numpy as np
+from utils import logger
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivf-pq")
+PARAMS_FILE = "index_params.json"
+
+def choose_index_type(num_vectors: int, supports_removal: bool = False) -> str:
+    """Choose the index type of a corpus from its number of chunks.
+
+    Exact search is fast enough for small corpora. HNSW gives the best recall/latency trade-off
+    for medium ones, and IVF, optionally with product quantization, keeps memory and build time
+    in check for large ones.
+
+    Args:
+        num_vectors (int): Number of chunks in the index.
+        supports_removal (bool, optional): Whether vectors must be removable. HNSW cannot remove
+        vectors, so IVF is used instead. Defaults to False.
+
+    Returns:
+        str: Value of env `VECTOR_INDEX_TYPE` if set, otherwise one of `INDEX_TYPES`
+        chosen with env `VECTOR_INDEX_HNSW_MIN_CHUNKS` (default 10000),
+        `VECTOR_INDEX_IVF_MIN_CHUNKS` (default 200000) and `VECTOR_INDEX_PQ` (default false).
+    """
+    index_type = os.getenv("VECTOR_INDEX_TYPE", "auto")
+    if index_type == "auto":
+        if num_vectors < int(os.getenv("VECTOR_INDEX_HNSW_MIN_CHUNKS", 10000)):
+            index_type = "flat"
+        elif num_vectors < int(os.getenv("VECTOR_INDEX_IVF_MIN_CHUNKS", 200000)):
+            index_type = "hnsw"
+        else:
+            index_type = "ivf-pq" if os.getenv("VECTOR_INDEX_PQ", "false").lower() == "true" else "ivf"
+    if index_type == "hnsw" and supports_removal:
+        index_type = "ivf"
+    return index_type
+
+def default_params(index_type: str, num_vectors: int, dim: int) -> dict:
+    """Build and search parameters of an index type, scaled with the corpus size.
+
+    Args:
+        index_type (str): One of `INDEX_TYPES`.
+        num_vectors (int): Number of vectors the index is built from.
+        dim (int): Dimension of the vectors.
+    """
+    if index_type == "hnsw":
+        return {
+            "type": index_type,
+            "m": 32,
+            "ef_construction": 80,
+            "ef_search": int(os.getenv("VECTOR_INDEX_EF_SEARCH", 256)),
+        }
+    if index_type in ("ivf", "ivf-pq"):
+        # Keep about 40 training vectors per centroid
+        nlist = max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // 40))
+        params = {
+            "type": index_type,
+            "nlist": nlist,
+            "nprobe": int(os.getenv("VECTOR_INDEX_NPROBE", max(1, nlist // 16))),
+        }
+        if index_type == "ivf-pq":
+            # Sub-quantizers of about 8 dimensions each, 8 bits per code
+            pq_m = max(m for m in range(1, max(1, dim // 8) + 1) if dim % m == 0)
+            params.update({"pq_m": pq_m, "pq_bits": 8})
+        return params
+    return {"type": "flat"}
+
+def create_index(params: dict, dim: int) -> faiss.Index:
+    """Create an empty, untrained index from its parameters."""
+    index_type = params["type"]
+    if index_type == "flat":
+        return faiss.IndexFlatL2(dim)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, params["m"])
+        index.hnsw.efConstruction = params["ef_construction"]
+        return index
+    if index_type == "ivf":
+        return faiss.index_factory(dim, f"IVF{params['nlist']},Flat")
+    if index_type == "ivf-pq":
+        index = faiss.index_factory(dim, f"IVF{params['nlist']},PQ{params['pq_m']}x{params['pq_bits']}")
+        # Polysemous codes are not used for search and make training much slower
+        faiss.downcast_index(index).do_polysemous_training = False
+        return index
+    raise ValueError(f"Unknown index type {index_type}, expected one of {INDEX_TYPES}")
+
+def apply_search_params(index: faiss.Index, params: dict):
+    """Set the search-time parameters of an index, which are not all kept by `faiss.write_index`."""
+    if params.get("type") == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = params["ef_search"]
+    elif params.get("type") in ("ivf", "ivf-pq"):
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+
+def reconstruct_vectors(index: faiss.Index) -> np.ndarray:
+    """Get every vector of an index, in insertion order. Vectors of PQ indexes are approximate."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # IVF indexes need a map from ids to inverted lists to reconstruct vectors
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+def reconstruct_ids(index: faiss.Index, ids: np.ndarray) -> np.ndarray:
+    """Get the vectors of some ids of an index, which may have gaps left by removed vectors."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is None:
+        return index.reconstruct_batch(ids)
+    # IVF indexes need a map from ids to inverted lists. A hash table also maps the gaps left
+    # by removed vectors, and it is dropped afterwards to keep the index as it was.
+    ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    try:
+        return index.reconstruct_batch(ids)
+    finally:
+        ivf.set_direct_map_type(faiss.DirectMap.NoMap)
+
+def convert_index(index: faiss.Index, index_type: str = None) -> tuple:
+    """Rebuild an exact index as the index type chosen for its size.
+
+    Args:
+        index (faiss.Index): Flat index holding every vector, in docstore order.
+        index_type (str, optional): One of `INDEX_TYPES`. Defaults to `choose_index_type(index.ntotal)`.
+
+    Returns:
+        tuple: The new index, with vectors in the same order, and its parameters.
+    """
+    index_type = index_type or choose_index_type(index.ntotal)
+    params = default_params(index_type, index.ntotal, index.d)
+    if index_type == "flat":
+        return index, params
+
+    start_time = time.time()
+    vectors = reconstruct_vectors(index)
+    new_index = create_index(params, index.d)
+    if not new_index.is_trained:
+        new_index.train(vectors)
+    new_index.add(vectors)
+    apply_search_params(new_index, params)
+    logger.info(f"Built {index_type} index of {index.ntotal} vectors in {time.time() - start_time:.1f} s: {params}")
+    return new_index, params
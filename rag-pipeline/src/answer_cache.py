@@ -0,0 +1,82 @@
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from utils import logger, ANSWER_CACHE_HITS, ANSWER_CACHE_MISSES
+
+class AnswerCache:
+    def __init__(self, threshold: float = None, max_entries: int = None):
+        """Semantic cache of chat answers, keyed by (document index hash, question embedding).
+
+        A question is answered from the cache when a question previously asked about the same
+        document has a cosine similarity above the threshold.
+
+        Args:
+            threshold (float, optional): Minimum cosine similarity of a hit.
+            Defaults to env `ANSWER_CACHE_THRESHOLD` or 0.95.
+            max_entries (int, optional): Maximum cached answers over all documents, least recently
+            used first evicted. Defaults to env `ANSWER_CACHE_MAX_ENTRIES` or 1024.
+        """
+        self.threshold = threshold if threshold is not None else float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 1024))
+        self._entries = OrderedDict()  # (index_hash, question) -> answer
+        self._vectors = {}  # index_hash -> {question: normalized embedding}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _normalize(embedding: list) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def get(self, index_hash: str, embedding: list) -> str:
+        """Find the answer of the most similar cached question about a document.
+
+        Args:
+            index_hash (str): Hash of the document index the question is asked about.
+            embedding (list): Embedding of the question.
+
+        Returns:
+            str: The cached answer, or None if no question is similar enough.
+        """
+        vector = self._normalize(embedding)
+        with self._lock:
+            questions = self._vectors.get(index_hash)
+            if questions:
+                keys = list(questions)
+                similarities = np.stack([questions[key] for key in keys]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_key = (index_hash, keys[best])
+                    self._entries.move_to_end(entry_key)
+                    ANSWER_CACHE_HITS.inc()
+                    logger.info(f"Answer cache hit with similarity {similarities[best]:.3f}")
+                    return self._entries[entry_key]
+        ANSWER_CACHE_MISSES.inc()
+        return None
+
+    def put(self, index_hash: str, question: str, embedding: list, answer: str):
+        """Cache the answer of a question about a document, replacing a previous answer of the same question.
+
+        Args:
+            index_hash (str): Hash of the document index the question is asked about.
+            question (str): The question.
+            embedding (list): Embedding of the question.
+            answer (str): Answer of the LLM.
+        """
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            entry_key = (index_hash, question)
+            self._entries[entry_key] = answer
+            self._entries.move_to_end(entry_key)
+            self._vectors.setdefault(index_hash, {})[question] = self._normalize(embedding)
+            while len(self._entries) > self.max_entries:
+                (old_hash, old_question), _ = self._entries.popitem(last=False)
+                questions = self._vectors[old_hash]
+                del questions[old_question]
+                if not questions:
+                    del self._vectors[old_hash]
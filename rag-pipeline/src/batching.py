@@ -0,0 +1,236 @@
+import os
+import math
+import time
+import queue
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Iterator
+from opentelemetry import context as otel_context
+from utils import logger, set_torch_threads, BATCH_SIZE, BATCH_WAIT_TIME, QUEUE_DEPTH, QUEUE_REJECTED
+
+GENERATE = "generate"
+STREAM = "stream"
+
+class QueueFullError(RuntimeError):
+    def __init__(self, retry_after: int):
+        """Raised when the inference queue is full, so that the client retries later instead of piling up.
+
+        Args:
+            retry_after (int): Estimated seconds until the queue has room again.
+        """
+        super().__init__(f"Inference queue is full, retry after {retry_after} s")
+        self.retry_after = retry_after
+
+class BatchScheduler:
+    def __init__(self, generate_fn: Callable[[list, list], list], max_batch_size: int = None, max_wait_ms: float = None,
+                 max_concurrent_batches: int = None, stream_fn: Callable[[str, dict, threading.Event], Iterator[str]] = None,
+                 max_queue_size: int = None, threads_per_batch: int = None, fair: bool = None):
+        """Dynamic batching scheduler for text generation.
+
+        Pending prompts are collected until `max_batch_size` prompts are queued or the oldest
+        one has waited `max_wait_ms`, then they are generated together in one padded batch.
+        Streamed answers take a slot of their own, so that at most `max_concurrent_batches`
+        generations ever compete for the cores. Prompts beyond `max_queue_size` are rejected
+        with `QueueFullError` instead of waiting.
+
+        Args:
+            generate_fn (Callable[[list, list], list]): Function mapping a list of prompts and the list of
+            their generation options to a list of outputs.
+            max_batch_size (int, optional): Maximum prompts per batch.
+            Defaults to env `CHAT_MAX_BATCH_SIZE` or 8.
+            max_wait_ms (float, optional): Maximum time in milliseconds a prompt waits for a batch to fill.
+            Defaults to env `CHAT_BATCH_WAIT_MS` or 20.
+            max_concurrent_batches (int, optional): Batches generated at the same time, e.g. one per
+            inference worker process. Defaults to env `CHAT_MAX_CONCURRENT_BATCHES` or 1.
+            stream_fn (Callable[[str, dict, threading.Event], Iterator[str]], optional): Function streaming the
+            answer of a prompt with its generation options, stopping once the event is set. Required by `stream`.
+            max_queue_size (int, optional): Maximum prompts waiting for a slot, 0 for no limit.
+            Defaults to env `CHAT_MAX_QUEUE_SIZE` or 64.
+            threads_per_batch (int, optional): Torch intra-op threads of each slot, so that concurrent
+            batches share the cores instead of oversubscribing them. Defaults to env
+            `CHAT_THREADS_PER_BATCH`, or the torch default.
+            fair (bool, optional): Take prompts from each user in turn rather than first come, first
+            served, so that one user's burst does not delay everyone else. Defaults to env `CHAT_FAIR_SCHEDULING`.
+        """
+        self.generate_fn = generate_fn
+        self.stream_fn = stream_fn
+        self.max_batch_size = max_batch_size or int(os.getenv("CHAT_MAX_BATCH_SIZE", 8))
+        self.max_wait_ms = max_wait_ms if max_wait_ms is not None else float(os.getenv("CHAT_BATCH_WAIT_MS", 20))
+        self.max_concurrent_batches = max_concurrent_batches or int(os.getenv("CHAT_MAX_CONCURRENT_BATCHES", 1))
+        self.max_queue_size = max_queue_size if max_queue_size is not None else int(os.getenv("CHAT_MAX_QUEUE_SIZE", 64))
+        self.threads_per_batch = threads_per_batch or int(os.getenv("CHAT_THREADS_PER_BATCH", 0))
+        self.fair = fair if fair is not None else os.getenv("CHAT_FAIR_SCHEDULING", "false").lower() in ("1", "true")
+        # Pending requests of each user, as (kind, prompt, options, future or (token queue, cancel event), enqueued at, context).
+        # Every user shares one queue unless scheduling is fair.
+        self._pending = OrderedDict()
+        self._size = 0
+        self._condition = threading.Condition()
+        # Moving average of the generation time of a batch, to tell rejected clients when to retry
+        self._batch_seconds = 1.0
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def submit(self, prompt: str, options: dict = None, user_id: str = None) -> Future:
+        """Queue a prompt for generation.
+
+        Args:
+            prompt (str): Prompt to generate from.
+            options (dict, optional): Generation options of the prompt, e.g. its maximum tokens.
+            Prompts with different options still share a batch.
+            user_id (str, optional): User of the prompt, whose prompts take turns with other users' when fair.
+
+        Returns:
+            Future: Resolves to the generated text.
+
+        Raises:
+            QueueFullError: If `max_queue_size` prompts are already waiting.
+        """
+        future = Future()
+        self._enqueue(GENERATE, prompt, options, future, user_id)
+        return future
+
+    def stream(self, prompt: str, options: dict = None, user_id: str = None) -> Iterator[str]:
+        """Queue a prompt whose answer is streamed once it gets a slot, see `submit`.
+
+        The prompt is queued right away, so a full queue raises here rather than on the first token.
+        Closing the iterator early, e.g. when the client disconnects, stops the generation.
+
+        Returns:
+            Iterator[str]: Text of the answer, as `stream_fn` yields it.
+        """
+        tokens = queue.Queue()
+        cancel = threading.Event()
+        self._enqueue(STREAM, prompt, options, (tokens, cancel), user_id)
+
+        def iterate():
+            try:
+                while True:
+                    kind, payload = tokens.get()
+                    if kind == "end":
+                        return
+                    if kind == "error":
+                        raise payload
+                    yield payload
+            finally:
+                cancel.set()
+        return iterate()
+
+    def _enqueue(self, kind: str, prompt: str, options: dict, target, user_id: str):
+        self._ensure_worker()
+        with self._condition:
+            if self.max_queue_size and self._size >= self.max_queue_size:
+                QUEUE_REJECTED.inc()
+                raise QueueFullError(self._retry_after())
+            key = user_id if self.fair else None
+            # Streamed answers are generated in the context of their request, e.g. under its trace
+            self._pending.setdefault(key, deque()).append(
+                (kind, prompt, options or {}, target, time.time(), otel_context.get_current())
+            )
+            self._size += 1
+            QUEUE_DEPTH.set(self._size)
+            self._condition.notify()
+
+    def _retry_after(self) -> int:
+        """Estimate the seconds until the queued prompts have been generated."""
+        batches_ahead = math.ceil(self._size / self.max_batch_size) / self.max_concurrent_batches
+        return max(1, math.ceil(batches_ahead * self._batch_seconds))
+
+    def _ensure_worker(self):
+        with self._lock:
+            # Each thread collects and generates one batch at a time
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < self.max_concurrent_batches:
+                worker = threading.Thread(target=self._run, name="batch-scheduler", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _pop(self, kind: str = None):
+        """Pop the oldest request of the next user, only of this kind if given. The lock must be held."""
+        for key, requests in self._pending.items():
+            request = next((request for request in requests if kind is None or request[0] == kind), None)
+            if request is None:
+                continue
+            requests.remove(request)
+            if not requests:
+                del self._pending[key]
+            else:
+                # The user goes back to the end of the line
+                self._pending.move_to_end(key)
+            self._size -= 1
+            return request
+        return None
+
+    def _collect(self) -> list:
+        """Block for the first request, then gather more until the batch is full or the window closes.
+
+        A streamed answer is generated alone, and is left queued while a batch is being gathered.
+        """
+        with self._condition:
+            while not self._size:
+                self._condition.wait()
+            batch = [self._pop()]
+            if batch[0][0] == GENERATE:
+                deadline = batch[0][4] + self.max_wait_ms / 1000
+                while len(batch) < self.max_batch_size:
+                    request = self._pop(GENERATE)
+                    if request is not None:
+                        batch.append(request)
+                        continue
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+            QUEUE_DEPTH.set(self._size)
+            return batch
+
+    def _run(self):
+        if self.threads_per_batch:
+            # Torch applies it to this thread and to threads started later, e.g. the generation thread of a stream
+            set_torch_threads(self.threads_per_batch)
+        while True:
+            batch = self._collect()
+            start_time = time.time()
+            for request in batch:
+                BATCH_WAIT_TIME.observe(start_time - request[4])
+            if batch[0][0] == STREAM:
+                self._stream(batch[0])
+            else:
+                self._generate(batch)
+            self._batch_seconds = 0.8 * self._batch_seconds + 0.2 * (time.time() - start_time)
+
+    def _generate(self, batch: list):
+        BATCH_SIZE.observe(len(batch))
+        prompts = [request[1] for request in batch]
+        options = [request[2] for request in batch]
+        try:
+            outputs = list(self.generate_fn(prompts, options))
+            if len(outputs) != len(batch):
+                # Matching outputs to prompts by position would leave some requests waiting forever
+                raise RuntimeError(f"Generated {len(outputs)} outputs for {len(batch)} prompts")
+        except Exception as e:
+            logger.error(f"Batched generation failed: {e}", exc_info=True)
+            for request in batch:
+                request[3].set_exception(e)
+            return
+
+        for request, output in zip(batch, outputs):
+            request[3].set_result(output)
+
+    def _stream(self, request: tuple):
+        _, prompt, options, (tokens, cancel), _, context = request
+        if cancel.is_set():
+            # The client left while the prompt was queued
+            return
+        token = otel_context.attach(context)
+        try:
+            for text in self.stream_fn(prompt, options, cancel):
+                if cancel.is_set():
+                    break
+                tokens.put(("token", text))
+            tokens.put(("end", None))
+        except Exception as e:
+            logger.error(f"Streamed generation failed: {e}", exc_info=True)
+            tokens.put(("error", e))
+        finally:
+            otel_context.detach(token)
@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import math
+from collections import Counter, defaultdict
+from itertools import count
+from typing import Iterable
+import numpy as np
+
+BM25_TERMS_FILE = "bm25.terms.json"
+BM25_ROWS_FILE = "bm25.rows.npy"
+BM25_FREQS_FILE = "bm25.freqs.npy"
+BM25_LENGTHS_FILE = "bm25.lengths.npy"
+
+# Words, numbers and identifiers joined by dots, dashes or slashes, e.g. "3.2.1", "ERR-404" or "v1/chat"
+TOKEN_PATTERN = re.compile(r"\w+(?:[./-]\w+)*")
+SEPARATOR_PATTERN = re.compile(r"[./-]")
+
+def tokenize(text: str) -> list:
+    """Split text into lowercase BM25 terms.
+
+    Identifiers and section numbers are kept whole, so that "3.2" does not match every "3"
+    and "2", and their parts are added too so that "ERR" still matches "ERR-404".
+
+    Args:
+        text (str): Text to split.
+
+    Returns:
+        list: Terms of the text, in order, followed by the parts of its compound terms.
+    """
+    terms = TOKEN_PATTERN.findall(text.lower())
+    # Compounds are the only terms with characters other than letters and digits, besides "_"
+    for term in [term for term in terms if not term.isalnum()]:
+        parts = SEPARATOR_PATTERN.split(term)
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+def write_bm25_index(folder_path: str, texts: Iterable[str]):
+    """Write the inverted index of chunks, labelled with their row.
+
+    The postings of every term are stored contiguously in arrays that can be memory-mapped,
+    next to the vectors written by `write_mmap_index`.
+
+    Args:
+        folder_path (str): Directory to write to.
+        texts (Iterable[str]): Text of each chunk, in row order.
+    """
+    # Ids are assigned to terms in order of first occurrence
+    term_ids = defaultdict(count().__next__)
+    postings, freqs, num_terms, lengths = [], [], [], []
+    for text in texts:
+        counts = Counter(tokenize(text))
+        postings.extend(map(term_ids.__getitem__, counts))
+        freqs.extend(counts.values())
+        num_terms.append(len(counts))
+        lengths.append(sum(counts.values()))
+
+    # Group the postings by term, rows are already in order
+    rows = np.repeat(np.arange(len(num_terms), dtype=np.int64), num_terms)
+    order = np.argsort(np.array(postings, dtype=np.int64), kind="stable")
+    bounds = np.searchsorted(np.array(postings, dtype=np.int64)[order], np.arange(len(term_ids) + 1))
+    terms = {term: [int(bounds[term_id]), int(bounds[term_id + 1])] for term, term_id in sorted(term_ids.items())}
+
+    os.makedirs(folder_path, exist_ok=True)
+    with open(os.path.join(folder_path, BM25_TERMS_FILE), "w") as f:
+        json.dump(terms, f)
+    np.save(os.path.join(folder_path, BM25_ROWS_FILE), rows[order])
+    np.save(os.path.join(folder_path, BM25_FREQS_FILE), np.array(freqs, dtype=np.float32)[order])
+    np.save(os.path.join(folder_path, BM25_LENGTHS_FILE), np.array(lengths, dtype=np.float32))
+
+class BM25Index:
+    def __init__(self, folder_path: str, k1: float = 1.5, b: float = 0.75, first_row: int = 0):
+        """Okapi BM25 search over an index written by `write_bm25_index`.
+
+        Postings are memory-mapped, so only the postings of the query terms are read.
+
+        Args:
+            folder_path (str): Directory of the index.
+            k1 (float, optional): Term frequency saturation. Defaults to 1.5.
+            b (float, optional): Chunk length normalization. Defaults to 0.75.
+            first_row (int, optional): Row of the first chunk of the index, e.g. of chunks appended
+            to a corpus. Defaults to 0.
+        """
+        with open(os.path.join(folder_path, BM25_TERMS_FILE), "r") as f:
+            self.terms = json.load(f)
+        self.rows = np.load(os.path.join(folder_path, BM25_ROWS_FILE), mmap_mode="r")
+        self.freqs = np.load(os.path.join(folder_path, BM25_FREQS_FILE), mmap_mode="r")
+        self.lengths = np.load(os.path.join(folder_path, BM25_LENGTHS_FILE))
+        self.avg_length = float(self.lengths.mean()) if len(self.lengths) else 0.0
+        self.first_row = first_row
+        self.k1 = k1
+        self.b = b
+
+    @staticmethod
+    def exists(folder_path: str) -> bool:
+        """Whether a BM25 index was written in `folder_path`."""
+        return os.path.exists(os.path.join(folder_path, BM25_TERMS_FILE))
+
+    def __len__(self) -> int:
+        return len(self.lengths)
+
+    def postings(self, term: str) -> tuple:
+        """Get the rows holding a term and its frequency in each, or None if no row holds it."""
+        if term not in self.terms:
+            return None
+        start, end = self.terms[term]
+        return np.asarray(self.rows[start:end]) + self.first_row, np.asarray(self.freqs[start:end])
+
+    def search(self, query: str, k: int, row_ranges: list = None, excluded: np.ndarray = None) -> list:
+        """Find the chunks that best match the terms of a query.
+
+        Args:
+            query (str): Query text.
+            k (int): Number of chunks to return.
+            row_ranges (list, optional): [first row, last row + 1) ranges to search in. Defaults to every chunk.
+            excluded (np.ndarray, optional): Whether to leave out each row, e.g. the rows of removed documents.
+
+        Returns:
+            list: (row, BM25 score) pairs, best match first. Chunks without any query term are left out.
+        """
+        num_rows = len(self)
+        matched_rows, matched_scores = [], []
+        for term in set(tokenize(query)):
+            postings = self.postings(term)
+            if postings is None:
+                continue
+            rows, freqs = postings
+            idf = math.log(1 + (num_rows - len(rows) + 0.5) / (len(rows) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[rows - self.first_row] / max(self.avg_length, 1e-9))
+            matched_rows.append(rows)
+            matched_scores.append(idf * freqs * (self.k1 + 1) / (freqs + norm))
+        if not matched_rows:
+            return []
+
+        rows, inverse = np.unique(np.concatenate(matched_rows), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(matched_scores))
+        if row_ranges is not None:
+            keep = np.zeros(len(rows), dtype=bool)
+            for start, end in row_ranges:
+                keep |= (rows >= start) & (rows < end)
+            rows, scores = rows[keep], scores[keep]
+        if excluded is not None:
+            keep = ~excluded[rows]
+            rows, scores = rows[keep], scores[keep]
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [(int(rows[i]), float(scores[i])) for i in top]
+
+class SegmentedBM25Index(BM25Index):
+    def __init__(self, segments: list):
+        """BM25 search over consecutive indexes, e.g. of a corpus and of the chunks appended since.
+
+        Term statistics are computed over every segment, so a chunk scores as if all the chunks
+        had been indexed together.
+
+        Args:
+            segments (list): `BM25Index` of each segment, whose `first_row` follow each other.
+        """
+        self.segments = segments
+        self.lengths = np.concatenate([segment.lengths for segment in segments])
+        self.avg_length = float(self.lengths.mean()) if len(self.lengths) else 0.0
+        self.first_row = segments[0].first_row
+        self.k1 = segments[0].k1
+        self.b = segments[0].b
+
+    def postings(self, term: str) -> tuple:
+        postings = [posting for posting in (segment.postings(term) for segment in self.segments) if posting is not None]
+        if not postings:
+            return None
+        return np.concatenate([rows for rows, _ in postings]), np.concatenate([freqs for _, freqs in postings])
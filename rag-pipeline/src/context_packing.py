@@ -0,0 +1,93 @@
+import os
+from typing import List
+from langchain_core.documents import Document
+from utils import CONTEXT_TOKENS
+
+def find_overlap(left: str, right: str, min_overlap: int = 16) -> int:
+    """Find the longest end of `left` that `right` starts with, e.g. the overlap of consecutive chunks.
+
+    Args:
+        left (str): Text whose end is compared.
+        right (str): Text whose start is compared.
+        min_overlap (int, optional): Shorter overlaps, e.g. a shared word, are ignored. Defaults to 16 characters.
+
+    Returns:
+        int: Length of the overlap in characters, 0 if none.
+    """
+    for length in range(min(len(left), len(right)) - 1, min_overlap - 1, -1):
+        if left.endswith(right[:length]):
+            return length
+    return 0
+
+def count_tokens(tokenizer, text: str) -> int:
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
+
+def truncate_tokens(tokenizer, text: str, max_tokens: int) -> tuple:
+    """Cut text after its first `max_tokens` tokens.
+
+    Returns:
+        tuple: The truncated text and its number of tokens.
+    """
+    encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=tokenizer.is_fast)
+    input_ids = encoding["input_ids"][:max_tokens]
+    if not input_ids:
+        return "", 0
+    if tokenizer.is_fast:
+        # Keep the original characters rather than decoding them again
+        return text[:encoding["offset_mapping"][len(input_ids) - 1][1]], len(input_ids)
+    return tokenizer.decode(input_ids), len(input_ids)
+
+def pack_context(docs: List[Document], tokenizer, budget: int = None, separator: str = "\n\n") -> str:
+    """Fill a token budget with the most relevant chunks, without repeating text.
+
+    Chunks are taken in order of relevance. A chunk contained in a chunk already taken is
+    skipped, and a chunk overlapping the start or end of a chunk of the same page taken before
+    is merged into it, so the overlap of the text splitter is only paid once. Chunks that do
+    not fit in the remaining budget are skipped, and the first chunk is truncated if it
+    alone exceeds the budget.
+
+    Args:
+        docs (List[Document]): Retrieved chunks, most relevant first.
+        tokenizer: Tokenizer of the LLM, which the budget is counted in.
+        budget (int, optional): Maximum tokens of context. Defaults to env `CONTEXT_TOKEN_BUDGET` or 512.
+        separator (str, optional): Separator of the packed passages. Defaults to a blank line.
+
+    Returns:
+        str: The context, passages in order of their most relevant chunk.
+    """
+    budget = budget or int(os.getenv("CONTEXT_TOKEN_BUDGET", 512))
+    separator_tokens = count_tokens(tokenizer, separator)
+    # Packed passages as [text, tokens, (doc_id, page)]
+    passages = []
+    used = 0
+    for doc in docs:
+        text = doc.page_content.strip()
+        if not text or any(text in passage[0] for passage in passages):
+            continue
+        source = (doc.metadata.get("doc_id", doc.metadata.get("source")), doc.metadata.get("page"))
+        for passage in passages:
+            if passage[2] != source:
+                continue
+            if overlap := find_overlap(passage[0], text):
+                merged = passage[0] + text[overlap:]
+            elif overlap := find_overlap(text, passage[0]):
+                merged = text + passage[0][overlap:]
+            else:
+                continue
+            # Passages after the first were charged their separator too
+            tokens = count_tokens(tokenizer, merged) + (separator_tokens if passage is not passages[0] else 0)
+            if used + tokens - passage[1] <= budget:
+                used += tokens - passage[1]
+                passage[0], passage[1] = merged, tokens
+            break
+        else:
+            tokens = count_tokens(tokenizer, text) + (separator_tokens if passages else 0)
+            if used + tokens <= budget:
+                passages.append([text, tokens, source])
+                used += tokens
+            elif not passages:
+                text, tokens = truncate_tokens(tokenizer, text, budget)
+                passages.append([text, tokens, source])
+                used += tokens
+    CONTEXT_TOKENS.observe(used)
+    return separator.join(passage[0] for passage in passages)
@@ -0,0 +1,733 @@
+import os
+import re
+import json
+import uuid
+import fcntl
+import shutil
+import hashlib
+import threading
+import weakref
+import faiss
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from ann_index import (PARAMS_FILE, apply_search_params, choose_index_type, create_index, default_params,
+                       reconstruct_ids, reconstruct_vectors)
+from mmap_index import (MMAP_INDEX_FILE, ChunkFile, RowIds, read_mmap_delta, read_mmap_extent, read_mmap_index,
+                        write_mmap_delta, write_mmap_index)
+from bm25_index import BM25Index, SegmentedBM25Index, write_bm25_index
+from utils import logger
+
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "LOCK"
+DELTA_PREFIX = "delta-"
+
+def parse_version(version: str) -> tuple:
+    """Split a corpus version into its base directory and its number of deltas, see `CorpusStore`."""
+    base, _, delta = version.partition("/")
+    return base, int(delta[len(DELTA_PREFIX):]) if delta else 0
+
+def get_delta_path(base_path: str, number: int) -> str:
+    """Get the directory of a delta of a base version."""
+    return os.path.join(base_path, f"{DELTA_PREFIX}{number:06d}")
+
+def get_doc_id_filter(filter) -> set:
+    """Get the document ids of a `{"doc_id": ...}` metadata filter.
+
+    Args:
+        filter: Metadata filter, e.g. `{"doc_id": "abc"}`, `{"doc_id": ["abc", "def"]}`
+        or `{"doc_id": {"$in": ["abc", "def"]}}`.
+
+    Returns:
+        set: The document ids, or None if the filter is not a plain document filter.
+    """
+    if not isinstance(filter, dict) or list(filter) != ["doc_id"]:
+        return None
+    condition = filter["doc_id"]
+    if isinstance(condition, dict):
+        if list(condition) not in (["$eq"], ["$in"]):
+            return None
+        condition = condition.get("$in", condition.get("$eq"))
+    return {condition} if isinstance(condition, str) else set(condition)
+
+def search_index(index: faiss.Index, vectors: np.ndarray, k: int, labels: np.ndarray = None,
+                 selector: faiss.IDSelector = None) -> tuple:
+    """Search among some vectors of an index only, skipping the others inside FAISS.
+
+    Args:
+        index (faiss.Index): Flat or IVF index.
+        vectors (np.ndarray): Query vectors.
+        k (int): Number of labels to return per query.
+        labels (np.ndarray, optional): Labels of the vectors to search. Defaults to every vector.
+        selector (faiss.IDSelector, optional): Vectors to search when `labels` is not given,
+        e.g. every vector but removed ones. Defaults to every vector.
+
+    Returns:
+        tuple: (L2 distances, labels) of each query, like `faiss.Index.search`.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if labels is not None:
+        selector = faiss.IDSelectorBatch(labels)
+        # Probe every list, the selector already skips the other vectors
+        nprobe = ivf.nlist if ivf is not None else None
+    elif selector is not None:
+        nprobe = ivf.nprobe if ivf is not None else None
+    else:
+        return index.search(vectors, k)
+    params = faiss.SearchParameters(sel=selector) if ivf is None else faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    return index.search(vectors, k, params=params)
+
+class SegmentedIndex:
+    def __init__(self, segments: list, removed: np.ndarray = None):
+        """Indexes searched as one, e.g. the memory-mapped index of a corpus and the vectors appended since.
+
+        Vectors are labelled with their chunk row in every segment. The rows of removed documents
+        stay in the segments until the corpus is compacted, and are skipped inside FAISS.
+
+        Args:
+            segments (list): FAISS indexes of the same dimension.
+            removed (np.ndarray, optional): Rows to skip. Defaults to none.
+        """
+        self.segments = segments
+        self.d = segments[0].d
+        self.removed = removed if removed is not None else np.empty(0, dtype=np.int64)
+        # FAISS does not own the inner selector, keep it alive with the outer one
+        self._removed_selector = faiss.IDSelectorBatch(self.removed) if len(self.removed) else None
+        self._selector = faiss.IDSelectorNot(self._removed_selector) if self._removed_selector is not None else None
+
+    @property
+    def ntotal(self) -> int:
+        """Number of vectors that can be found."""
+        return sum(segment.ntotal for segment in self.segments) - len(self.removed)
+
+    def search(self, vectors: np.ndarray, k: int, labels: np.ndarray = None) -> tuple:
+        """Search every segment and keep the `k` nearest vectors, see `search_index`."""
+        results = [search_index(segment, vectors, k, labels, self._selector) for segment in self.segments if segment.ntotal]
+        if not results:
+            return np.full((len(vectors), k), np.inf, dtype=np.float32), np.full((len(vectors), k), -1, dtype=np.int64)
+        if len(results) == 1:
+            return results[0]
+        distances = np.concatenate([distances for distances, _ in results], axis=1)
+        ids = np.concatenate([ids for _, ids in results], axis=1)
+        # Missing results have the largest distance, so they stay last
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+def search_label_scores(index, embedding: list, k: int, labels: np.ndarray = None) -> list:
+    """Search among some vectors of an index only, see `search_index`.
+
+    Args:
+        index (faiss.Index | SegmentedIndex): Flat or IVF index, or segments of them.
+        embedding (list): Query embedding.
+        k (int): Number of labels to return.
+        labels (np.ndarray, optional): Labels of the vectors to search. Defaults to every vector.
+
+    Returns:
+        list: (label, L2 distance) pairs, most similar first.
+    """
+    query = np.array([embedding], dtype=np.float32)
+    if isinstance(index, SegmentedIndex):
+        scores, indices = index.search(query, k, labels)
+    else:
+        scores, indices = search_index(index, query, k, labels)
+    return [(label, score) for label, score in zip(indices[0].tolist(), scores[0].tolist()) if label != -1]
+
+def search_labels(vector_store: FAISS, embedding: list, k: int, labels: np.ndarray) -> list:
+    """Search among some vectors of a store only, see `search_label_scores`.
+
+    Returns:
+        list: (Document, L2 distance) pairs, most similar first.
+    """
+    return [
+        (vector_store.docstore.search(vector_store.index_to_docstore_id[label]), score)
+        for label, score in search_label_scores(vector_store.index, embedding, k, labels)
+    ]
+
+class CorpusVectorStore(FAISS):
+    """FAISS vector store of every document of a user.
+
+    Vectors are added with explicit integer ids, so the vectors of a document can be removed
+    without renumbering the others, and searches can be restricted to some documents with
+    a FAISS id selector instead of filtering a larger result set.
+    """
+    def __init__(self, *args, index_params: dict = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index_params = index_params or {"type": "flat"}
+        # Saved version of the corpus, set by `CorpusStore`
+        self.version = None
+        self._lock = threading.RLock()
+        self._doc_labels = None
+        self._next_label = None
+
+    @classmethod
+    def create(cls, embeddings: Embeddings, dim: int) -> "CorpusVectorStore":
+        """Create an empty corpus of `dim` dimensional vectors."""
+        return cls(embeddings, faiss.IndexIDMap2(faiss.IndexFlatL2(dim)), InMemoryDocstore(), {})
+
+    def _get_doc_labels(self) -> dict:
+        """Map each document id to the ids of its vectors, built once and then updated by every change."""
+        if self._doc_labels is None:
+            doc_labels = {}
+            for label, docstore_id in self.index_to_docstore_id.items():
+                doc_labels.setdefault(docstore_id.rsplit(":", 1)[0], []).append(label)
+            self._doc_labels = {doc_id: np.array(labels, dtype=np.int64) for doc_id, labels in doc_labels.items()}
+        return self._doc_labels
+
+    def document_ids(self) -> set:
+        """Get the ids of the documents in the corpus."""
+        with self._lock:
+            return set(self._get_doc_labels())
+
+    def add_document(self, doc_id: str, vector_store: FAISS):
+        """Append the chunks of a document, replacing the document if it is already in the corpus.
+
+        Args:
+            doc_id (str): Document ID, stored in the `doc_id` metadata of every chunk.
+            vector_store (FAISS): Index of the document alone, e.g. from `get_vector_store`.
+        """
+        vectors = reconstruct_vectors(vector_store.index)
+        chunks = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in range(len(vectors))]
+        self.add_chunks(doc_id, vectors, chunks)
+
+    def add_chunks(self, doc_id: str, vectors: np.ndarray, chunks: list):
+        """Append the chunks of a document and their vectors, see `add_document`."""
+        with self._lock:
+            self.delete_document(doc_id)
+            if self._next_label is None:
+                self._next_label = max(self.index_to_docstore_id, default=-1) + 1
+            labels = np.arange(self._next_label, self._next_label + len(vectors), dtype=np.int64)
+            self._next_label += len(vectors)
+            docstore_ids = [f"{doc_id}:{i}" for i in range(len(vectors))]
+            self.index.add_with_ids(vectors, labels)
+            self.docstore.add({
+                docstore_id: Document(page_content=chunk.page_content, metadata={**chunk.metadata, "doc_id": doc_id})
+                for docstore_id, chunk in zip(docstore_ids, chunks)
+            })
+            self.index_to_docstore_id.update(zip(labels.tolist(), docstore_ids))
+            self._get_doc_labels()[doc_id] = labels
+            self._convert_if_large()
+
+    def get_document(self, doc_id: str) -> tuple:
+        """Get the chunks of a document and their vectors.
+
+        Returns:
+            tuple: (vectors, chunks) in chunk order, or None if the document is not in the corpus.
+        """
+        with self._lock:
+            labels = self._get_doc_labels().get(doc_id)
+            if labels is None:
+                return None
+            chunks = [self.docstore.search(self.index_to_docstore_id[label]) for label in labels.tolist()]
+            return reconstruct_ids(self.index, labels), chunks
+
+    def delete_document(self, doc_id: str) -> bool:
+        """Remove the chunks of a document.
+
+        Returns:
+            bool: Whether the document was in the corpus.
+        """
+        with self._lock:
+            labels = self._get_doc_labels().get(doc_id)
+            if labels is None:
+                return False
+            self.index.remove_ids(labels)
+            self.docstore.delete([self.index_to_docstore_id.pop(label) for label in labels.tolist()])
+            del self._doc_labels[doc_id]
+            return True
+
+    def _convert_if_large(self):
+        """Switch from the exact index to IVF once the corpus is large enough, keeping the vector ids."""
+        index_type = choose_index_type(self.index.ntotal, supports_removal=True)
+        if self.index_params["type"] != "flat" or index_type == "flat":
+            return
+        labels = faiss.vector_to_array(self.index.id_map)
+        vectors = faiss.downcast_index(self.index.index).reconstruct_n(0, self.index.ntotal)
+        params = default_params(index_type, len(vectors), self.index.d)
+        index = create_index(params, self.index.d)
+        index.train(vectors)
+        index.add_with_ids(vectors, labels)
+        apply_search_params(index, params)
+        self.index, self.index_params = index, params
+        logger.info(f"Converted a corpus of {len(vectors)} chunks to {index_type}: {params}")
+
+    def similarity_search_with_score_by_vector(self, embedding: list, k: int = 4, filter=None, fetch_k: int = 20, **kwargs) -> list:
+        """Search the corpus, only computing distances to the chunks of the documents in `filter`.
+
+        Args:
+            embedding (list): Query embedding.
+            k (int, optional): Number of chunks to return. Defaults to 4.
+            filter (optional): Metadata filter. Document filters, e.g. `{"doc_id": ["abc"]}`, are
+            applied inside the index. Other filters are applied to `fetch_k` results by `FAISS`.
+            fetch_k (int, optional): Results fetched before applying other filters. Defaults to 20.
+
+        Returns:
+            list: (Document, L2 distance) pairs, most similar first.
+        """
+        doc_ids = get_doc_id_filter(filter)
+        with self._lock:
+            if doc_ids is None:
+                return super().similarity_search_with_score_by_vector(embedding, k, filter=filter, fetch_k=fetch_k, **kwargs)
+
+            doc_labels = self._get_doc_labels()
+            labels = [doc_labels[doc_id] for doc_id in doc_ids if doc_id in doc_labels]
+            if not labels:
+                return []
+            return search_labels(self, embedding, k, np.concatenate(labels))
+
+class ReadOnlyCorpusError(TypeError):
+    def __init__(self, method: str):
+        """Raised when a read-only corpus is written to, since only its `CorpusStore` may update it.
+
+        Args:
+            method (str): `CorpusStore` method that makes the update instead.
+        """
+        super().__init__(f"The corpus is read-only, update it with `CorpusStore.{method}`.")
+
+class ReadOnlyCorpusVectorStore(FAISS):
+    """Memory-mapped corpus of a user, see `write_mmap_index`.
+
+    Loading only maps the files of the corpus, and processes serving the same corpus share
+    its pages through the page cache instead of each holding a copy. Chunks are labelled
+    with their row and the chunks of a document are a range of rows. Corpora saved with a BM25
+    index can also be searched by keywords, see `search_rows` and `search_keywords`. Chunks
+    appended since the corpus was last compacted are searched as a segment of their own, and
+    the rows of documents removed since are skipped.
+    """
+    def __init__(self, *args, index_params: dict = None, doc_ranges: dict = None, version: str = None,
+                 bm25: BM25Index = None, removed: np.ndarray = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index_params = index_params or {"type": "flat"}
+        self.doc_ranges = doc_ranges or {}
+        self.version = version
+        self.bm25 = bm25
+        # Whether each row belongs to a removed document, or None if no document was removed
+        self.removed = removed
+
+    @classmethod
+    def load(cls, folder_path: str, embeddings: Embeddings, version: str = None, num_deltas: int = 0) -> "ReadOnlyCorpusVectorStore":
+        """Open a corpus saved by `CorpusStore`.
+
+        Args:
+            folder_path (str): Base directory of the corpus.
+            embeddings (Embeddings): Embeddings object used by the corpus.
+            version (str, optional): Version of the corpus. Defaults to None.
+            num_deltas (int, optional): Deltas of the base to apply, see `write_mmap_delta`. Defaults to 0.
+        """
+        index, chunks, doc_ranges = read_mmap_index(folder_path)
+        with open(os.path.join(folder_path, PARAMS_FILE), "r") as f:
+            index_params = json.load(f)
+        apply_search_params(index, index_params)
+        # Versions saved before keyword search existed have no BM25 index
+        bm25 = BM25Index(folder_path) if BM25Index.exists(folder_path) else None
+        segments, removed = [index], None
+        if num_deltas:
+            appended, offsets, keyword_segments = [], [chunks.offsets[:-1]], [bm25]
+            for number in range(1, num_deltas + 1):
+                delta_path = get_delta_path(folder_path, number)
+                first_row, vectors, delta_offsets, doc_ranges = read_mmap_delta(delta_path)
+                if len(vectors):
+                    appended.append((first_row, vectors))
+                    offsets.append(delta_offsets[:-1])
+                    if bm25 is not None:
+                        keyword_segments.append(BM25Index(delta_path, first_row=first_row))
+            offsets.append(delta_offsets[-1:])
+            if appended:
+                # Appended vectors are few until the next compaction, they are searched exactly
+                appended_index = faiss.IndexIDMap2(faiss.IndexFlat(index.d, index.metric_type))
+                for first_row, vectors in appended:
+                    appended_index.add_with_ids(vectors, np.arange(first_row, first_row + len(vectors), dtype=np.int64))
+                segments.append(appended_index)
+                if bm25 is not None:
+                    bm25 = SegmentedBM25Index(keyword_segments)
+            chunks = ChunkFile(folder_path, np.concatenate(offsets))
+            removed = np.ones(len(chunks), dtype=bool)
+            for start, end in doc_ranges.values():
+                removed[start:end] = False
+        return cls(
+            embeddings, SegmentedIndex(segments, np.flatnonzero(removed) if removed is not None else None),
+            chunks, RowIds(len(chunks)), index_params=index_params, doc_ranges=doc_ranges, version=version,
+            bm25=bm25, removed=removed if removed is not None and removed.any() else None
+        )
+
+    def document_ids(self) -> set:
+        """Get the ids of the documents in the corpus."""
+        return set(self.doc_ranges)
+
+    def add_texts(self, *args, **kwargs):
+        raise ReadOnlyCorpusError("add_document")
+
+    def add_embeddings(self, *args, **kwargs):
+        raise ReadOnlyCorpusError("add_document")
+
+    def delete(self, *args, **kwargs):
+        raise ReadOnlyCorpusError("delete_document")
+
+    def similarity_search_with_score_by_vector(self, embedding: list, k: int = 4, filter=None, fetch_k: int = 20, **kwargs) -> list:
+        """Search the corpus, only computing distances to the chunks of the documents in `filter`.
+
+        See `CorpusVectorStore.similarity_search_with_score_by_vector`.
+        """
+        doc_ids = get_doc_id_filter(filter)
+        if doc_ids is None:
+            return super().similarity_search_with_score_by_vector(embedding, k, filter=filter, fetch_k=fetch_k, **kwargs)
+
+        labels = [np.arange(*self.doc_ranges[doc_id], dtype=np.int64) for doc_id in doc_ids if doc_id in self.doc_ranges]
+        if not labels:
+            return []
+        return search_labels(self, embedding, k, np.concatenate(labels))
+
+    def get_row_ranges(self, filter=None) -> list:
+        """Get the [first row, last row + 1) ranges of the documents of a `{"doc_id": ...}` filter.
+
+        Returns:
+            list: Row ranges, or None to search every chunk.
+        """
+        if not filter:
+            return None
+        doc_ids = get_doc_id_filter(filter)
+        if doc_ids is None:
+            raise ValueError(f"Only document filters can be applied to chunk rows, got {filter}")
+        return [self.doc_ranges[doc_id] for doc_id in sorted(doc_ids) if doc_id in self.doc_ranges]
+
+    def search_rows(self, embedding: list, k: int, filter=None) -> list:
+        """Search the corpus by embedding, restricted to the documents of a `{"doc_id": ...}` filter.
+
+        Returns:
+            list: (row, L2 distance) pairs, most similar first.
+        """
+        row_ranges = self.get_row_ranges(filter)
+        if row_ranges is None:
+            return search_label_scores(self.index, embedding, k)
+        if not row_ranges:
+            return []
+        labels = np.concatenate([np.arange(start, end, dtype=np.int64) for start, end in row_ranges])
+        return search_label_scores(self.index, embedding, k, labels)
+
+    def search_keywords(self, query: str, k: int, filter=None) -> list:
+        """Search the corpus by BM25, restricted to the documents of a `{"doc_id": ...}` filter.
+
+        Returns:
+            list: (row, BM25 score) pairs, best match first.
+        """
+        if self.bm25 is None:
+            raise ValueError("The corpus was saved without a BM25 index.")
+        row_ranges = self.get_row_ranges(filter)
+        if row_ranges is not None and not row_ranges:
+            return []
+        return self.bm25.search(query, k, row_ranges, self.removed)
+
+class CorpusStore:
+    def __init__(self, root_dir: str, max_deltas: int = None, max_removed_fraction: float = None, max_resident: int = None):
+        """Persistent store of the corpus of each user.
+
+        A corpus is saved in full as a base version, holding the corpus both as a pickled `FAISS`
+        store, which is loaded to update it, and in the memory-mapped format served to chat
+        requests, with a BM25 index of the same chunks. Later updates only write a delta of the
+        base, with the chunks of the added documents appended to its chunk file, so that an
+        upload costs the size of the document rather than of the corpus. Once a base has
+        `max_deltas` deltas, or `max_removed_fraction` of its rows belong to removed documents,
+        the corpus is compacted into a new base in the background.
+
+        Every save atomically points the `CURRENT` file of the user to the new version, so
+        readers never load a half-written corpus. Updates of the same user are serialized with
+        a file lock, so several server processes can share the store. Loaded corpora are shared,
+        e.g. between a resident QA pipeline and an ingestion job, as long as they are referenced
+        and up to date. The last `max_resident` updated corpora stay loaded, so that uploads in
+        a row do not reload the corpus.
+
+        Args:
+            root_dir (str): Directory holding one sub-directory per user.
+            max_deltas (int, optional): Deltas of a base before it is compacted. Defaults to env
+            `CORPUS_MAX_DELTAS` or 16.
+            max_removed_fraction (float, optional): Fraction of rows of removed documents before
+            the corpus is compacted. Defaults to env `CORPUS_MAX_REMOVED_FRACTION` or 0.25.
+            max_resident (int, optional): Updated corpora kept loaded. Defaults to env `CORPUS_MAX_RESIDENT` or 2.
+        """
+        self.root_dir = root_dir
+        self.max_deltas = max_deltas or int(os.getenv("CORPUS_MAX_DELTAS", 16))
+        self.max_removed_fraction = max_removed_fraction if max_removed_fraction is not None \
+            else float(os.getenv("CORPUS_MAX_REMOVED_FRACTION", 0.25))
+        self.max_resident = max_resident or int(os.getenv("CORPUS_MAX_RESIDENT", 2))
+        self._loaded = weakref.WeakValueDictionary()
+        self._resident = OrderedDict()  # user_id -> corpus, least recently updated first
+        self._read_only = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self._user_locks = {}
+        self._compactions = {}  # user_id -> compaction thread
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def user_dir(self, user_id: str) -> str:
+        # Keep the directory readable, the hash avoids collisions between sanitized ids
+        safe_id = re.sub(r"[^\w.-]", "_", user_id)[:64]
+        return os.path.join(self.root_dir, f"{safe_id}-{hashlib.md5(user_id.encode()).hexdigest()[:8]}")
+
+    def _user_lock(self, user_id: str) -> threading.RLock:
+        with self._lock:
+            return self._user_locks.setdefault(user_id, threading.RLock())
+
+    @contextmanager
+    def _write_lock(self, user_id: str):
+        """Serialize the updates of a user's corpus across threads and processes."""
+        with self._user_lock(user_id):
+            user_dir = self.user_dir(user_id)
+            os.makedirs(user_dir, exist_ok=True)
+            with open(os.path.join(user_dir, LOCK_FILE), "w") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+
+    def current_version(self, user_id: str) -> str:
+        """Get the saved version of a user's corpus, or None if the user has no document yet."""
+        try:
+            with open(os.path.join(self.user_dir(user_id), CURRENT_FILE), "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def load(self, user_id: str, embeddings: Embeddings) -> CorpusVectorStore:
+        """Get the corpus of a user to update it.
+
+        Args:
+            user_id (str): User ID.
+            embeddings (Embeddings): Embeddings object used by the corpus.
+
+        Returns:
+            CorpusVectorStore: The corpus, or None if the user has no document yet.
+        """
+        # Saves of the same user remove the previous version, wait for them
+        with self._user_lock(user_id):
+            version = self.current_version(user_id)
+            if version is None:
+                return None
+            with self._lock:
+                corpus = self._loaded.get(user_id)
+            # Another process may have saved a newer version
+            if corpus is not None and corpus.version == version:
+                return corpus
+
+            base, num_deltas = parse_version(version)
+            base_dir = os.path.join(self.user_dir(user_id), base)
+            loaded_base, loaded_deltas = parse_version(corpus.version) if corpus is not None else (None, 0)
+            # Only the deltas saved since are applied, unless the corpus was compacted
+            if loaded_base != base or loaded_deltas > num_deltas:
+                with open(os.path.join(base_dir, PARAMS_FILE), "r") as f:
+                    index_params = json.load(f)
+                corpus = CorpusVectorStore.load_local(
+                    folder_path=base_dir,
+                    embeddings=embeddings,
+                    allow_dangerous_deserialization=True,
+                    index_params=index_params
+                )
+                apply_search_params(corpus.index, index_params)
+                loaded_deltas = 0
+            with corpus._lock:
+                for number in range(loaded_deltas + 1, num_deltas + 1):
+                    self._apply_delta(corpus, base_dir, number)
+                corpus.version = version
+            with self._lock:
+                self._loaded[user_id] = corpus
+            return corpus
+
+    @staticmethod
+    def _apply_delta(corpus: CorpusVectorStore, base_dir: str, number: int):
+        """Apply a delta written by `_save_delta` to the corpus of its previous version."""
+        first_row, vectors, offsets, doc_ranges = read_mmap_delta(get_delta_path(base_dir, number))
+        chunks = ChunkFile(base_dir, offsets)
+        for doc_id in corpus.document_ids() - set(doc_ranges):
+            corpus.delete_document(doc_id)
+        for doc_id, (start, end) in doc_ranges.items():
+            if start >= first_row:
+                rows = range(start - first_row, end - first_row)
+                corpus.add_chunks(doc_id, vectors[rows.start:rows.stop], [chunks.search(row) for row in rows])
+
+    def load_read_only(self, user_id: str, embeddings: Embeddings) -> FAISS:
+        """Get the memory-mapped corpus of a user to search it.
+
+        Args:
+            user_id (str): User ID.
+            embeddings (Embeddings): Embeddings object used by the corpus.
+
+        Returns:
+            ReadOnlyCorpusVectorStore: The corpus, or None if the user has no document yet. Corpora
+            saved before the memory-mapped format existed are loaded as a `CorpusVectorStore`.
+        """
+        for attempt in range(2):
+            version = self.current_version(user_id)
+            if version is None:
+                return None
+            with self._lock:
+                corpus = self._read_only.get((user_id, version))
+            if corpus is not None:
+                return corpus
+
+            base, num_deltas = parse_version(version)
+            base_dir = os.path.join(self.user_dir(user_id), base)
+            if not os.path.exists(os.path.join(base_dir, MMAP_INDEX_FILE)) and os.path.isdir(base_dir):
+                return self.load(user_id, embeddings)
+            try:
+                corpus = ReadOnlyCorpusVectorStore.load(base_dir, embeddings, version=version, num_deltas=num_deltas)
+            except (FileNotFoundError, RuntimeError):
+                # The version was compacted and removed while being opened
+                if attempt > 0:
+                    raise
+                continue
+            with self._lock:
+                self._read_only[(user_id, version)] = corpus
+            return corpus
+
+    def add_document(self, user_id: str, doc_id: str, vector_store: FAISS, embeddings: Embeddings, keep_doc_ids: set = None) -> CorpusVectorStore:
+        """Append a document to the corpus of a user and save it.
+
+        Args:
+            user_id (str): User ID.
+            doc_id (str): Document ID.
+            vector_store (FAISS): Index of the document alone.
+            embeddings (Embeddings): Embeddings object used by the corpus.
+            keep_doc_ids (set, optional): Documents the user still has. Other documents, e.g. replaced
+            by a new upload of the same file, are removed from the corpus. Defaults to keeping all.
+
+        Returns:
+            CorpusVectorStore: The updated corpus.
+        """
+        with self._write_lock(user_id):
+            corpus = self.load(user_id, embeddings) or CorpusVectorStore.create(embeddings, vector_store.index.d)
+            if keep_doc_ids is not None:
+                for stale_doc_id in corpus.document_ids() - set(keep_doc_ids) - {doc_id}:
+                    corpus.delete_document(stale_doc_id)
+            corpus.add_document(doc_id, vector_store)
+            self._save(user_id, corpus, embeddings, added=[doc_id])
+            return corpus
+
+    def delete_document(self, user_id: str, doc_id: str, embeddings: Embeddings) -> bool:
+        """Remove a document from the corpus of a user and save it.
+
+        Returns:
+            bool: Whether the document was in the corpus.
+        """
+        with self._write_lock(user_id):
+            corpus = self.load(user_id, embeddings)
+            if corpus is None or not corpus.delete_document(doc_id):
+                return False
+            self._save(user_id, corpus, embeddings)
+            return True
+
+    def compact(self, user_id: str, embeddings: Embeddings) -> bool:
+        """Save the corpus of a user as a new base version, dropping the rows of removed documents.
+
+        Returns:
+            bool: Whether the corpus had deltas to compact.
+        """
+        with self._write_lock(user_id):
+            corpus = self.load(user_id, embeddings)
+            if corpus is None or parse_version(corpus.version)[1] == 0:
+                return False
+            self._save_base(user_id, corpus)
+            logger.info(f"Compacted the corpus of user {user_id}")
+            return True
+
+    def wait_for_compactions(self):
+        """Wait for the compactions running in the background, e.g. before the server exits."""
+        with self._lock:
+            threads = list(self._compactions.values())
+        for thread in threads:
+            thread.join()
+
+    def _schedule_compaction(self, user_id: str, embeddings: Embeddings):
+        with self._lock:
+            if user_id in self._compactions:
+                return
+            # It waits for the save in progress to release the lock of the user
+            thread = threading.Thread(target=self._compact, args=(user_id, embeddings), name="corpus-compaction", daemon=True)
+            self._compactions[user_id] = thread
+        thread.start()
+
+    def _compact(self, user_id: str, embeddings: Embeddings):
+        try:
+            self.compact(user_id, embeddings)
+        except Exception as e:
+            logger.error(f"Compaction of the corpus of user {user_id} failed: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._compactions.pop(user_id, None)
+
+    def _save(self, user_id: str, corpus: CorpusVectorStore, embeddings: Embeddings, added: list = ()):
+        """Save the changes of a corpus since its version, the documents in `added` and the removed ones."""
+        try:
+            base_dir = os.path.join(self.user_dir(user_id), parse_version(corpus.version)[0]) if corpus.version else None
+            # New corpora and corpora saved before the memory-mapped format existed are saved in full
+            if base_dir is None or not os.path.exists(os.path.join(base_dir, MMAP_INDEX_FILE)):
+                self._save_base(user_id, corpus)
+            elif self._save_delta(user_id, corpus, added):
+                self._schedule_compaction(user_id, embeddings)
+        except Exception:
+            # The corpus holds changes that were not saved
+            with self._lock:
+                self._loaded.pop(user_id, None)
+                self._resident.pop(user_id, None)
+            raise
+        with self._lock:
+            self._loaded[user_id] = corpus
+            self._resident[user_id] = corpus
+            self._resident.move_to_end(user_id)
+            while len(self._resident) > self.max_resident:
+                self._resident.popitem(last=False)
+
+    def _save_delta(self, user_id: str, corpus: CorpusVectorStore, added: list) -> bool:
+        """Save the changes of a corpus as a delta of its version.
+
+        Returns:
+            bool: Whether the corpus should be compacted.
+        """
+        user_dir = self.user_dir(user_id)
+        base, number = parse_version(corpus.version)
+        base_dir = os.path.join(user_dir, base)
+        delta_dir = get_delta_path(base_dir, number + 1)
+        version = os.path.relpath(delta_dir, user_dir)
+        # Left over by an interrupted save
+        shutil.rmtree(delta_dir, ignore_errors=True)
+        with corpus._lock:
+            documents = {doc_id: corpus.get_document(doc_id) for doc_id in added}
+            doc_ranges = write_mmap_delta(
+                delta_dir, base_dir, os.path.join(user_dir, corpus.version), documents, corpus.document_ids()
+            )
+            write_bm25_index(delta_dir, (chunk.page_content for _, chunks in documents.values() for chunk in chunks))
+            self._set_current(user_id, version)
+            corpus.version = version
+
+        num_rows, _ = read_mmap_extent(delta_dir)
+        removed_rows = num_rows - sum(end - start for start, end in doc_ranges.values())
+        with open(os.path.join(base_dir, PARAMS_FILE), "r") as f:
+            base_params = json.load(f)
+        return number + 1 >= self.max_deltas or removed_rows > self.max_removed_fraction * num_rows \
+            or corpus.index_params != base_params
+
+    def _save_base(self, user_id: str, corpus: CorpusVectorStore):
+        """Save a corpus in full as a new base version and remove the previous ones."""
+        user_dir = self.user_dir(user_id)
+        version = uuid.uuid4().hex
+        version_dir = os.path.join(user_dir, version)
+        with corpus._lock:
+            corpus.save_local(version_dir)
+            with open(os.path.join(version_dir, PARAMS_FILE), "w") as f:
+                json.dump(corpus.index_params, f)
+            write_mmap_index(version_dir, corpus)
+            # Keyword index of the same rows, for hybrid retrieval
+            chunks = ChunkFile(version_dir)
+            write_bm25_index(version_dir, (chunks.search(row).page_content for row in range(len(chunks))))
+            self._set_current(user_id, version)
+            corpus.version = version
+
+        # Remove the previous versions. Processes that still map their files keep reading them.
+        for entry in os.scandir(user_dir):
+            if entry.is_dir() and entry.name != version:
+                shutil.rmtree(entry.path, ignore_errors=True)
+
+    def _set_current(self, user_id: str, version: str):
+        user_dir = self.user_dir(user_id)
+        tmp_path = os.path.join(user_dir, f"{CURRENT_FILE}.{uuid.uuid4().hex}")
+        with open(tmp_path, "w") as f:
+            f.write(version)
+        os.replace(tmp_path, os.path.join(user_dir, CURRENT_FILE))
@@ -1,37 +1,165 @@
-from langchain_community.document_loaders import PyPDFLoader
+import os
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator
+from pypdf import PdfReader
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from utils import get_doc_dir
+from utils import get_doc_dir, get_model_dir
 
-def extract_data(pdf_path: str) -> list:
+# Chunk size and overlap in characters, when no tokenizer is available
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 100
+# Chunk size and overlap in tokens of the LLM
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", 256))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", 32))
+
+# Shared pool of extraction workers, created once with a fixed size
+_executor = None
+_executor_lock = threading.Lock()
+# PDF opened by the current worker process, as ((path, mtime), reader)
+_worker_reader = (None, None)
+# Text splitter of the current worker process, as (tokenizer directory, splitter)
+_worker_splitter = (None, None)
+
+def get_chunk_tokenizer_dir(local_dir: str = None) -> str:
+    """Get the directory of the tokenizer that chunks are measured with.
+
+    Chunks are measured in tokens of the LLM when its tokenizer has been downloaded, so that
+    the context packed into a prompt has a predictable length. Set env `CHUNK_BY_TOKENS` to
+    "false" to measure them in characters.
+
+    Args:
+        local_dir (str, optional): Directory of the local LLM model. Defaults to `get_model_dir()`.
+
+    Returns:
+        str: The tokenizer directory, or None to measure chunks in characters.
+    """
+    if os.getenv("CHUNK_BY_TOKENS", "true").lower() == "false":
+        return None
+    local_dir = local_dir or get_model_dir()
+    return local_dir if os.path.exists(os.path.join(local_dir, "tokenizer_config.json")) else None
+
+def get_chunking_key(tokenizer_dir: str = None) -> str:
+    """Describe the chunking of documents, so that indexes of another chunking are not reused."""
+    if tokenizer_dir is None:
+        return f"{CHUNK_SIZE}:{CHUNK_OVERLAP}"
+    return f"tokens:{CHUNK_TOKENS}:{CHUNK_OVERLAP_TOKENS}:{os.path.basename(os.path.normpath(tokenizer_dir))}"
+
+def get_text_splitter(tokenizer_dir: str = None) -> RecursiveCharacterTextSplitter:
+    """Get the text splitter of the current process, measuring chunks in tokens if `tokenizer_dir` is set."""
+    global _worker_splitter
+    if _worker_splitter[1] is None or _worker_splitter[0] != tokenizer_dir:
+        if tokenizer_dir is None:
+            splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+        else:
+            from transformers import AutoTokenizer
+            splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+                AutoTokenizer.from_pretrained(tokenizer_dir),
+                chunk_size=CHUNK_TOKENS,
+                chunk_overlap=CHUNK_OVERLAP_TOKENS
+            )
+        _worker_splitter = (tokenizer_dir, splitter)
+    return _worker_splitter[1]
+
+def get_extraction_workers() -> int:
+    """Number of extraction worker processes, from env `PDF_EXTRACTION_WORKERS` or min(4, cpu count)."""
+    return int(os.getenv("PDF_EXTRACTION_WORKERS", min(4, os.cpu_count() or 1)))
+
+def start_extraction_pool() -> ProcessPoolExecutor:
+    """Get the shared pool of extraction workers, creating it on first call.
+
+    The pool has `get_extraction_workers()` processes for the life of the server and is never
+    replaced, so documents being extracted never lose their workers. Call it at startup so that
+    the first upload does not wait for it.
+
+    Returns:
+        ProcessPoolExecutor: The shared pool.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Forking a process that already runs threads (the server, torch) can deadlock its children.
+            # Workers are forked from a clean server process instead, which imports the extraction
+            # modules once rather than every worker importing them again.
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            context = multiprocessing.get_context(method)
+            if method == "forkserver":
+                context.set_forkserver_preload(["__main__", __name__])
+            _executor = ProcessPoolExecutor(max_workers=get_extraction_workers(), mp_context=context)
+        return _executor
+
+def _split_page(pdf_path: str, page_number: int, tokenizer_dir: str = None) -> list:
+    """Extract the text of one page and split it into chunks. Runs in a worker process."""
+    global _worker_reader
+    key = (pdf_path, os.path.getmtime(pdf_path))
+    if _worker_reader[0] != key:
+        _worker_reader = (key, PdfReader(pdf_path))
+    page = _worker_reader[1].pages[page_number]
+    text = page.extract_text(extraction_mode="plain").strip()
+    return get_text_splitter(tokenizer_dir).split_text(text)
+
+def iter_chunks(pdf_path: str, progress: Callable = None, workers: int = None, tokenizer_dir: str = None) -> Iterator[Document]:
+    """Lazily extract and split the pages of a PDF document, in parallel.
+
+    Pages are parsed and split by a pool of worker processes while earlier chunks are
+    already being consumed. Only a small window of pages is in flight at any time.
+
+    Args:
+        pdf_path (str): Path to the pdf document.
+        progress (Callable, optional): Called with `pages_total` first, then as `progress(pages_parsed=n)` after each page.
+        workers (int, optional): Pages of this document extracted at the same time by the shared pool,
+        see `start_extraction_pool`. Defaults to `get_extraction_workers()`.
+        tokenizer_dir (str, optional): Tokenizer to measure chunks in `CHUNK_TOKENS` tokens with,
+        e.g. from `get_chunk_tokenizer_dir`. Defaults to measuring chunks in `CHUNK_SIZE` characters.
+
+    Yields:
+        Document: Text chunks in page order, with `source` and `page` metadata.
+    """
+    workers = workers or get_extraction_workers()
+    num_pages = len(PdfReader(pdf_path).pages)
+    if progress is not None:
+        progress(pages_total=num_pages)
+
+    # Small documents are not worth the inter-process round trips
+    if workers <= 1 or num_pages < 2 * workers:
+        results = (_split_page(pdf_path, page_number, tokenizer_dir) for page_number in range(num_pages))
+    else:
+        results = _iter_parallel(pdf_path, num_pages, start_extraction_pool(), window=2 * workers, tokenizer_dir=tokenizer_dir)
+
+    for page_number, chunk_list in enumerate(results):
+        for chunk in chunk_list:
+            yield Document(page_content=chunk, metadata={"source": pdf_path, "page": page_number})
+        if progress is not None:
+            progress(pages_parsed=page_number + 1)
+
+def _iter_parallel(pdf_path: str, num_pages: int, executor: ProcessPoolExecutor, window: int, tokenizer_dir: str = None) -> Iterator[list]:
+    """Yield the chunks of every page in order, keeping at most `window` pages in flight."""
+    pending = deque()
+    next_page = 0
+    while next_page < num_pages or pending:
+        while next_page < num_pages and len(pending) < window:
+            pending.append(executor.submit(_split_page, pdf_path, next_page, tokenizer_dir))
+            next_page += 1
+        yield pending.popleft().result()
+
+def extract_data(pdf_path: str, progress: Callable = None) -> list:
     """Extract text from a PDF document and return a list of text chunks.
 
     Args:
         pdf_path (str): Path to the pdf document.
+        progress (Callable, optional): Called as `progress(pages_parsed=n)` after each page.
 
     Returns:
         list: A list of text chunks.
     """
-    # Load a PDF document
-    loader = PyPDFLoader(pdf_path)
-    docs = loader.load()  # a list of Document objects
-    
-    # Split text into chunks
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=100
-    )
-
-    chunks = []
-    for doc in docs:
-        chunk_list = text_splitter.split_text(doc.page_content)
-        for chunk in chunk_list:
-            chunks.append(chunk)
-            
-    return chunks
+    return [doc.page_content for doc in iter_chunks(pdf_path, progress=progress)]
+
 
-    
 if __name__ == "__main__":
     chunks = extract_data(get_doc_dir())
     print("Number of text chunks:", len(chunks))
     print("Sample chunks:", chunks[:2])
-    
+
@@ -1,66 +1,361 @@
-from transformers import AutoTokenizer, pipeline
-from transformers.modeling_utils import PreTrainedModel
-from langchain_huggingface import HuggingFacePipeline
-from langchain.prompts import PromptTemplate
-from langchain.chains.retrieval_qa.base import RetrievalQA
-from model_setup import load_model
+import time
+import weakref
+from threading import Thread, Event
+from typing import TYPE_CHECKING, Callable, Iterator
+from langchain_core.retrievers import BaseRetriever
 from data_preparation import prepare_retriever
-from utils import get_model_dir, tracer, trace
+from hybrid_retrieval import HybridRetriever
+from context_packing import pack_context
+from resources import resources, GENERATION_KWARGS, PROMPT_TEMPLATE
+from prefix_cache import PrefixCache
+from speculative import PROMPT_LOOKUP, prompt_lookup_generate, speculative_decoding_enabled
+from generation_controls import build_generation_kwargs, get_temperatures, truncate_at_stop, stream_until_stop
+from opentelemetry import context as otel_context
+from utils import (get_model_dir, timed_stage, tracer, trace, logger,
+                   CHAT_STAGE_LATENCY, GENERATION_TOKENS_PER_SECOND, PROMPT_TOKENS, GENERATED_TOKENS)
 
-def setup_pipeline(local_dir: str, file_path: str = None, model: PreTrainedModel = None) -> RetrievalQA:
+if TYPE_CHECKING:
+    # torch, transformers and langchain chains take seconds to import, only type checkers load them here
+    from transformers import TextIteratorStreamer
+    from transformers.modeling_utils import PreTrainedModel
+    from langchain.chains.retrieval_qa.base import RetrievalQA
+    from langchain_core.language_models.llms import BaseLLM
+
+# Past key values of recent prompt prefixes, shared by every user
+prefix_cache = PrefixCache()
+
+def setup_pipeline(
+    local_dir: str, 
+    file_path: str = None, 
+    model: "PreTrainedModel" = None, 
+    progress: Callable = None, 
+    retriever: BaseRetriever = None,
+    llm: "BaseLLM" = None
+    ) -> "RetrievalQA":
     """Setup a QA chain with RAG model.
+    
+    The tokenizer, LLM pipeline and prompt are shared across calls through the resource
+    registry, so only the retriever is built per document.
 
     Args:
         local_dir (str): Directory of the local LLM model.
         file_path (str): File path to the PDF file.
         model (PreTrainedModel): Pre-loaded locam LLM model.
+        progress (Callable): Progress callback of the ingestion.
+        retriever (BaseRetriever): Retriever to use instead of indexing `file_path`, e.g. over a user's corpus.
+        llm (BaseLLM): LLM to use instead of the shared local one, e.g. generating on inference worker processes.
 
     Returns:
         RetrievalQA: A QA chain object.
     """
     with tracer.start_as_current_span("setup_pipeline") as setup_pipeline:
-        with tracer.start_as_current_span("load_tokenizer", links=[trace.Link(setup_pipeline.get_span_context())]):
-            tokenizer = AutoTokenizer.from_pretrained(local_dir)
-        
-        if model is None:
-            model = load_model(
-                model_name="Qwen/Qwen2.5-0.5B-Instruct", 
-                local_dir=get_model_dir()
-            )
+        with tracer.start_as_current_span("load_llm", links=[trace.Link(setup_pipeline.get_span_context())]):
+            # Wrap the shared HuggingFace pipeline in a LangChain object
+            local_llm = llm or resources.get_llm(local_dir, model)
         
         with tracer.start_as_current_span("prepare_retriever", links=[trace.Link(setup_pipeline.get_span_context())]):
-            retriever = prepare_retriever(file_path=file_path)
-        
-        # Setup a RAG pipeline
-        pipe = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            repetition_penalty=1.2,
-            max_new_tokens=500
-        )
-        
-        # Wrap the HuggingFace pipeline in a LangChain object
-        local_llm = HuggingFacePipeline(pipeline=pipe)
-        
-        # Define the prompt template
-        prompt_template = """Answer based on context:\n{context}\nQuestion: {question}\nAnswer:"""
-        prompt = PromptTemplate(
-            input_variables=["context", "question"],
-            template=prompt_template
-        )
+            if retriever is None:
+                retriever = prepare_retriever(file_path=file_path, progress=progress)
         
         # Setup a QA chain
+        from langchain.chains.retrieval_qa.base import RetrievalQA
         qa_chain = RetrievalQA.from_chain_type(
         llm=local_llm,
         chain_type="stuff",
         retriever=retriever,
         return_source_documents=False,
-        chain_type_kwargs={"prompt": prompt}
+        chain_type_kwargs={"prompt": resources.get_prompt()}
         )
         
         return qa_chain
 
+def build_prompt(qa_chain: "RetrievalQA", question: str, question_embedding: list = None, doc_ids: list = None,
+                 local_dir: str = None) -> str:
+    """Retrieve the context of a question and fill in the RAG prompt.
+
+    Retrieved chunks are packed into a token budget by `pack_context`, so the prefill cost of
+    prompts does not depend on how many chunks were retrieved or how long they are.
+
+    Args:
+        qa_chain (RetrievalQA): QA chain holding the user's retriever.
+        question (str): A question to ask.
+        question_embedding (list, optional): Embedding of the question, if already computed,
+        so that the retriever does not embed it again.
+        doc_ids (list, optional): Only retrieve chunks of these documents. Defaults to all documents.
+        local_dir (str, optional): Directory of the local LLM, whose tokenizer counts the budget.
+        Defaults to `get_model_dir()`.
+
+    Returns:
+        str: The prompt to generate an answer from.
+    """
+    with timed_stage(CHAT_STAGE_LATENCY, "retrieve", "retrieve_context"):
+        retriever = qa_chain.retriever
+        search_kwargs = {"filter": {"doc_id": list(doc_ids)}} if doc_ids else {}
+        if isinstance(retriever, HybridRetriever):
+            docs = retriever.invoke(question, embedding=question_embedding, **search_kwargs)
+        elif question_embedding is not None and hasattr(retriever, "vectorstore"):
+            docs = retriever.vectorstore.similarity_search_by_vector(
+                question_embedding, **{**retriever.search_kwargs, **search_kwargs}
+            )
+        else:
+            docs = retriever.invoke(question, **search_kwargs)
+    with timed_stage(CHAT_STAGE_LATENCY, "pack_context"):
+        docs = list(docs)
+        context = pack_context(docs, resources.get_tokenizer(local_dir or get_model_dir())) if docs else ""
+    return resources.get_prompt().format(context=context, question=question)
+
+class GenerationTimer:
+    def __init__(self, streamer=None):
+        """Streamer recording when the prefill and the decoding of a generation end.
+
+        `generate` puts the prompt before the prefill, then the tokens of each step, so the
+        prefill ends with the second put. Everything is passed on to `streamer`, if given.
+
+        Args:
+            streamer (BaseStreamer, optional): Streamer of the generated tokens, e.g. a `TextIteratorStreamer`.
+        """
+        self.streamer = streamer
+        self.start_ns = None
+        self.first_token_ns = None
+        self.end_ns = None
+        self.first_tokens = 0
+
+    def put(self, value):
+        if self.start_ns is None:
+            self.start_ns = time.time_ns()
+        elif self.first_token_ns is None:
+            self.first_token_ns = time.time_ns()
+            self.first_tokens = value.numel()
+        if self.streamer is not None:
+            self.streamer.put(value)
+
+    def end(self):
+        self.end_ns = time.time_ns()
+        if self.streamer is not None:
+            self.streamer.end()
+
+    def observe(self, prompt_tokens: int, generated_tokens: int, decoding: str = "greedy"):
+        """Record the prefill and decode stages as spans and metrics, once the generation ended.
+
+        Args:
+            prompt_tokens (int): Prompt tokens of every sequence, padding excluded.
+            generated_tokens (int): Tokens generated for every sequence, padding excluded.
+            decoding (str, optional): Decoding method, "greedy" or "prompt_lookup". Defaults to "greedy".
+        """
+        PROMPT_TOKENS.inc(prompt_tokens)
+        GENERATED_TOKENS.inc(generated_tokens)
+        if self.first_token_ns is None:
+            return
+        end_ns = self.end_ns or time.time_ns()
+        for stage, start_ns, stage_end_ns in (("prefill", self.start_ns, self.first_token_ns), ("decode", self.first_token_ns, end_ns)):
+            tracer.start_span(stage, start_time=start_ns).end(end_time=stage_end_ns)
+            CHAT_STAGE_LATENCY.labels(stage=stage).observe((stage_end_ns - start_ns) / 1e9)
+        decode_tokens = generated_tokens - self.first_tokens
+        if decode_tokens > 0 and end_ns > self.first_token_ns:
+            GENERATION_TOKENS_PER_SECOND.labels(decoding=decoding).observe(decode_tokens * 1e9 / (end_ns - self.first_token_ns))
+
+def get_prefix_lengths(tokenizer, prompt: str) -> tuple:
+    """Tokenize a RAG prompt and find where its reusable prefixes end.
+
+    The template header is shared by every prompt, and the header followed by the retrieved
+    context is shared by follow-up questions over the same chunks.
+
+    Args:
+        tokenizer: Tokenizer of the local LLM.
+        prompt (str): Prompt built from `PROMPT_TEMPLATE`.
+
+    Returns:
+        tuple: Token ids of the prompt and the lengths, in tokens, of its reusable prefixes.
+    """
+    header, rest = PROMPT_TEMPLATE.split("{context}")
+    question_marker = rest.split("{question}")[0]
+    prefix_ends = []
+    if prompt.startswith(header):
+        prefix_ends.append(len(header))
+        context_end = prompt.rfind(question_marker)
+        if context_end > len(header):
+            prefix_ends.append(context_end)
+
+    encoding = tokenizer(prompt, return_offsets_mapping=tokenizer.is_fast)
+    input_ids = encoding["input_ids"]
+    prefix_lengths = []
+    for end in prefix_ends:
+        if tokenizer.is_fast:
+            # A token crossing the boundary belongs to the remainder of the prompt
+            prefix_lengths.append(sum(1 for _, token_end in encoding["offset_mapping"] if token_end <= end))
+        else:
+            prefix_ids = tokenizer(prompt[:end])["input_ids"]
+            if input_ids[:len(prefix_ids)] == prefix_ids:
+                prefix_lengths.append(len(prefix_ids))
+    return input_ids, prefix_lengths
+
+def generate_with_prefix_cache(model: "PreTrainedModel", tokenizer, prompt: str, streamer: "TextIteratorStreamer" = None,
+                               options: dict = None, cancel: Event = None) -> list:
+    """Generate an answer, only prefilling the part of the prompt missing from the prefix cache.
+
+    With env `SPECULATIVE_DECODING` set to "prompt_lookup", tokens copied from the retrieved
+    context are drafted and verified several at a time, see `prompt_lookup_generate`. Requests
+    sampling at a positive temperature, their own or the model's default, are decoded normally.
+
+    Args:
+        model (PreTrainedModel): Local LLM model.
+        tokenizer: Tokenizer of the local LLM.
+        prompt (str): Prompt to generate from.
+        streamer (TextIteratorStreamer, optional): Receives the tokens as they are generated.
+        options (dict, optional): Generation options of the request, see `resolve_generation_options`.
+        cancel (Event, optional): Stops the generation at the next token once set.
+
+    Returns:
+        list: Token ids of the answer, without the prompt. It may end with the stop sequence that ended it.
+    """
+    with tracer.start_as_current_span("generate_with_prefix_cache") as span:
+        with timed_stage(CHAT_STAGE_LATENCY, "tokenize"):
+            input_ids, prefix_lengths = get_prefix_lengths(tokenizer, prompt)
+        cached_length, past_key_values = 0, None
+        # Unlike `id(model)`, a weak reference never matches a new model that reuses the id of a collected one
+        model_key = weakref.ref(model)
+        if prefix_cache.enabled:
+            cached_length, past_key_values = prefix_cache.lookup(model_key, input_ids, prefix_lengths)
+        span.set_attribute("prompt_tokens", len(input_ids))
+        span.set_attribute("prefill_tokens_reused", cached_length)
+
+        options = options or {}
+        generation_kwargs = build_generation_kwargs(model, tokenizer, len(input_ids), [options], cancel=cancel)
+        timer = GenerationTimer(streamer)
+        # Drafts are verified greedily, so requests sampling, by default or not, are decoded normally
+        if speculative_decoding_enabled() and get_temperatures(model, [options])[0] == 0:
+            answer_ids, past_key_values, stats = prompt_lookup_generate(
+                model, input_ids, generation_kwargs["max_new_tokens"],
+                eos_token_id=model.generation_config.eos_token_id,
+                past_key_values=past_key_values,
+                repetition_penalty=generation_kwargs["repetition_penalty"],
+                streamer=timer,
+                stopping_criteria=generation_kwargs.get("stopping_criteria", [None])[0]
+            )
+            span.set_attribute("draft_tokens", stats["draft_tokens"])
+            span.set_attribute("accepted_draft_tokens", stats["accepted_tokens"])
+            span.set_attribute("forward_passes", stats["forward_passes"])
+            decoding = PROMPT_LOOKUP
+        else:
+            import torch
+            inputs = torch.tensor([input_ids], device=model.device)
+            output = model.generate(
+                input_ids=inputs,
+                attention_mask=torch.ones_like(inputs),
+                past_key_values=past_key_values,
+                streamer=timer,
+                pad_token_id=tokenizer.pad_token_id,
+                return_dict_in_generate=True,
+                **generation_kwargs
+            )
+            answer_ids, past_key_values = output.sequences[0, len(input_ids):].tolist(), output.past_key_values
+            decoding = "greedy"
+        timer.observe(len(input_ids), len(answer_ids), decoding)
+        span.set_attribute("generated_tokens", len(answer_ids))
+        prefix_cache.store(model_key, input_ids, prefix_lengths, past_key_values)
+        return answer_ids
+
+def generate_batch(local_dir: str, prompts: list, model: "PreTrainedModel" = None, options: list = None) -> list:
+    """Generate answers for several prompts in one padded batch.
+
+    Each sequence stops at EOS, at its own token budget or at one of its stop sequences, and
+    only the generated tokens are decoded.
+
+    Args:
+        local_dir (str): Directory of the local LLM model.
+        prompts (list): Prompts to generate from.
+        model (PreTrainedModel): Pre-loaded local LLM model.
+        options (list, optional): Generation options of each prompt, see `resolve_generation_options`.
+        Defaults to `GENERATION_KWARGS` for every prompt.
+
+    Returns:
+        list: Generated text of each prompt, without the prompt and cut before any stop sequence.
+    """
+    with tracer.start_as_current_span("generate_batch") as span:
+        span.set_attribute("batch_size", len(prompts))
+        if model is None:
+            model = resources.get_model(local_dir=local_dir)
+        tokenizer = resources.get_tokenizer(local_dir)
+        options = options or [{} for _ in prompts]
+        if len(prompts) == 1:
+            # A lone prompt can skip the prefill of its cached prefix and verify drafts, padded batches cannot
+            answer_ids = generate_with_prefix_cache(model, tokenizer, prompts[0], options=options[0])
+            with timed_stage(CHAT_STAGE_LATENCY, "detokenize"):
+                return [truncate_at_stop(tokenizer.decode(answer_ids, skip_special_tokens=True), options[0].get("stop"))]
+
+        with timed_stage(CHAT_STAGE_LATENCY, "tokenize"):
+            # Decoder-only models continue from the last position, so prompts are padded on the left
+            inputs = tokenizer(prompts, return_tensors="pt", padding=True, padding_side="left").to(model.device)
+        timer = GenerationTimer()
+        output = model.generate(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            streamer=timer,
+            pad_token_id=tokenizer.pad_token_id,
+            **build_generation_kwargs(model, tokenizer, inputs["input_ids"].shape[1], options)
+        )
+        answer_ids = output[:, inputs["input_ids"].shape[1]:]
+        timer.observe(int(inputs["attention_mask"].sum()), int((answer_ids != tokenizer.pad_token_id).sum()))
+        with timed_stage(CHAT_STAGE_LATENCY, "detokenize"):
+            # Sequences that stopped early are padded to the longest one, or run on if the model has no EOS token
+            answers = [
+                tokenizer.decode(ids[:option.get("max_tokens", GENERATION_KWARGS["max_new_tokens"])], skip_special_tokens=True)
+                for ids, option in zip(answer_ids, options)
+            ]
+        return [truncate_at_stop(answer, option.get("stop")) for answer, option in zip(answers, options)]
+
+def stream_generate(local_dir: str, prompt: str, model: "PreTrainedModel" = None, options: dict = None,
+                    cancel: Event = None) -> Iterator[str]:
+    """Generate an answer and yield its text as soon as tokens are decoded.
+
+    Args:
+        local_dir (str): Directory of the local LLM model.
+        prompt (str): Prompt to generate from.
+        model (PreTrainedModel): Pre-loaded local LLM model.
+        options (dict, optional): Generation options of the request, see `resolve_generation_options`.
+        cancel (Event, optional): Stops the generation once set, e.g. when the client disconnected.
+        It is also set when the consumer stops reading.
+
+    Yields:
+        str: Newly generated text, without the prompt, up to any stop sequence.
+
+    Raises:
+        Exception: The error of the generation, once the text generated before it has been yielded.
+    """
+    tokenizer = resources.get_tokenizer(local_dir)
+    if model is None:
+        model = resources.get_model(local_dir=local_dir)
+    from transformers import TextIteratorStreamer
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    
+    # Spans of the generation thread are children of the span of the request
+    parent_context = otel_context.get_current()
+    cancel = cancel or Event()
+    errors = []
+
+    def generate():
+        token = otel_context.attach(parent_context)
+        try:
+            generate_with_prefix_cache(model, tokenizer, prompt, streamer=streamer, options=options, cancel=cancel)
+        except Exception as e:
+            logger.error(f"Streaming generation failed: {e}", exc_info=True)
+            # The consumer raises it once the streamer is drained, rather than taking a partial answer as complete
+            errors.append(e)
+            streamer.end()
+        finally:
+            otel_context.detach(token)
+    
+    thread = Thread(target=generate, daemon=True)
+    thread.start()
+    try:
+        yield from stream_until_stop(streamer, (options or {}).get("stop"))
+    finally:
+        # Tokens nobody reads any more are not generated, e.g. after a stop sequence or a disconnect
+        cancel.set()
+    thread.join()
+    if errors:
+        raise errors[0]
+
 def chat_with_llm(question: str):
     """Ask a question to the QA chain and return the response.
 
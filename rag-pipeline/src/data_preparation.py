@@ -1,10 +1,18 @@
 import os
+import time
 import hashlib
-from langchain_huggingface import HuggingFaceEmbeddings
+import itertools
+from typing import Callable, Iterable
 from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.vectorstores.base import VectorStoreRetriever
-from data_extraction import extract_data
-from utils import get_hardware, get_root_dir, get_doc_dir, trace, tracer
+from data_extraction import iter_chunks, get_chunk_tokenizer_dir, get_chunking_key
+from index_store import IndexStore
+from ann_index import convert_index
+from embedding_cache import EmbeddingCache
+from resources import resources, DEFAULT_EMBEDDING_MODEL_NAME
+from utils import get_vector_store_dir, get_doc_dir, trace, tracer, logger, StageTimer, torch_threads, EMBEDDING_THROUGHPUT, UPLOAD_STAGE_LATENCY
 
 def compute_content_hash(chunks: list, embedding_model_name: str) -> str:
     """Compute a hash based on document content and embedding model name.
@@ -17,84 +25,223 @@ def compute_content_hash(chunks: list, embedding_model_name: str) -> str:
         Hash string.
     """
     content = "".join(chunks) + embedding_model_name
-    return hashlib.md5(content.encode()).hexdigest()[:8]
+    return hashlib.md5(content.encode()).hexdigest()[:16]
 
-def get_vector_store(chunks: list, embeddings: HuggingFaceEmbeddings, cache_dir: str) -> FAISS:
-    """Retrieves a vector store from a list of text chunks using the given embeddings.
+def compute_file_hash(file_path: str, embedding_model_name: str, tokenizer_dir: str = None) -> str:
+    """Compute a hash based on the bytes of a document, the chunking and the embedding model name.
+    
+    Unlike `compute_content_hash`, it is known before the document is parsed.
 
     Args:
-        chunks (list): List of text chunks.
-        embeddings (HuggingFaceEmbeddings): Embeddings object.
-        cache_dir (str): Directory to save the vector store.
+        file_path (str): Path to the document.
+        embedding_model_name (str): Model name.
+        tokenizer_dir (str, optional): Tokenizer the chunks are measured with. Defaults to characters.
+        
+    Returns:
+        Hash string.
+    """
+    file_hash = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(block)
+    file_hash.update(f"{get_chunking_key(tokenizer_dir)}:{embedding_model_name}".encode())
+    return file_hash.hexdigest()[:16]
+
+def build_vector_store(
+    chunks: Iterable, 
+    embeddings: Embeddings, 
+    batch_size: int = None, 
+    threads: int = None,
+    progress: Callable = None,
+    embedding_cache: EmbeddingCache = None
+    ) -> FAISS:
+    """Embed text chunks in fixed-size batches and add each batch to the index as it goes.
+    
+    Only one batch of chunks is held outside of the index at any time, so the chunks can be
+    streamed straight from the PDF extractor.
+
+    Args:
+        chunks (Iterable): Text chunks, as strings or Documents.
+        embeddings (Embeddings): Embeddings object.
+        batch_size (int, optional): Chunks per batch. Defaults to env `EMBEDDING_BATCH_SIZE` or 64.
+        threads (int, optional): Torch intra-op threads of the embedding worker. 
+        Defaults to env `EMBEDDING_THREADS`, or the torch default if unset.
+        progress (Callable, optional): Called with `chunks_embedded` and `chunks_per_second`.
+        embedding_cache (EmbeddingCache, optional): Cache of chunk embeddings. Only chunks missing
+        from it are embedded. Defaults to None.
         
     Returns:
         FAISS object.
     """
-    # Compute content hash
-    embedding_model_name = embeddings.model_name
-    current_hash = compute_content_hash(chunks, embedding_model_name)
+    batch_size = batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+    threads = threads or int(os.getenv("EMBEDDING_THREADS", 0))
     
-    # Check if cached index exists and contains a valid hash
-    hash_file = os.path.join(cache_dir, "content_hash.txt")
-    if os.path.exists(cache_dir) and os.path.exists(hash_file):
-        with open(hash_file, "r") as f:
-            cached_hash = f.read().strip()
-            
-        if current_hash == cached_hash:
-            return FAISS.load_local(
-                folder_path=cache_dir,
-                embeddings=embeddings,
-                allow_dangerous_deserialization=True
+    vector_store = None
+    chunks_embedded = 0
+    start_time = time.time()
+    chunk_iter = iter(chunks)
+    # Chunks are extracted lazily, so extraction time is the time spent waiting for a batch
+    stages = StageTimer(UPLOAD_STAGE_LATENCY)
+    while True:
+        with stages.stage("extract"):
+            batch = list(itertools.islice(chunk_iter, batch_size))
+        if not batch:
+            break
+        texts = [chunk.page_content if isinstance(chunk, Document) else chunk for chunk in batch]
+        metadatas = [chunk.metadata if isinstance(chunk, Document) else {} for chunk in batch]
+        # Only the embedding runs with the threads of the embedding worker
+        with stages.stage("embed"), torch_threads(threads):
+            if embedding_cache is not None:
+                vectors = embedding_cache.embed(texts, embeddings.embed_documents)
+            else:
+                vectors = embeddings.embed_documents(texts)
+        with stages.stage("index"):
+            if vector_store is None:
+                vector_store = FAISS.from_embeddings(zip(texts, vectors), embedding=embeddings, metadatas=metadatas)
+            else:
+                vector_store.add_embeddings(zip(texts, vectors), metadatas=metadatas)
+        
+        chunks_embedded += len(batch)
+        if progress is not None:
+            progress(
+                chunks_embedded=chunks_embedded, 
+                chunks_per_second=chunks_embedded / max(time.time() - start_time, 1e-9)
             )
-        else:
-            import shutil
-            shutil.rmtree(cache_dir)
+    
+    if vector_store is None:
+        raise ValueError("No text could be extracted from the document.")
+    
+    stages.observe()
+    throughput = chunks_embedded / max(time.time() - start_time, 1e-9)
+    EMBEDDING_THROUGHPUT.observe(throughput)
+    logger.info(f"Embedded {chunks_embedded} chunks at {throughput:.1f} chunks/sec")
+    return vector_store
+
+def get_vector_store(
+    chunks: Iterable, 
+    embeddings: Embeddings, 
+    cache_dir: str, 
+    progress: Callable = None,
+    cache_key: str = None,
+    embedding_cache: EmbeddingCache = None,
+    index_type: str = None
+    ) -> FAISS:
+    """Retrieves a vector store from text chunks using the given embeddings.
+    
+    Indexes are cached per content hash in `cache_dir`, so a document that has already
+    been uploaded (by any user) is loaded from disk instead of being embedded again.
+
+    Args:
+        chunks (Iterable): Text chunks, as a list or a lazy iterator of strings or Documents.
+        embeddings (Embeddings): Embeddings object.
+        cache_dir (str): Root directory of the vector store cache.
+        progress (Callable, optional): Called with `chunks_total` and `chunks_embedded` counts.
+        cache_key (str, optional): Precomputed cache key, e.g. from `compute_file_hash`. 
+        Lazy chunks are then only consumed on a cache miss. Defaults to the content hash of `chunks`.
+        embedding_cache (EmbeddingCache, optional): Cache of chunk embeddings, so that only new or 
+        changed chunks are embedded on a miss. Defaults to None.
+        index_type (str, optional): FAISS index type, one of "flat", "hnsw", "ivf" or "ivf-pq".
+        Defaults to `choose_index_type`, based on the number of chunks.
+        
+    Returns:
+        FAISS object.
+    """
+    # Compute content hash
+    if cache_key is None:
+        chunks = list(chunks)
+        cache_key = compute_content_hash(
+            [chunk.page_content if isinstance(chunk, Document) else chunk for chunk in chunks], 
+            embeddings.model_name
+        )
+    
+    # Reuse the cached index if the same content was embedded before
+    store = IndexStore(cache_dir)
+    vector_store = store.get(cache_key, embeddings)
+    if vector_store is not None:
+        logger.info(f"Loaded cached index {cache_key}")
+        if progress is not None:
+            num_chunks = vector_store.index.ntotal
+            progress(chunks_total=num_chunks, chunks_embedded=num_chunks)
+        return vector_store
             
-    # Create a new vector store
-    vector_store = FAISS.from_texts(chunks, embedding=embeddings)    
+    # Create a new vector store, batch by batch
+    vector_store = build_vector_store(chunks, embeddings, progress=progress, embedding_cache=embedding_cache)
+    if progress is not None:
+        progress(chunks_total=vector_store.index.ntotal)
     
-    # Save the new index and hash
-    os.makedirs(cache_dir, exist_ok=True)
-    vector_store.save_local(cache_dir)
-    with open(hash_file, "w") as f:
-        f.write(current_hash)    
+    # Switch to an approximate index for large documents
+    vector_store.index, index_params = convert_index(vector_store.index, index_type)
+    
+    # Save the new index and its parameters under its hash
+    store.put(cache_key, vector_store, index_params=index_params)
         
     return vector_store
 
-def prepare_retriever(
-    embedding_model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
-    file_path:str = None
-    ) -> VectorStoreRetriever:
-    """Create a vector store retriever with the given embedding model.
+def prepare_vector_store(
+    embedding_model_name: str = DEFAULT_EMBEDDING_MODEL_NAME,
+    file_path:str = None,
+    progress: Callable = None
+    ) -> FAISS:
+    """Parse, embed and index a PDF document, or load its cached index.
+
+    The index stays exact whatever the document's size. Its vectors are copied into the user's
+    corpus, which switches to an approximate index as it grows, so an HNSW graph would only be
+    thrown away and product quantization would lose recall in the corpus.
 
     Args:
         embedding_model_name (str, optional): Embedding model that maps text to vectors.
-        Defaults to "sentence-transformers/all-MiniLM-L6-v2" (lightweight model).
+        Defaults to env `EMBEDDING_MODEL` or "sentence-transformers/all-MiniLM-L6-v2" (lightweight model).
         
         file_path (str, optional): File path to the PDF file. Defaults to None.
+        
+        progress (Callable, optional): Progress callback of the ingestion. Defaults to None.
 
     Returns:
-        VectorStoreRetriever: A retriever object.
+        FAISS: Index of the document.
     """
-    with tracer.start_as_current_span("prepare_retriever") as prepare_retriever:
-        # Initialize embeddings
-        hardware = get_hardware()
-        with tracer.start_as_current_span("embeddings", links=[trace.Link(prepare_retriever.get_span_context())]):
-            embeddings = HuggingFaceEmbeddings(
-                model_name=embedding_model_name,
-                model_kwargs={"device": hardware}
-                )
+    with tracer.start_as_current_span("prepare_vector_store") as prepare_vector_store:
+        # Get the shared embeddings
+        with tracer.start_as_current_span("embeddings", links=[trace.Link(prepare_vector_store.get_span_context())]):
+            embeddings = resources.get_embeddings(embedding_model_name)
         
-        # Create text chunks
-        with tracer.start_as_current_span("chunks", links=[trace.Link(prepare_retriever.get_span_context())]):
-            chunks = extract_data(get_doc_dir() if file_path is None else file_path)
+        # Stream text chunks straight into the embedding stage
+        file_path = get_doc_dir() if file_path is None else file_path
+        tokenizer_dir = get_chunk_tokenizer_dir()
+        with tracer.start_as_current_span("chunks", links=[trace.Link(prepare_vector_store.get_span_context())]):
+            chunks = iter_chunks(file_path, progress=progress, tokenizer_dir=tokenizer_dir)
             
-        with tracer.start_as_current_span("vector_store", links=[trace.Link(prepare_retriever.get_span_context())]):
+        with tracer.start_as_current_span("vector_store", links=[trace.Link(prepare_vector_store.get_span_context())]):
             vector_store = get_vector_store(
                 chunks=chunks,
                 embeddings=embeddings,
-                cache_dir=get_root_dir() + "rag-pipeline/vector_store"
+                cache_dir=get_vector_store_dir(),
+                progress=progress,
+                cache_key=compute_file_hash(file_path, embedding_model_name, tokenizer_dir),
+                embedding_cache=resources.get_embedding_cache(embedding_model_name),
+                index_type="flat"
             )
+        return vector_store
+
+def prepare_retriever(
+    embedding_model_name: str = DEFAULT_EMBEDDING_MODEL_NAME,
+    file_path:str = None,
+    progress: Callable = None
+    ) -> VectorStoreRetriever:
+    """Create a vector store retriever with the given embedding model.
+
+    Args:
+        embedding_model_name (str, optional): Embedding model that maps text to vectors.
+        Defaults to env `EMBEDDING_MODEL` or "sentence-transformers/all-MiniLM-L6-v2" (lightweight model).
+        
+        file_path (str, optional): File path to the PDF file. Defaults to None.
+        
+        progress (Callable, optional): Progress callback of the ingestion. Defaults to None.
+
+    Returns:
+        VectorStoreRetriever: A retriever object.
+    """
+    with tracer.start_as_current_span("prepare_retriever") as prepare_retriever:
+        vector_store = prepare_vector_store(embedding_model_name, file_path=file_path, progress=progress)
         
         # Create a retriever
         with tracer.start_as_current_span("retriever", links=[trace.Link(prepare_retriever.get_span_context())]):
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import uuid
+import threading
+from utils import logger
+
+class DocumentRegistry:
+    def __init__(self, path: str):
+        """Registry of the documents uploaded by each user.
+
+        The registry is kept in memory and persisted as an append-only JSON lines log,
+        which is replayed on startup.
+
+        Args:
+            path (str): Path of the JSON lines log.
+        """
+        self.path = path
+        self._documents = {}  # user_id -> {doc_id: document}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # Skip a line left half-written by an interrupted process
+                    logger.warning(f"Skipping corrupted line in {self.path}")
+                    continue
+                self._apply(event)
+
+    def _apply(self, event: dict):
+        user_documents = self._documents.setdefault(event["user_id"], {})
+        if event["op"] == "add":
+            user_documents[event["document"]["doc_id"]] = event["document"]
+        elif event["op"] == "remove":
+            user_documents.pop(event["doc_id"], None)
+
+    def _append(self, event: dict):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(event) + "\n")
+        self._apply(event)
+
+    def add(self, user_id: str, file_path: str, content_hash: str = None, file_name: str = None) -> dict:
+        """Register an uploaded document. A file uploaded again under the same name replaces its entry.
+
+        Args:
+            user_id (str): User ID.
+            file_path (str): Path of the uploaded file.
+            content_hash (str, optional): Hash of the document index, e.g. from `compute_file_hash`.
+            file_name (str, optional): Name the file was uploaded under. Defaults to the name of `file_path`.
+
+        Returns:
+            dict: The document entry, with `doc_id`, `file_name`, `file_path`, `content_hash` and `uploaded_at`.
+        """
+        with self._lock:
+            file_name = file_name or os.path.basename(file_path)
+            for document in list(self._documents.get(user_id, {}).values()):
+                if document["file_name"] == file_name:
+                    self._append({"op": "remove", "user_id": user_id, "doc_id": document["doc_id"]})
+            document = {
+                "doc_id": uuid.uuid4().hex[:12],
+                "file_name": file_name,
+                "file_path": file_path,
+                "content_hash": content_hash,
+                "uploaded_at": time.time(),
+            }
+            self._append({"op": "add", "user_id": user_id, "document": document})
+            return document
+
+    def remove(self, user_id: str, doc_id: str) -> dict:
+        """Unregister a document.
+
+        Returns:
+            dict: The removed document entry, or None if it does not exist.
+        """
+        with self._lock:
+            document = self._documents.get(user_id, {}).get(doc_id)
+            if document is not None:
+                self._append({"op": "remove", "user_id": user_id, "doc_id": doc_id})
+            return document
+
+    def get(self, user_id: str, doc_id: str) -> dict:
+        """Get a document entry, or None if it does not exist."""
+        with self._lock:
+            return self._documents.get(user_id, {}).get(doc_id)
+
+    def list(self, user_id: str) -> list:
+        """Get the documents of a user, oldest first."""
+        with self._lock:
+            return sorted(self._documents.get(user_id, {}).values(), key=lambda document: document["uploaded_at"])
+
+    def latest(self, user_id: str) -> dict:
+        """Get the most recently uploaded document of a user, or None."""
+        documents = self.list(user_id)
+        return documents[-1] if documents else None
+
+    def users(self) -> list:
+        """Get the users that have at least one document."""
+        with self._lock:
+            return [user_id for user_id, documents in self._documents.items() if documents]
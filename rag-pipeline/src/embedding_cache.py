@@ -0,0 +1,146 @@
+import os
+import re
+import json
+import fcntl
+import hashlib
+import threading
+import numpy as np
+from typing import Callable
+from utils import logger, EMBEDDING_CACHE_HITS, EMBEDDING_CACHE_MISSES
+
+KEY_SIZE = 16  # bytes of a md5 digest
+
+class EmbeddingCache:
+    def __init__(self, cache_dir: str, model_name: str):
+        """Persistent cache of chunk embeddings, keyed by (embedding model name, chunk text hash).
+
+        Vectors of one model are appended to a raw float32 file that is read through a memory map,
+        and the md5 digest of each chunk text is appended to a key file at the same row.
+
+        Args:
+            cache_dir (str): Root directory of the embedding caches.
+            model_name (str): Embedding model name. Each model gets its own sub-directory.
+        """
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, re.sub(r"[^\w.-]", "_", model_name))
+        self._vectors_path = os.path.join(self.dir, "vectors.f32")
+        self._keys_path = os.path.join(self.dir, "keys.bin")
+        self._meta_path = os.path.join(self.dir, "meta.json")
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._num_rows = 0
+        self._vectors = None
+        self.dim = None
+        os.makedirs(self.dir, exist_ok=True)
+        self._load_new_keys()
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+    @staticmethod
+    def _key(text: str) -> bytes:
+        return hashlib.md5(text.encode()).digest()
+
+    def _load_new_keys(self):
+        """Index the keys appended since the last load, possibly by another process."""
+        if self.dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path, "r") as f:
+                self.dim = json.load(f)["dim"]
+        if self.dim is None or not os.path.exists(self._keys_path):
+            return
+        vector_rows = os.path.getsize(self._vectors_path) // (4 * self.dim) if os.path.exists(self._vectors_path) else 0
+        key_rows = os.path.getsize(self._keys_path) // KEY_SIZE
+        # A row is only valid once both its vector and its key are written
+        num_rows = min(vector_rows, key_rows)
+        if num_rows <= self._num_rows:
+            return
+        with open(self._keys_path, "rb") as f:
+            f.seek(self._num_rows * KEY_SIZE)
+            data = f.read((num_rows - self._num_rows) * KEY_SIZE)
+        for i in range(num_rows - self._num_rows):
+            self._rows[data[i * KEY_SIZE:(i + 1) * KEY_SIZE]] = self._num_rows + i
+        self._num_rows = num_rows
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode="r", shape=(num_rows, self.dim))
+
+    def _truncate_partial_rows(self):
+        """Drop a row left half-written by an interrupted writer, so vectors and keys stay aligned."""
+        vector_rows = os.path.getsize(self._vectors_path) // (4 * self.dim) if os.path.exists(self._vectors_path) else 0
+        key_rows = os.path.getsize(self._keys_path) // KEY_SIZE
+        num_rows = min(vector_rows, key_rows)
+        if os.path.exists(self._vectors_path) and os.path.getsize(self._vectors_path) != num_rows * 4 * self.dim:
+            os.truncate(self._vectors_path, num_rows * 4 * self.dim)
+        if os.path.getsize(self._keys_path) != num_rows * KEY_SIZE:
+            os.truncate(self._keys_path, num_rows * KEY_SIZE)
+
+    def get(self, texts: list) -> list:
+        """Look up the cached vectors of several chunks.
+
+        Args:
+            texts (list): Chunk texts.
+
+        Returns:
+            list: One float32 vector per text, or None for texts that are not cached.
+        """
+        keys = [self._key(text) for text in texts]
+        with self._lock:
+            if any(key not in self._rows for key in keys):
+                self._load_new_keys()
+            rows = [self._rows.get(key) for key in keys]
+            vectors = [None if row is None else np.array(self._vectors[row]) for row in rows]
+
+        hits = sum(vector is not None for vector in vectors)
+        EMBEDDING_CACHE_HITS.inc(hits)
+        EMBEDDING_CACHE_MISSES.inc(len(texts) - hits)
+        return vectors
+
+    def put(self, texts: list, vectors: list):
+        """Append the vectors of several chunks to the cache.
+
+        Args:
+            texts (list): Chunk texts.
+            vectors (list): Their embedding vectors.
+        """
+        if not texts:
+            return
+        array = np.asarray(vectors, dtype=np.float32)
+        with self._lock, open(self._keys_path, "ab") as keys_file:
+            fcntl.flock(keys_file, fcntl.LOCK_EX)
+            try:
+                if self.dim is None:
+                    self.dim = array.shape[1]
+                    with open(self._meta_path, "w") as f:
+                        json.dump({"model_name": self.model_name, "dim": self.dim}, f)
+                elif array.shape[1] != self.dim:
+                    raise ValueError(f"Expected vectors of size {self.dim}, got {array.shape[1]}")
+                # Catch up with other writers so that new rows are appended after theirs
+                self._truncate_partial_rows()
+                self._load_new_keys()
+                with open(self._vectors_path, "ab") as vectors_file:
+                    vectors_file.write(array.tobytes())
+                keys_file.write(b"".join(self._key(text) for text in texts))
+                keys_file.flush()
+                self._load_new_keys()
+            finally:
+                fcntl.flock(keys_file, fcntl.LOCK_UN)
+
+    def embed(self, texts: list, embed_fn: Callable[[list], list]) -> list:
+        """Embed chunks, only computing the vectors of chunks missing from the cache.
+
+        Args:
+            texts (list): Chunk texts.
+            embed_fn (Callable[[list], list]): Embeds a list of texts, e.g. `embeddings.embed_documents`.
+
+        Returns:
+            list: One vector per text.
+        """
+        vectors = self.get(texts)
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            # Embed each distinct text once
+            missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+            new_vectors = dict(zip(missing_texts, embed_fn(missing_texts)))
+            for i in missing:
+                vectors[i] = np.asarray(new_vectors[texts[i]], dtype=np.float32)
+            self.put(missing_texts, [new_vectors[text] for text in missing_texts])
+            logger.info(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+        return [vector.tolist() for vector in vectors]
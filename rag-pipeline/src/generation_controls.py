@@ -0,0 +1,207 @@
+import os
+import threading
+from typing import Iterator, List
+from resources import GENERATION_KWARGS
+
+def get_generation_limits() -> dict:
+    """Server-side caps of the generation options of a chat request.
+
+    Returns:
+        dict: `max_tokens` (env `CHAT_MAX_TOKENS_LIMIT`, defaults to the default answer length),
+        `stop_sequences` (env `CHAT_MAX_STOP_SEQUENCES` or 4), `stop_length` in characters
+        (env `CHAT_MAX_STOP_LENGTH` or 32) and `temperature` (env `CHAT_MAX_TEMPERATURE` or 2.0).
+    """
+    return {
+        "max_tokens": int(os.getenv("CHAT_MAX_TOKENS_LIMIT", GENERATION_KWARGS["max_new_tokens"])),
+        "stop_sequences": int(os.getenv("CHAT_MAX_STOP_SEQUENCES", 4)),
+        "stop_length": int(os.getenv("CHAT_MAX_STOP_LENGTH", 32)),
+        "temperature": float(os.getenv("CHAT_MAX_TEMPERATURE", 2.0)),
+    }
+
+def resolve_generation_options(max_tokens: int = None, stop: List[str] = None, temperature: float = None) -> dict:
+    """Check the generation options of a request against the server caps.
+
+    `max_tokens` and `temperature` are clamped to their caps, stop sequences beyond the caps are
+    rejected since dropping one would change where the answer ends.
+
+    Args:
+        max_tokens (int, optional): Maximum tokens of the answer. Defaults to `GENERATION_KWARGS`.
+        stop (List[str], optional): Strings ending the answer, which is cut before them.
+        temperature (float, optional): Sampling temperature, 0 for greedy decoding. Defaults to the model's.
+
+    Returns:
+        dict: Only the options that were given, ready for `generate_batch`. Empty means the defaults.
+
+    Raises:
+        ValueError: If an option is out of range or the stop sequences exceed the caps.
+    """
+    limits = get_generation_limits()
+    options = {}
+    if max_tokens is not None:
+        if max_tokens < 1:
+            raise ValueError("max_tokens must be at least 1")
+        options["max_tokens"] = min(max_tokens, limits["max_tokens"])
+    if stop:
+        if len(stop) > limits["stop_sequences"]:
+            raise ValueError(f"At most {limits['stop_sequences']} stop sequences are allowed")
+        if any(not sequence or len(sequence) > limits["stop_length"] for sequence in stop):
+            raise ValueError(f"Stop sequences must have 1 to {limits['stop_length']} characters")
+        options["stop"] = list(stop)
+    if temperature is not None:
+        if temperature < 0:
+            raise ValueError("temperature must not be negative")
+        options["temperature"] = min(temperature, limits["temperature"])
+    return options
+
+def truncate_at_stop(text: str, stop: List[str] = None) -> str:
+    """Cut text before the first occurrence of any stop sequence."""
+    end = min((index for index in (text.find(sequence) for sequence in stop or []) if index >= 0), default=len(text))
+    return text[:end]
+
+def stream_until_stop(chunks: Iterator[str], stop: List[str] = None) -> Iterator[str]:
+    """Pass streamed text on until a stop sequence, which may span several chunks, appears.
+
+    The last characters that could start a stop sequence are held back until the next chunk
+    shows whether they do.
+
+    Args:
+        chunks (Iterator[str]): Streamed text, e.g. from a `TextIteratorStreamer`.
+        stop (List[str], optional): Strings ending the text.
+
+    Yields:
+        str: Text before the first stop sequence.
+    """
+    if not stop:
+        yield from chunks
+        return
+    holdback = max(len(sequence) for sequence in stop) - 1
+    pending = ""
+    for chunk in chunks:
+        pending += chunk
+        text = truncate_at_stop(pending, stop)
+        if len(text) < len(pending):
+            if text:
+                yield text
+            return
+        if len(pending) > holdback:
+            yield pending[:len(pending) - holdback]
+            pending = pending[len(pending) - holdback:]
+    if pending:
+        yield pending
+
+class StopCriteria:
+    def __init__(self, tokenizer, prompt_length: int, max_tokens: list, stops: list):
+        """Stop each sequence of a batch at its own token budget or stop sequence.
+
+        `generate` only calls its stopping criteria, so this does not subclass
+        `transformers.StoppingCriteria`, which would import transformers with this module.
+
+        Args:
+            tokenizer: Tokenizer of the local LLM, decoding the end of each sequence.
+            prompt_length (int): Length of the padded prompts, where the answers start.
+            max_tokens (list): Maximum tokens of the answer of each sequence.
+            stops (list): Stop sequences of each sequence, or None.
+        """
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.max_tokens = max_tokens
+        self.stops = stops
+        # A character may take several byte-level tokens, so look back further than the longest stop sequence
+        self.lookback = [4 * max(map(len, stop)) if stop else 0 for stop in stops]
+
+    def __call__(self, input_ids, scores=None, **kwargs):
+        import torch
+        generated = input_ids.shape[1] - self.prompt_length
+        is_done = []
+        for row, (max_tokens, stop, lookback) in enumerate(zip(self.max_tokens, self.stops, self.lookback)):
+            done = generated >= max_tokens
+            if not done and stop and generated > 0:
+                tail = self.tokenizer.decode(input_ids[row, -min(generated, lookback):], skip_special_tokens=True)
+                done = any(sequence in tail for sequence in stop)
+            is_done.append(done)
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+class CancelCriteria:
+    def __init__(self, cancel: threading.Event, criteria=None):
+        """Stop every sequence of a batch once `cancel` is set, e.g. when the client of a streamed answer left.
+
+        Args:
+            cancel (threading.Event): Set to stop the generation at the next token.
+            criteria (Callable, optional): Stopping criterion applied until then, e.g. a `StopCriteria`.
+        """
+        self.cancel = cancel
+        self.criteria = criteria
+
+    def __call__(self, input_ids, scores=None, **kwargs):
+        import torch
+        if self.cancel.is_set():
+            return torch.ones(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if self.criteria is not None:
+            return self.criteria(input_ids, scores, **kwargs)
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+class TemperatureProcessor:
+    def __init__(self, temperatures: list):
+        """Sample each sequence of a batch at its own temperature, 0 picking the most likely token.
+
+        Like `StopCriteria`, it is only called by `generate` and needs no transformers base class.
+
+        Args:
+            temperatures (list): Temperature of each sequence.
+        """
+        self.temperatures = temperatures
+
+    def __call__(self, input_ids, scores):
+        import torch
+        scores = scores.clone()
+        for row, temperature in enumerate(self.temperatures):
+            if temperature > 0:
+                scores[row] = scores[row] / temperature
+            else:
+                # Sampling from a single token is greedy decoding
+                best = scores[row].argmax()
+                scores[row] = torch.full_like(scores[row], -float("inf"))
+                scores[row, best] = 0.0
+        return scores
+
+def get_temperatures(model, options: list) -> list:
+    """Resolve the temperature of each request, 0 for greedy decoding.
+
+    Requests without a temperature keep the sampling settings of the model's generation config.
+    """
+    config = model.generation_config
+    default = (config.temperature or 1.0) if config.do_sample else 0.0
+    return [option.get("temperature", default) for option in options]
+
+def build_generation_kwargs(model, tokenizer, prompt_length: int, options: list, cancel: threading.Event = None) -> dict:
+    """Build the `generate` arguments of a batch from the options of its requests.
+
+    Args:
+        model: Local LLM model.
+        tokenizer: Tokenizer of the local LLM.
+        prompt_length (int): Length of the padded prompts.
+        options (list): Options of each request, see `resolve_generation_options`.
+        cancel (threading.Event, optional): Stops the generation once set.
+
+    Returns:
+        dict: `GENERATION_KWARGS` with the budget of the longest request, stopping criteria and,
+        if a request set its temperature, the sampling settings of every request.
+    """
+    max_tokens = [option.get("max_tokens", GENERATION_KWARGS["max_new_tokens"]) for option in options]
+    kwargs = {**GENERATION_KWARGS, "max_new_tokens": max(max_tokens)}
+    stops = [option.get("stop") for option in options]
+    criteria = None
+    if any(stops) or len(set(max_tokens)) > 1:
+        criteria = StopCriteria(tokenizer, prompt_length, max_tokens, stops)
+    if cancel is not None:
+        criteria = CancelCriteria(cancel, criteria)
+    if criteria is not None:
+        kwargs["stopping_criteria"] = [criteria]
+    if any("temperature" in option for option in options):
+        temperatures = get_temperatures(model, options)
+        if any(temperatures):
+            # The model's own temperature would apply on top of the per-request ones
+            kwargs.update(do_sample=True, temperature=1.0, logits_processor=[TemperatureProcessor(temperatures)])
+        else:
+            kwargs.update(do_sample=False, temperature=None, top_p=None, top_k=None)
+    return kwargs
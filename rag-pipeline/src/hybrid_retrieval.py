@@ -0,0 +1,103 @@
+import os
+from typing import Any, List
+from langchain_community.vectorstores import FAISS
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from corpus import ReadOnlyCorpusVectorStore
+from resources import resources
+from utils import RETRIEVAL_STAGE_LATENCY, timed_stage
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """Fuse rankings by summing 1 / (k + rank) over the rankings of each item.
+
+    Only ranks are used, so dense distances and BM25 scores, which are on different scales,
+    need no normalization.
+
+    Args:
+        rankings (list): Rankings of items, best first.
+        k (int, optional): Damping of the top ranks. Defaults to 60.
+
+    Returns:
+        list: (item, fused score) pairs, best first. Ties keep the order in which items were first ranked.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+def retrieval_stage(stage: str):
+    """Trace a retrieval stage and record its latency."""
+    return timed_stage(RETRIEVAL_STAGE_LATENCY, stage, f"retrieve_{stage}")
+
+class HybridRetriever(BaseRetriever):
+    """Retriever fusing dense and BM25 search over a memory-mapped corpus.
+
+    Both searches return `fetch_k` chunk rows, fused with reciprocal rank fusion. Dense search
+    finds paraphrases, BM25 finds exact identifiers and section numbers that embeddings blur.
+    An optional cross-encoder then reorders the best `rerank_k` fused chunks.
+    """
+    vectorstore: ReadOnlyCorpusVectorStore
+    k: int = 8
+    fetch_k: int = 20
+    rrf_k: int = 60
+    reranker: Any = None
+    rerank_k: int = 10
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun, embedding: list = None, filter=None
+    ) -> List[Document]:
+        """Retrieve the `k` most relevant chunks.
+
+        Args:
+            query (str): Question to retrieve chunks for.
+            embedding (list, optional): Embedding of the question, if already computed.
+            filter (optional): Document filter, e.g. `{"doc_id": ["abc"]}`. Defaults to every document.
+        """
+        with retrieval_stage("dense"):
+            if embedding is None:
+                embedding = self.vectorstore.embeddings.embed_query(query)
+            dense_rows = [row for row, _ in self.vectorstore.search_rows(embedding, self.fetch_k, filter)]
+        with retrieval_stage("bm25"):
+            keyword_rows = [row for row, _ in self.vectorstore.search_keywords(query, self.fetch_k, filter)]
+        with retrieval_stage("fusion"):
+            fused = reciprocal_rank_fusion([dense_rows, keyword_rows], self.rrf_k)
+            num_candidates = max(self.k, self.rerank_k) if self.reranker is not None else self.k
+            docs = [self.vectorstore.docstore.search(row) for row, _ in fused[:num_candidates]]
+        if self.reranker is not None and len(docs) > 1:
+            with retrieval_stage("rerank"):
+                scores = self.reranker.predict([(query, doc.page_content) for doc in docs])
+                order = sorted(range(len(docs)), key=lambda i: -float(scores[i]))
+                docs = [docs[i] for i in order]
+        return docs[:self.k]
+
+def build_retriever(vector_store: FAISS, k: int = None) -> BaseRetriever:
+    """Build the retriever of a user's corpus.
+
+    Memory-mapped corpora saved with a BM25 index get a `HybridRetriever`, unless env
+    `RETRIEVAL_MODE` is "dense". Other corpora get a dense similarity retriever.
+
+    Args:
+        vector_store (FAISS): Corpus of the user.
+        k (int, optional): Number of chunks to retrieve, which `pack_context` then fits in the
+        prompt. Defaults to env `RETRIEVAL_K` or 8.
+
+    Returns:
+        BaseRetriever: The retriever.
+    """
+    k = k or int(os.getenv("RETRIEVAL_K", 8))
+    hybrid = os.getenv("RETRIEVAL_MODE", "hybrid").lower() == "hybrid"
+    if not hybrid or not isinstance(vector_store, ReadOnlyCorpusVectorStore) or vector_store.bm25 is None:
+        return vector_store.as_retriever(search_type="similarity", search_kwargs={"k": k})
+
+    # Reranking is off unless a cross-encoder is configured, e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    reranker_model_name = os.getenv("RERANKER_MODEL")
+    return HybridRetriever(
+        vectorstore=vector_store,
+        k=k,
+        fetch_k=int(os.getenv("RETRIEVAL_FETCH_K", 20)),
+        rrf_k=int(os.getenv("RETRIEVAL_RRF_K", 60)),
+        reranker=resources.get_reranker(reranker_model_name) if reranker_model_name else None,
+        rerank_k=int(os.getenv("RERANK_CANDIDATES", 10))
+    )
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import shutil
+import threading
+from contextlib import contextmanager
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+from ann_index import PARAMS_FILE, apply_search_params
+from utils import logger
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".lock"
+TMP_PREFIX = ".tmp-"
+
+class IndexStore:
+    def __init__(self, root_dir: str, max_entries: int = None, max_bytes: int = None):
+        """Content-addressed store of FAISS indexes.
+
+        Every index lives in its own `<root_dir>/<content_hash>` directory, so indexes of
+        different documents never overwrite each other. A `manifest.json` keeps the size
+        and last access time of each entry and is used for LRU eviction.
+
+        Args:
+            root_dir (str): Directory holding one sub-directory per index.
+            max_entries (int, optional): Maximum number of cached indexes.
+            Defaults to env `VECTOR_STORE_MAX_ENTRIES` or 64.
+            max_bytes (int, optional): Maximum total size of cached indexes in bytes.
+            Defaults to env `VECTOR_STORE_MAX_BYTES` or 2 GiB.
+        """
+        self.root_dir = root_dir
+        self.max_entries = max_entries or int(os.getenv("VECTOR_STORE_MAX_ENTRIES", 64))
+        self.max_bytes = max_bytes or int(os.getenv("VECTOR_STORE_MAX_BYTES", 2 * 1024 ** 3))
+        self._thread_lock = threading.Lock()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """Serialize manifest updates across threads and processes."""
+        with self._thread_lock:
+            with open(os.path.join(self.root_dir, LOCK_FILE), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_manifest(self) -> dict:
+        path = os.path.join(self.root_dir, MANIFEST_FILE)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Corrupted index manifest in {self.root_dir}, starting from scratch.")
+            return {}
+
+    def _write_manifest(self, manifest: dict):
+        path = os.path.join(self.root_dir, MANIFEST_FILE)
+        tmp_path = f"{path}.{uuid.uuid4().hex}"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, path)
+
+    def _remove_dir(self, path: str):
+        """Atomically detach a directory before deleting it, so readers never see half of it."""
+        trash = os.path.join(self.root_dir, TMP_PREFIX + uuid.uuid4().hex)
+        try:
+            os.rename(path, trash)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def entry_dir(self, key: str) -> str:
+        return os.path.join(self.root_dir, key)
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.entry_dir(key), "index.faiss"))
+
+    def touch(self, key: str):
+        """Mark an entry as recently used."""
+        with self._locked():
+            manifest = self._read_manifest()
+            if key in manifest:
+                manifest[key]["last_access"] = time.time()
+                self._write_manifest(manifest)
+
+    def get(self, key: str, embeddings: Embeddings) -> FAISS:
+        """Load a cached index.
+
+        Args:
+            key (str): Content hash of the index.
+            embeddings (Embeddings): Embeddings object used by the index.
+
+        Returns:
+            FAISS object, or None if the index is not cached.
+        """
+        if not self.contains(key):
+            return None
+        try:
+            vector_store = FAISS.load_local(
+                folder_path=self.entry_dir(key),
+                embeddings=embeddings,
+                allow_dangerous_deserialization=True
+            )
+            params_path = os.path.join(self.entry_dir(key), PARAMS_FILE)
+            if os.path.exists(params_path):
+                with open(params_path, "r") as f:
+                    apply_search_params(vector_store.index, json.load(f))
+        except (OSError, RuntimeError, ValueError) as e:
+            # The entry may have been evicted by another process while loading
+            logger.warning(f"Failed to load cached index {key}: {e}")
+            return None
+        self.touch(key)
+        return vector_store
+
+    def get_params(self, key: str) -> dict:
+        """Get the build and search parameters of a cached index, or None if they were not saved."""
+        try:
+            with open(os.path.join(self.entry_dir(key), PARAMS_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, vector_store: FAISS, index_params: dict = None):
+        """Save an index under its content hash.
+
+        The index is written to a temporary directory first and then renamed into place,
+        so concurrent writers of the same document cannot corrupt each other.
+
+        Args:
+            key (str): Content hash of the index.
+            vector_store (FAISS): Index to save.
+            index_params (dict, optional): Build and search parameters of the index, from `convert_index`.
+        """
+        tmp_dir = os.path.join(self.root_dir, TMP_PREFIX + uuid.uuid4().hex)
+        vector_store.save_local(tmp_dir)
+        if index_params is not None:
+            with open(os.path.join(tmp_dir, PARAMS_FILE), "w") as f:
+                json.dump(index_params, f)
+        size = sum(entry.stat().st_size for entry in os.scandir(tmp_dir))
+
+        with self._locked():
+            try:
+                os.rename(tmp_dir, self.entry_dir(key))
+            except OSError:
+                # Another writer stored the same content first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+            manifest = self._read_manifest()
+            now = time.time()
+            manifest[key] = {"size": size, "created": now, "last_access": now}
+            self._evict(manifest, keep=key)
+            self._write_manifest(manifest)
+
+    def _evict(self, manifest: dict, keep: str = None):
+        """Remove least recently used entries until the store is within its limits."""
+        lru = sorted(manifest, key=lambda k: manifest[k]["last_access"])
+        total_bytes = sum(entry["size"] for entry in manifest.values())
+        for key in lru:
+            if len(manifest) <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logger.info(f"Evicting cached index {key}")
+            total_bytes -= manifest.pop(key)["size"]
+            self._remove_dir(self.entry_dir(key))
@@ -0,0 +1,136 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from utils import logger
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+class IngestionJob:
+    def __init__(self, user_id: str, file_path: str):
+        """Progress of a background PDF ingestion.
+
+        Args:
+            user_id (str): User who uploaded the document.
+            file_path (str): Path of the uploaded PDF file.
+        """
+        self.job_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.file_path = file_path
+        self.status = QUEUED
+        self.error = None
+        self.pages_total = 0
+        self.pages_parsed = 0
+        self.chunks_total = 0
+        self.chunks_embedded = 0
+        self.chunks_per_second = 0.0
+        self.created_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def update(self, **progress):
+        """Update progress counters, e.g. `job.update(pages_parsed=3)`."""
+        with self._lock:
+            for key, value in progress.items():
+                setattr(self, key, value)
+
+    def finish(self, error: Exception = None):
+        with self._lock:
+            self.status = FAILED if error else DONE
+            self.error = str(error) if error else None
+            self.finished_at = time.time()
+        self._done.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until the job has finished. Returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            return {
+                "job_id": self.job_id,
+                "user_id": self.user_id,
+                "file_path": str(self.file_path),
+                "status": self.status,
+                "error": self.error,
+                "pages_total": self.pages_total,
+                "pages_parsed": self.pages_parsed,
+                "chunks_total": self.chunks_total,
+                "chunks_embedded": self.chunks_embedded,
+                "chunks_per_second": self.chunks_per_second,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+            }
+
+class IngestionManager:
+    def __init__(self, max_workers: int = None, max_jobs: int = 1000):
+        """Run PDF ingestion jobs on a bounded worker pool, off the event loop.
+
+        Args:
+            max_workers (int, optional): Number of concurrent ingestion jobs.
+            Defaults to env `INGESTION_WORKERS` or 2.
+            max_jobs (int, optional): Number of jobs kept for status queries. Defaults to 1000.
+        """
+        self.max_workers = max_workers or int(os.getenv("INGESTION_WORKERS", 2))
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ingestion")
+        self._jobs = OrderedDict()
+        self._latest_jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, user_id: str, file_path: str, ingest_fn: Callable, on_done: Callable = None) -> IngestionJob:
+        """Queue an ingestion job.
+
+        Args:
+            user_id (str): User who uploaded the document.
+            file_path (str): Path of the uploaded PDF file.
+            ingest_fn (Callable): Called as `ingest_fn(file_path, progress=job.update)`.
+            on_done (Callable, optional): Called as `on_done(job, result)` once the job succeeded,
+            unless a newer job of the same user was submitted meanwhile.
+
+        Returns:
+            IngestionJob: The queued job.
+        """
+        job = IngestionJob(user_id, file_path)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._latest_jobs[user_id] = job.job_id
+            # Forget the oldest finished jobs
+            for job_id in list(self._jobs):
+                if len(self._jobs) <= self.max_jobs:
+                    break
+                if self._jobs[job_id].finished_at is not None:
+                    del self._jobs[job_id]
+        self._executor.submit(self._run, job, ingest_fn, on_done)
+        return job
+
+    def _run(self, job: IngestionJob, ingest_fn: Callable, on_done: Callable):
+        job.update(status=RUNNING)
+        try:
+            result = ingest_fn(job.file_path, progress=job.update)
+            if on_done is not None and self.is_latest(job):
+                on_done(job, result)
+        except Exception as e:
+            logger.error(f"❌ Ingestion job {job.job_id} failed: {e}", exc_info=True)
+            job.finish(error=e)
+            return
+        job.finish()
+        logger.info(f"Ingestion job {job.job_id} done for user {job.user_id}")
+
+    def get(self, job_id: str) -> IngestionJob:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def is_latest(self, job: IngestionJob) -> bool:
+        with self._lock:
+            return self._latest_jobs.get(job.user_id) == job.job_id
+
+    def is_pending(self, user_id: str) -> bool:
+        """Whether the latest upload of a user is still being processed."""
+        with self._lock:
+            job = self._jobs.get(self._latest_jobs.get(user_id))
+        return job is not None and job.finished_at is None
@@ -1,45 +1,151 @@
 import os
 import shutil
 import time
+import uuid
 import threading
+from contextlib import asynccontextmanager
+from functools import partial
 from pathlib import Path
+from typing import Iterator, List, Optional
 from fastapi import FastAPI, UploadFile, File, HTTPException, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
-from data_pipeline import setup_pipeline
-from model_setup import load_model
-from utils import (get_model_dir, trace, tracer, logger, 
-                   MODEL_LOAD_TIME, REQUEST_COUNT, LATENCY, 
+from batching import BatchScheduler, QueueFullError
+from ingestion import IngestionManager
+from pipeline_cache import PipelineCache
+from document_registry import DocumentRegistry
+from answer_cache import AnswerCache
+from corpus import CorpusStore, CorpusVectorStore, ReadOnlyCorpusVectorStore
+from hybrid_retrieval import build_retriever
+from data_extraction import get_chunk_tokenizer_dir, start_extraction_pool
+from data_preparation import compute_file_hash, compute_content_hash, prepare_vector_store
+from data_pipeline import setup_pipeline, build_prompt, generate_batch, stream_generate
+from generation_controls import resolve_generation_options
+from model_setup import load_model, PRECISIONS
+from model_server import ModelServer, ModelClient
+from resources import resources, DEFAULT_EMBEDDING_MODEL_NAME
+from utils import (get_model_dir, get_corpus_dir, setup_telemetry, timed_stage, tracer, logger, 
+                   MODEL_LOAD_TIME, REQUEST_COUNT, LATENCY, TIME_TO_FIRST_TOKEN, CHAT_STAGE_LATENCY, UPLOAD_STAGE_LATENCY,
                    monitor_memory_usage, secure_filename)
 
 class ChatRequest(BaseModel):
     messages: str
+    # Skip the answer cache lookup, e.g. to get a fresh answer. The new answer is still cached.
+    bypass_cache: bool = False
+    # Only retrieve context from these documents. Defaults to every document of the user.
+    doc_ids: Optional[List[str]] = None
+    # Generation options, capped by the server. Answers generated with any of them skip the answer cache.
+    max_tokens: Optional[int] = None
+    stop: Optional[List[str]] = None
+    temperature: Optional[float] = None
     
 class ModelState:
     def __init__(self):
         """State holder for the local LLM
         """
         self.llm_loaded = False
-        self.qa_pipelines = {}
-        self.model = None
+        # Evicted pipelines are rebuilt from the saved corpus of their user
+        self.qa_pipelines = PipelineCache(loader=lambda user_id: load_user_pipeline(user_id))
+        
+    @property
+    def model(self):
+        """The LLM shared with every pipeline through the resource registry."""
+        return resources.model
+    
+    @model.setter
+    def model(self, model):
+        resources.model = model
         
 # LLM global variables
 model_state = ModelState()
 
+# Ingests uploaded PDFs off the event loop
+ingestion_manager = IngestionManager()
+
+# Set when the LLM runs in inference worker processes, see `--inference-workers`
+model_client = ModelClient() if os.getenv("MODEL_SERVER_ADDRESS") else None
+if model_client is not None:
+    model_state.llm_loaded = model_client.ready()
+
+def get_generation_options(request: ChatRequest) -> dict:
+    """Check the generation options of a request against the server caps, see `resolve_generation_options`."""
+    try:
+        return resolve_generation_options(request.max_tokens, request.stop, request.temperature)
+    except ValueError as e:
+        raise HTTPException(422, str(e))
+
+def generate_answers(prompts: list, options: list = None) -> list:
+    """Generate prompts in one batch, on the inference workers if they are used."""
+    if model_client is not None:
+        return model_client.generate(prompts, options)
+    return generate_batch(get_model_dir(), prompts, model=model_state.model, options=options)
+
+def stream_answer(prompt: str, options: dict = None, cancel: threading.Event = None) -> Iterator[str]:
+    """Stream the answer of a prompt, on the inference workers if they are used, until `cancel` is set."""
+    if model_client is not None:
+        return model_client.stream(prompt, options, cancel=cancel)
+    return stream_generate(get_model_dir(), prompt, model=model_state.model, options=options, cancel=cancel)
+
+def get_threads_per_batch() -> Optional[int]:
+    """Torch threads of each generation slot, env `CHAT_THREADS_PER_BATCH` or the cores split between the slots.
+
+    Inference workers set their own threads, so the HTTP process leaves torch alone with them.
+    """
+    if model_client is not None:
+        return None
+    concurrent_batches = int(os.getenv("CHAT_MAX_CONCURRENT_BATCHES", 1))
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+    return int(os.getenv("CHAT_THREADS_PER_BATCH", 0)) or max(1, cores // concurrent_batches)
+
+# Batches concurrent chat requests into one generation, one batch or stream in flight per slot, e.g.
+# per inference worker. Requests beyond the bounded queue are turned away with 429.
+chat_batcher = BatchScheduler(
+    generate_fn=generate_answers,
+    stream_fn=stream_answer,
+    max_concurrent_batches=model_client.num_workers if model_client is not None else None,
+    threads_per_batch=get_threads_per_batch()
+)
+
+def queue_full(error: QueueFullError) -> HTTPException:
+    return HTTPException(429, "Too many pending chat requests, retry later", headers={"Retry-After": str(error.retry_after)})
+
 # Define paths
 UPLOAD_DIR = Path("./uploaded_pdfs")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
-app = FastAPI()
+# Documents of each user, persisted across restarts
+document_registry = DocumentRegistry(str(UPLOAD_DIR / "documents.jsonl"))
+answer_cache = AnswerCache()
+
+# One growing index per user, over all of their documents
+corpus_store = CorpusStore(get_corpus_dir())
+for registered_user in document_registry.users():
+    model_state.qa_pipelines.set_source(registered_user, registered_user)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Spans are exported once the server starts, importing the app alone starts no exporter
+    setup_telemetry()
+    # One pool of extraction workers for the life of the server
+    extraction_pool = start_extraction_pool()
+    yield
+    extraction_pool.shutdown(cancel_futures=True)
+    corpus_store.wait_for_compactions()
+
+app = FastAPI(lifespan=lifespan)
 FastAPIInstrumentor.instrument_app(app)
 
-def load_llm(model_name="Qwen/Qwen2.5-0.5B-Instruct"):
+def load_llm(model_name="Qwen/Qwen2.5-0.5B-Instruct", precision=None):
     """Function to load LLM on startup.
 
     Args:
         model_name (str, optional): Model name on [Hugging Face](https://huggingface.co/Qwen/Qwen2.5-0.5B-Instruct). 
         Defaults to "Qwen/Qwen2.5-0.5B-Instruct".
+        precision (str, optional): Weight precision, one of "fp32", "bf16" or "dynamic-int8".
+        Defaults to env `MODEL_PRECISION` or "fp32".
     """
     with tracer.start_as_current_span("load_llm") as load_llm:
         start_time = time.time()
@@ -48,7 +154,8 @@ def load_llm(model_name="Qwen/Qwen2.5-0.5B-Instruct"):
             # Loading LLM Model
             logger.info("🔄 Loading LLM ...")
             local_dir = get_model_dir(model_name)
-            model_state.model = load_model(model_name=model_name, local_dir=local_dir)           
+            resources.precision = precision
+            model_state.model = load_model(model_name=model_name, local_dir=local_dir, precision=precision)
             MODEL_LOAD_TIME.observe(time.time() - start_time)
             model_state.llm_loaded = True
             logger.info("✅ LLM Model Loaded Successfully")
@@ -63,6 +170,8 @@ def get_metadata():
 @app.get("/health")
 async def health_check(response: Response):
     health_status = {"status": "healthy"}
+    if model_client is not None:
+        model_state.llm_loaded = model_client.ready()
     
     if not model_state.llm_loaded:
         response.status_code = 503
@@ -70,83 +179,326 @@ async def health_check(response: Response):
         
     return health_status
 
+def save_upload(file: UploadFile, file_path: Path):
+    """Copy an uploaded file to disk."""
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(file.file, buffer)
+
+def load_user_pipeline(user_id: str):
+    """Build a QA chain over the corpus of a user.
+
+    Args:
+        user_id (str): User ID.
+
+    Returns:
+        RetrievalQA: QA chain over every document of the user, or None if none was ingested yet.
+    """
+    corpus = corpus_store.load_read_only(user_id, resources.get_embeddings())
+    if corpus is None:
+        return None
+    retriever = build_retriever(corpus)
+    llm = model_client.get_llm() if model_client is not None else None
+    return setup_pipeline(local_dir=get_model_dir(), model=model_state.model, retriever=retriever, llm=llm)
+
+def ingest_document(user_id: str, doc_id: str, file_path: str, progress=None):
+    """Parse, embed and index a PDF document, then append it to the user's corpus. 
+    Runs on the ingestion worker pool. The uploaded file is deleted afterwards, its chunks
+    live on in the corpus.
+
+    Args:
+        user_id (str): User who uploaded the document.
+        doc_id (str): ID of the document in the registry.
+        file_path (str): Path of the uploaded PDF file.
+        progress (Callable, optional): Progress callback of the ingestion job.
+
+    Returns:
+        RetrievalQA: QA chain over every document of the user.
+    """
+    with tracer.start_as_current_span("ingest_pdf"):
+        try:
+            vector_store = prepare_vector_store(file_path=file_path, progress=progress)
+        finally:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        doc_ids = {document["doc_id"] for document in document_registry.list(user_id)}
+        if doc_id in doc_ids:
+            with timed_stage(UPLOAD_STAGE_LATENCY, "corpus"):
+                corpus_store.add_document(user_id, doc_id, vector_store, resources.get_embeddings(), keep_doc_ids=doc_ids)
+        else:
+            logger.info(f"Document {doc_id} was deleted while being ingested")
+        with timed_stage(UPLOAD_STAGE_LATENCY, "load"):
+            return load_user_pipeline(user_id)
+
+def on_ingestion_done(job, qa_pipeline):
+    """Switch the user's chat over to the updated corpus."""
+    if qa_pipeline is None:
+        return
+    model_state.qa_pipelines.put(job.user_id, qa_pipeline, source=job.user_id)
+    logger.info(f"Retriever updated for user {job.user_id}!")
+
 @app.post("/api/upload_pdf", description="API endpoint to upload PDF documents.")
 async def upload_pdf(user_id: str, file: UploadFile = File(...)):
-    """Handle PDF upload, extracts text, and updates the vector database.
+    """Save an uploaded PDF and queue its ingestion in the background.
 
     Args:
         user_id (str): User ID for storing and retrieving PDF documents.
         file (UploadFile, optional): PDF file to be uploaded. Defaults to File(...).
+        
+    Returns:
+        Response (json): Job ID to query the ingestion progress with `/api/upload_status/{job_id}`.
     """
     with tracer.start_as_current_span("upload_pdf") as upload_pdf:
         if not model_state.llm_loaded:
             raise HTTPException(status_code=503, detail="LLM is still loading. Please wait.")
         try:
-            # Save file locally
+            # Save file locally without blocking the event loop
             file_name = secure_filename(file.filename)
-            file_path = UPLOAD_DIR / f"{user_id}_{file_name}"
-            os.makedirs("./uploaded_pdfs", exist_ok=True)
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+            # A new path per upload, so that uploading a file again does not overwrite it under a running ingestion
+            file_path = UPLOAD_DIR / f"{user_id}_{uuid.uuid4().hex[:12]}_{file_name}"
+            with timed_stage(UPLOAD_STAGE_LATENCY, "save"):
+                await run_in_threadpool(save_upload, file, file_path)
+            with timed_stage(UPLOAD_STAGE_LATENCY, "hash"):
+                content_hash = await run_in_threadpool(compute_file_hash, str(file_path), DEFAULT_EMBEDDING_MODEL_NAME, get_chunk_tokenizer_dir())
+            document = document_registry.add(user_id, str(file_path), content_hash=content_hash, file_name=file_name)
             
-            # Update qa_pipeline with the new document
-            logger.info(f" Updating retriever for user {user_id}...")
-            with tracer.start_as_current_span(
-                "setup_pipeline", links=[trace.Link(upload_pdf.get_span_context())]
-            ):
-                model_state.qa_pipelines[user_id] = setup_pipeline(local_dir=get_model_dir(), file_path=str(file_path), model=model_state.model)
-            logger.info("Retriever updated!")
-            return {"message": "PDF processed and stored successfully", "file_path": file_path}
+            # Update qa_pipeline with the new document in the background
+            logger.info(f" Queuing retriever update for user {user_id}...")
+            model_state.qa_pipelines.set_source(user_id, user_id)
+            job = ingestion_manager.submit(
+                user_id, str(file_path), partial(ingest_document, user_id, document["doc_id"]), on_done=on_ingestion_done
+            )
+            return {
+                "message": "PDF uploaded, processing started", 
+                "job_id": job.job_id, 
+                "doc_id": document["doc_id"], 
+                "file_path": file_path
+            }
 
         except Exception as e:
-            logger.error(f"❌ Error updating retriever: {e}", exc_info=True)
+            logger.error(f"❌ Error saving PDF: {e}", exc_info=True)
             raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/api/upload_status/{job_id}", description="API endpoint to query the progress of a PDF ingestion.")
+async def upload_status(job_id: str):
+    """Get the progress of a PDF ingestion job.
+
+    Args:
+        job_id (str): Job ID returned by `/api/upload_pdf`.
+
+    Returns:
+        Response (json): Status, pages parsed and chunks embedded of the job.
+    """
+    job = ingestion_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown ingestion job.")
+    return job.to_dict()
     
-@app.post("/api/chat", description="API endpoint to chat with local LLM and measure latency with Prometheus.")
-def chat_endpoint(user_id: str, request: ChatRequest):
-    """Chat with the local LLM.
+@app.get("/api/documents", description="API endpoint to list the documents uploaded by a user.")
+async def list_documents(user_id: str):
+    """List the documents uploaded by a user.
 
     Args:
         user_id (str): User ID.
-        request (ChatRequest): Prompt to chat with the LLM.
 
     Returns:
-        Response (json): {"response": answer of the LLM}.
+        Response (json): {"documents": documents of the user, oldest first}.
     """
-    REQUEST_COUNT.inc()
-    start_time = time.time()
+    return {"documents": document_registry.list(user_id)}
+
+@app.delete("/api/documents/{doc_id}", description="API endpoint to delete a document of a user.")
+def delete_document(user_id: str, doc_id: str):
+    """Delete a document and remove its chunks from the user's corpus.
+
+    Args:
+        user_id (str): User ID.
+        doc_id (str): Document ID returned by `/api/upload_pdf`.
+
+    Returns:
+        Response (json): ID of the deleted document.
+    """
+    document = document_registry.get(user_id, doc_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Unknown document.")
+    # Unregister the document only once its chunks are gone, so a failed save can be retried
+    corpus_store.delete_document(user_id, doc_id, resources.get_embeddings())
+    document_registry.remove(user_id, doc_id)
+    try:
+        os.remove(document["file_path"])
+    except FileNotFoundError:
+        pass
+    logger.info(f"Deleted document {doc_id} of user {user_id}")
+    return {"message": "Document deleted", "doc_id": doc_id}
     
+def get_user_pipeline(user_id: str):
+    """Get the QA pipeline of a user, making sure the LLM and the user's document are ready.
+
+    Args:
+        user_id (str): User ID.
+
+    Returns:
+        RetrievalQA: The user's QA chain.
+    """
     if not model_state.llm_loaded:
         raise HTTPException(status_code=503, detail="LLM is still loading. Please wait.")
     
-    user_pdfs = sorted(UPLOAD_DIR.glob(f"{user_id}_*.pdf"), key=os.path.getmtime, reverse=True)
-    if not user_pdfs: 
+    latest_pdf = document_registry.latest(user_id)
+    if latest_pdf is None: 
         raise HTTPException(400, "No PDF found for this user. Upload a PDF first.")
-    latest_pdf = str(user_pdfs[0])
-    logger.info(f"Processing chat request using PDF: {latest_pdf}")
+    logger.info(f"Processing chat request using PDF: {latest_pdf['file_path']}")
     
-    # Get user-specific pipeline
-    qa_pipeline = model_state.qa_pipelines.get(user_id)
+    # Get user-specific pipeline, reloading it from the index store if it was evicted
+    try:
+        qa_pipeline = model_state.qa_pipelines.get(user_id)
+    except Exception as e:
+        logger.error(f"❌ Error reloading QA pipeline: {e}", exc_info=True)
+        qa_pipeline = None
     
     # Ensure retriever is ready
+    if qa_pipeline is None and ingestion_manager.is_pending(user_id):
+        raise HTTPException(status_code=409, detail="PDF is still being processed. Please wait.")
     if qa_pipeline is None:
         logger.info(f"QA pipeline is None")
         raise HTTPException(status_code=400, detail="QA pipeline is not ready. Upload PDF first")
-    if model_state.model is None:
-            model_state.model = load_model(
-                model_name="Qwen/Qwen2.5-0.5B-Instruct", 
-                local_dir=get_model_dir()
-            )
+    # Another server process may have updated the corpus
+    vector_store = getattr(qa_pipeline.retriever, "vectorstore", None)
+    if isinstance(vector_store, (CorpusVectorStore, ReadOnlyCorpusVectorStore)) \
+            and vector_store.version != corpus_store.current_version(user_id):
+        qa_pipeline = load_user_pipeline(user_id)
+        model_state.qa_pipelines.put(user_id, qa_pipeline, source=user_id)
+    if model_state.model is None and model_client is None:
+        resources.get_model(local_dir=get_model_dir())
+    return qa_pipeline
+
+def get_content_hash(document: dict) -> str:
+    """Get the content hash of a registered document.
+
+    Documents registered before their hash was recorded are hashed from their file. Ingestion
+    deletes the file though, so once it is gone the document id, which is never reused, stands in.
+    """
+    if document.get("content_hash"):
+        return document["content_hash"]
+    try:
+        return compute_file_hash(document["file_path"], DEFAULT_EMBEDDING_MODEL_NAME, get_chunk_tokenizer_dir())
+    except FileNotFoundError:
+        logger.debug(f"File of document {document['doc_id']} is gone, its id stands in for its content hash")
+        return document["doc_id"]
+
+def get_index_hash(user_id: str, qa_pipeline, doc_ids: list = None) -> str:
+    """Get the hash of the documents a question is answered from, which keys the answer cache.
+
+    Args:
+        user_id (str): User ID.
+        qa_pipeline (RetrievalQA): QA chain of the user.
+        doc_ids (list, optional): Documents the question is restricted to. Defaults to all documents.
+    """
+    documents = document_registry.list(user_id)
+    # Leave out documents that are still being ingested
+    vector_store = getattr(qa_pipeline.retriever, "vectorstore", None)
+    if isinstance(vector_store, (CorpusVectorStore, ReadOnlyCorpusVectorStore)):
+        ingested = vector_store.document_ids()
+        documents = [document for document in documents if document["doc_id"] in ingested]
+    if doc_ids:
+        documents = [document for document in documents if document["doc_id"] in doc_ids]
+    content_hashes = sorted(get_content_hash(document) for document in documents)
+    return compute_content_hash(content_hashes, DEFAULT_EMBEDDING_MODEL_NAME)
+
+@app.post("/api/chat", description="API endpoint to chat with local LLM and measure latency with Prometheus.")
+def chat_endpoint(user_id: str, request: ChatRequest):
+    """Chat with the local LLM.
+
+    Args:
+        user_id (str): User ID.
+        request (ChatRequest): Prompt to chat with the LLM.
+
+    Returns:
+        Response (json): {"response": answer of the LLM}.
+    """
+    REQUEST_COUNT.inc()
+    start_time = time.time()
+    options = get_generation_options(request)
+    
+    qa_pipeline = get_user_pipeline(user_id)
     try:
+        index_hash = get_index_hash(user_id, qa_pipeline, request.doc_ids)
+        with timed_stage(CHAT_STAGE_LATENCY, "embed_query"):
+            question_embedding = resources.get_embeddings().embed_query(request.messages)
+        cached_answer = None if request.bypass_cache or options else answer_cache.get(index_hash, question_embedding)
+        if cached_answer is not None:
+            LATENCY.observe(time.time() - start_time)
+            return {"response": cached_answer}
+        
         logger.info(f"QA pipeline invoke ...")
-        response = qa_pipeline.invoke(request.messages)
-        response_text = response["result"].split("Answer:")[-1].strip()
+        prompt = build_prompt(qa_pipeline, request.messages, question_embedding, request.doc_ids)
+        # Only the answer comes back, the prompt is neither decoded nor copied
+        response = chat_batcher.submit(prompt, options, user_id=user_id).result()
+        with timed_stage(CHAT_STAGE_LATENCY, "postprocess"):
+            response_text = response.strip()
+            if not options:
+                answer_cache.put(index_hash, request.messages, question_embedding, response_text)
+    except QueueFullError as e:
+        raise queue_full(e)
     except Exception as e:
         logger.error(f"Pipeline error: {str(e)}")
         raise HTTPException(500, "Failed to process request")
     
     LATENCY.observe(time.time() - start_time)
     return {"response": response_text}
+
+@app.post("/api/chat/stream", description="API endpoint to chat with local LLM and stream the answer token by token.")
+def chat_stream_endpoint(user_id: str, request: ChatRequest):
+    """Chat with the local LLM and stream the answer as it is generated.
+
+    Args:
+        user_id (str): User ID.
+        request (ChatRequest): Prompt to chat with the LLM.
+
+    Returns:
+        StreamingResponse: Chunked plain text answer of the LLM.
+    """
+    REQUEST_COUNT.inc()
+    start_time = time.time()
+    options = get_generation_options(request)
+    
+    qa_pipeline = get_user_pipeline(user_id)
+    try:
+        index_hash = get_index_hash(user_id, qa_pipeline, request.doc_ids)
+        with timed_stage(CHAT_STAGE_LATENCY, "embed_query"):
+            question_embedding = resources.get_embeddings().embed_query(request.messages)
+        cached_answer = None if request.bypass_cache or options else answer_cache.get(index_hash, question_embedding)
+        if cached_answer is None:
+            prompt = build_prompt(qa_pipeline, request.messages, question_embedding, request.doc_ids)
+            # Queued before responding, so that a full queue is still reported with a status code
+            text_stream = chat_batcher.stream(prompt, options, user_id=user_id)
+    except QueueFullError as e:
+        raise queue_full(e)
+    except Exception as e:
+        logger.error(f"Pipeline error: {str(e)}")
+        raise HTTPException(500, "Failed to process request")
+    
+    if cached_answer is not None:
+        TIME_TO_FIRST_TOKEN.observe(time.time() - start_time)
+        LATENCY.observe(time.time() - start_time)
+        return StreamingResponse(iter([cached_answer]), media_type="text/plain")
+    
+    def token_stream():
+        first_token = True
+        answer = []
+        # A failed generation raises out of the loop, so its partial answer is never cached
+        for text in text_stream:
+            if first_token and text:
+                TIME_TO_FIRST_TOKEN.observe(time.time() - start_time)
+                first_token = False
+            answer.append(text)
+            yield text
+        LATENCY.observe(time.time() - start_time)
+        if answer and not options:
+            with timed_stage(CHAT_STAGE_LATENCY, "postprocess"):
+                answer_cache.put(index_hash, request.messages, question_embedding, "".join(answer).strip())
+    
+    return StreamingResponse(token_stream(), media_type="text/plain")
     
 @app.get("/api/config")
 def get_config():
@@ -169,13 +521,56 @@ if __name__ == "__main__":
                         )
     parser.add_argument('--model', type=str, default='Qwen/Qwen2.5-0.5B-Instruct',
                         help="Model name to download.")
+    parser.add_argument('--precision', type=str, choices=PRECISIONS, default=os.getenv("MODEL_PRECISION", "fp32"),
+                        help="Weight precision of the LLM. bf16 and dynamic-int8 are converted once and cached.")
+    parser.add_argument('--max-batch-size', type=int, default=chat_batcher.max_batch_size,
+                        help="Maximum number of chat requests generated in one batch.")
+    parser.add_argument('--batch-wait-ms', type=float, default=chat_batcher.max_wait_ms,
+                        help="Maximum time a chat request waits for its batch to fill.")
+    parser.add_argument('--inference-workers', type=int, default=int(os.getenv("INFERENCE_WORKERS", 0)),
+                        help="Run the LLM in this many worker processes, each pinned to its share of the cores. "
+                             "0 runs it in the HTTP process.")
+    parser.add_argument('--threads-per-worker', type=int, default=os.getenv("INFERENCE_THREADS_PER_WORKER"),
+                        help="Torch threads of each inference worker. Defaults to its number of cores.")
+    parser.add_argument('--workers', type=int, default=int(os.getenv("HTTP_WORKERS", 1)),
+                        help="Number of HTTP worker processes. Only 1 is supported.")
     args = parser.parse_args()
+    if args.workers > 1:
+        # The document registry, upload jobs, pipeline cache and metrics live in the memory of one HTTP process
+        parser.error("--workers > 1 is not supported, HTTP workers would not share documents, upload jobs or metrics. "
+                     "Use --inference-workers to generate in parallel.")
+    chat_batcher.max_batch_size = args.max_batch_size
+    chat_batcher.max_wait_ms = args.batch_wait_ms
     
-    # Load local LLM
-    load_llm(args.model)
-    
-    # Start memory monitoring
-    threading.Thread(target=monitor_memory_usage, daemon=True).start()
-    
-    # Start FastAPI server
-    uvicorn.run(app, host="0.0.0.0", port=args.port)
\ No newline at end of file
+    if args.inference_workers > 0:
+        # Generate in separate processes fed through a local queue
+        model_server = ModelServer(
+            args.inference_workers, args.model, get_model_dir(args.model),
+            precision=args.precision, num_threads=args.threads_per_worker
+        ).start()
+        if not model_server.wait_ready():
+            logger.error(f"❌ Inference workers failed to load the LLM: {model_server.status()}")
+        
+        # The server imports the app again, pass the settings through the environment
+        os.environ["MODEL_SERVER_ADDRESS"] = model_server.address
+        os.environ["MODEL_SERVER_AUTHKEY"] = model_server.authkey.hex()
+        os.environ["CHAT_MAX_BATCH_SIZE"] = str(args.max_batch_size)
+        os.environ["CHAT_BATCH_WAIT_MS"] = str(args.batch_wait_ms)
+        threading.Thread(target=monitor_memory_usage, daemon=True).start()
+        uvicorn.run("main:app", host="0.0.0.0", port=args.port, app_dir=os.path.dirname(os.path.abspath(__file__)))
+        model_server.stop()
+    else:
+        # Load local LLM
+        load_llm(args.model, precision=args.precision)
+        
+        # Load the shared tokenizer, embeddings and generation pipeline before serving
+        try:
+            resources.warm_up(get_model_dir(args.model))
+        except Exception as e:
+            logger.error(f"❌ Shared resources warm-up failed: {e}", exc_info=True)
+        
+        # Start memory monitoring
+        threading.Thread(target=monitor_memory_usage, daemon=True).start()
+        
+        # Start FastAPI server
+        uvicorn.run(app, host="0.0.0.0", port=args.port)
@@ -0,0 +1,218 @@
+import os
+import json
+import mmap
+import faiss
+import numpy as np
+from collections.abc import Mapping
+from langchain_community.docstore.base import Docstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from ann_index import reconstruct_ids
+
+MMAP_INDEX_FILE = "index.mmap.faiss"
+IVF_DATA_FILE = "index.ivfdata"
+CHUNKS_FILE = "chunks.jsonl"
+OFFSETS_FILE = "chunks.offsets.npy"
+DOCUMENTS_FILE = "documents.json"
+DELTA_FILE = "delta.json"
+DELTA_VECTORS_FILE = "vectors.npy"
+
+def encode_chunk(chunk: Document) -> bytes:
+    """Encode a chunk as a line of a chunk file."""
+    return json.dumps({"page_content": chunk.page_content, "metadata": chunk.metadata}).encode() + b"\n"
+
+class ChunkFile(Docstore):
+    def __init__(self, folder_path: str, offsets: np.ndarray = None):
+        """Read-only docstore of the chunks of a memory-mapped index.
+
+        Chunks are stored one JSON record per line, looked up by row through an array of
+        byte offsets. Both files are memory-mapped, so nothing is read until a chunk is
+        returned and processes reading the same files share their pages.
+
+        Args:
+            folder_path (str): Directory written by `write_mmap_index`.
+            offsets (np.ndarray, optional): Offsets of the rows to read, e.g. including the
+            chunks appended by `write_mmap_delta`. Defaults to the rows of the index.
+        """
+        self.offsets = np.load(os.path.join(folder_path, OFFSETS_FILE), mmap_mode="r") if offsets is None else offsets
+        with open(os.path.join(folder_path, CHUNKS_FILE), "rb") as f:
+            # Empty files cannot be mapped
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def search(self, search) -> Document:
+        """Get the chunk of a row, or a not found message like `InMemoryDocstore`."""
+        row = int(search)
+        if not 0 <= row < len(self):
+            return f"ID {search} not found."
+        record = json.loads(self._data[int(self.offsets[row]):int(self.offsets[row + 1])])
+        return Document(page_content=record["page_content"], metadata=record["metadata"])
+
+class RowIds(Mapping):
+    """Map from index labels to docstore ids of a memory-mapped index, which are both the chunk row."""
+    def __init__(self, num_rows: int):
+        self._num_rows = num_rows
+
+    def __getitem__(self, label) -> int:
+        if not 0 <= label < self._num_rows:
+            raise KeyError(label)
+        return int(label)
+
+    def __iter__(self):
+        return iter(range(self._num_rows))
+
+    def __len__(self) -> int:
+        return self._num_rows
+
+def write_mmap_index(folder_path: str, vector_store: FAISS) -> dict:
+    """Write a vector store in a format that can be memory-mapped read-only.
+
+    Vectors are stored in FAISS on-disk inverted lists, labelled with their chunk row, and
+    chunks in a `ChunkFile` instead of a pickled docstore. Flat indexes are written as an
+    IVF index with a single list, which is still an exact search, and IVF indexes keep their
+    trained quantizer. Chunks are grouped by their `doc_id` metadata, so each document is a
+    range of rows.
+
+    Args:
+        folder_path (str): Directory to write to. It must not be read while being written.
+        vector_store (FAISS): Vector store with a flat or IVF index, optionally wrapped in an `IndexIDMap`.
+
+    Returns:
+        dict: [first row, last row + 1) of each document.
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    labels = sorted(
+        vector_store.index_to_docstore_id,
+        key=lambda label: str(vector_store.docstore.search(vector_store.index_to_docstore_id[label]).metadata.get("doc_id", ""))
+    )
+    chunks = [vector_store.docstore.search(vector_store.index_to_docstore_id[label]) for label in labels]
+
+    # Chunk text, one JSON record per line
+    offsets = [0]
+    doc_ranges = {}
+    with open(os.path.join(folder_path, CHUNKS_FILE), "wb") as f:
+        for row, chunk in enumerate(chunks):
+            record = encode_chunk(chunk)
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+            doc_id = chunk.metadata.get("doc_id")
+            if doc_id is not None:
+                doc_ranges.setdefault(doc_id, [row, row])[1] = row + 1
+    np.save(os.path.join(folder_path, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    with open(os.path.join(folder_path, DOCUMENTS_FILE), "w") as f:
+        json.dump(doc_ranges, f)
+
+    # Vectors, labelled with their row
+    source_index = vector_store.index
+    ivf = faiss.try_extract_index_ivf(source_index)
+    vectors = reconstruct_ids(source_index, np.array(labels, dtype=np.int64))
+    if ivf is None:
+        dim = source_index.d
+        quantizer = faiss.IndexFlatL2(dim)
+        quantizer.add(np.zeros((1, dim), dtype=np.float32))
+        index = faiss.IndexIVFFlat(quantizer, dim, 1, source_index.metric_type)
+    else:
+        index = faiss.clone_index(ivf)
+        index.reset()
+    if labels:
+        index.add_with_ids(vectors, np.arange(len(labels), dtype=np.int64))
+        # Empty inverted lists cannot be mapped, they stay in the index file
+        invlists = faiss.OnDiskInvertedLists(index.nlist, index.code_size, os.path.join(folder_path, IVF_DATA_FILE))
+        source_lists = faiss.InvertedListsPtrVector()
+        source_lists.push_back(index.invlists)
+        invlists.merge_from_multiple(source_lists.data(), 1, False, False)
+        index.replace_invlists(invlists, False)
+    faiss.write_index(index, os.path.join(folder_path, MMAP_INDEX_FILE))
+    return doc_ranges
+
+def read_mmap_index(folder_path: str) -> tuple:
+    """Open an index written by `write_mmap_index` without reading its vectors and chunks.
+
+    Returns:
+        tuple: (FAISS index, `ChunkFile`, [first row, last row + 1) of each document).
+    """
+    # Inverted lists are looked up next to the index file, so the directory can be moved
+    index = faiss.read_index(
+        os.path.join(folder_path, MMAP_INDEX_FILE), faiss.IO_FLAG_READ_ONLY | faiss.IO_FLAG_ONDISK_SAME_DIR
+    )
+    invlists = faiss.downcast_InvertedLists(faiss.extract_index_ivf(index).invlists)
+    if isinstance(invlists, faiss.OnDiskInvertedLists):
+        # Prefetch threads are started on every search, which costs more than reading lists from the page cache
+        invlists.prefetch_nthread = 0
+    with open(os.path.join(folder_path, DOCUMENTS_FILE), "r") as f:
+        doc_ranges = json.load(f)
+    return index, ChunkFile(folder_path), doc_ranges
+
+def read_mmap_extent(folder_path: str) -> tuple:
+    """Get the rows of an index written by `write_mmap_index` or of one of its deltas.
+
+    Returns:
+        tuple: (number of rows, end of the chunks in the chunk file), including the rows of earlier deltas.
+    """
+    if os.path.exists(os.path.join(folder_path, DELTA_FILE)):
+        with open(os.path.join(folder_path, DELTA_FILE), "r") as f:
+            delta = json.load(f)
+        return delta["num_rows"], delta["chunks_end"]
+    offsets = np.load(os.path.join(folder_path, OFFSETS_FILE), mmap_mode="r")
+    return len(offsets) - 1, int(offsets[-1])
+
+def write_mmap_delta(folder_path: str, base_path: str, previous_path: str, documents: dict, doc_ids: set) -> dict:
+    """Write the changes of a corpus since a version written by `write_mmap_index` or `write_mmap_delta`.
+
+    The chunks of the added documents are appended to the chunk file of the base index, after
+    the rows of the previous version, so that each document is still a range of rows. Their
+    vectors are stored in a plain array next to their offsets. Rows of removed documents are
+    left in place and only dropped from the document ranges.
+
+    Args:
+        folder_path (str): Directory of the delta. It must not be read while being written.
+        base_path (str): Directory of the base index, whose chunk file is appended to.
+        previous_path (str): Directory of the previous version, the base index or a delta of it.
+        documents (dict): (vectors, chunks) of each added document, replacing its previous rows if any.
+        doc_ids (set): Documents of the new version, the added ones and those kept from the previous version.
+
+    Returns:
+        dict: [first row, last row + 1) of each document of the new version.
+    """
+    first_row, chunks_end = read_mmap_extent(previous_path)
+    with open(os.path.join(previous_path, DOCUMENTS_FILE), "r") as f:
+        doc_ranges = {doc_id: rows for doc_id, rows in json.load(f).items() if doc_id in doc_ids and doc_id not in documents}
+    os.makedirs(folder_path, exist_ok=True)
+    offsets = [chunks_end]
+    row = first_row
+    with open(os.path.join(base_path, CHUNKS_FILE), "r+b") as f:
+        # Drop what an interrupted save appended after the previous version
+        f.truncate(chunks_end)
+        f.seek(chunks_end)
+        for doc_id, (_, chunks) in documents.items():
+            for chunk in chunks:
+                record = encode_chunk(chunk)
+                f.write(record)
+                offsets.append(offsets[-1] + len(record))
+            doc_ranges[doc_id] = [row, row + len(chunks)]
+            row += len(chunks)
+    vectors = [vectors for vectors, _ in documents.values() if len(vectors)]
+    np.save(os.path.join(folder_path, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(folder_path, DELTA_VECTORS_FILE), np.concatenate(vectors) if vectors else np.empty(0, dtype=np.float32))
+    with open(os.path.join(folder_path, DOCUMENTS_FILE), "w") as f:
+        json.dump(doc_ranges, f)
+    with open(os.path.join(folder_path, DELTA_FILE), "w") as f:
+        json.dump({"first_row": first_row, "num_rows": row, "chunks_end": offsets[-1]}, f)
+    return doc_ranges
+
+def read_mmap_delta(folder_path: str) -> tuple:
+    """Open a delta written by `write_mmap_delta`.
+
+    Returns:
+        tuple: (first added row, vectors of the added rows, chunk file offsets of the added rows,
+        [first row, last row + 1) of each document of the version).
+    """
+    with open(os.path.join(folder_path, DELTA_FILE), "r") as f:
+        first_row = json.load(f)["first_row"]
+    vectors = np.load(os.path.join(folder_path, DELTA_VECTORS_FILE))
+    offsets = np.load(os.path.join(folder_path, OFFSETS_FILE))
+    with open(os.path.join(folder_path, DOCUMENTS_FILE), "r") as f:
+        doc_ranges = json.load(f)
+    return first_row, vectors, offsets, doc_ranges
@@ -0,0 +1,445 @@
+import os
+import time
+import queue
+import uuid
+import tempfile
+import threading
+import multiprocessing
+from contextlib import closing
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing.connection import Client
+from multiprocessing.managers import BaseManager, DictProxy
+from typing import TYPE_CHECKING, Iterator
+from utils import logger, setup_telemetry
+
+if TYPE_CHECKING:
+    from langchain_core.language_models.llms import LLM
+
+LOADING, READY, FAILED = "loading", "ready", "failed"
+# Streamed tokens between checks for a cancellation, each check being a round-trip to the server
+CANCEL_CHECK_TOKENS = 8
+
+class _ServerManager(BaseManager):
+    """Serves the queues of a `ModelServer` from the process that started it."""
+
+class _ClientManager(BaseManager):
+    """Connects to the queues of a `ModelServer`."""
+
+for _name in ("get_request_queue", "get_response_queue", "remove_response_queue"):
+    _ClientManager.register(_name)
+for _name in ("get_worker_status", "get_worker_requests", "get_cancelled_requests"):
+    _ClientManager.register(_name, proxytype=DictProxy)
+
+def plan_core_sets(num_workers: int, cores: list = None) -> list:
+    """Split the cores of this process into one contiguous set per inference worker.
+
+    Args:
+        num_workers (int): Number of inference workers.
+        cores (list, optional): Cores to split. Defaults to the cores this process may run on.
+
+    Returns:
+        list: Cores of each worker. Workers share cores when there are fewer cores than workers.
+    """
+    if cores is None:
+        cores = os.sched_getaffinity(0) if hasattr(os, "sched_getaffinity") else range(os.cpu_count() or 1)
+    cores = sorted(cores)
+    if len(cores) < num_workers:
+        return [[cores[i % len(cores)]] for i in range(num_workers)]
+    size, extra = divmod(len(cores), num_workers)
+    core_sets, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        core_sets.append(cores[start:end])
+        start = end
+    return core_sets
+
+def run_inference_worker(address: str, authkey: bytes, worker_index: int, cores: list, num_threads: int,
+                         model_name: str, local_dir: str, precision: str):
+    """Entry point of an inference worker process.
+
+    The worker pins itself to its cores, loads the LLM, then generates the requests it takes
+    from the shared request queue one at a time and sends the results to the queue of the
+    client that sent them.
+    """
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    import torch
+    torch.set_num_threads(num_threads)
+    from data_pipeline import generate_batch, stream_generate
+    from resources import resources
+    setup_telemetry(f"rag-pipeline-inference-worker-{worker_index}")
+
+    manager = _ClientManager(address=address, authkey=authkey)
+    manager.connect()
+    status = manager.get_worker_status()
+    status[worker_index] = {"state": LOADING, "pid": os.getpid(), "cores": cores, "num_threads": num_threads}
+    try:
+        resources.precision = precision
+        model = resources.get_model(model_name=model_name, local_dir=local_dir)
+    except Exception as e:
+        logger.error(f"❌ Inference worker {worker_index} failed to load the LLM: {e}", exc_info=True)
+        status[worker_index] = {**status[worker_index], "state": FAILED, "error": str(e)}
+        return
+    status[worker_index] = {**status[worker_index], "state": READY}
+    logger.info(f"Inference worker {worker_index} ready on cores {cores} with {num_threads} threads")
+
+    requests = manager.get_request_queue()
+    current = manager.get_worker_requests()
+    cancelled = manager.get_cancelled_requests()
+    response_queues = {}
+    while True:
+        kind, client_id, request_id, payload = requests.get()
+        if kind == "stop":
+            break
+        if client_id not in response_queues:
+            response_queues[client_id] = manager.get_response_queue(client_id)
+        responses = response_queues[client_id]
+        # The client may have left while the request was queued
+        if cancelled.pop(request_id, False):
+            responses.put(("end", request_id, None))
+            continue
+        # The server fails the request if this worker dies while generating it
+        current[worker_index] = (client_id, request_id)
+        try:
+            if kind == "generate":
+                prompts, options = payload
+                responses.put(("result", request_id, generate_batch(local_dir, prompts, model=model, options=options)))
+            elif kind == "stream":
+                prompt, options = payload
+                with closing(stream_generate(local_dir, prompt, model=model, options=options)) as texts:
+                    for index, text in enumerate(texts):
+                        # Closing the stream stops the generation once its client has left
+                        if index % CANCEL_CHECK_TOKENS == 0 and cancelled.pop(request_id, False):
+                            break
+                        responses.put(("token", request_id, text))
+                    else:
+                        # A cancellation after the last check is dropped with the request
+                        cancelled.pop(request_id, None)
+                responses.put(("end", request_id, None))
+            else:
+                raise ValueError(f"Unknown request kind {kind}")
+        except Exception as e:
+            logger.error(f"Inference worker {worker_index} failed a {kind} request: {e}", exc_info=True)
+            responses.put(("error", request_id, str(e)))
+        finally:
+            current.pop(worker_index, None)
+
+class ModelServer:
+    # How often dead workers are looked for
+    MONITOR_INTERVAL = 1.0
+
+    def __init__(self, num_workers: int, model_name: str, local_dir: str, precision: str = None,
+                 num_threads: int = None, address: str = None):
+        """Inference worker processes fed through a local IPC queue.
+
+        The queues are served by a `multiprocessing` manager from the process that starts the
+        server, over a Unix socket. The HTTP process connects to it with `ModelClient`, so
+        generations run outside of it and throughput scales with the workers.
+
+        Args:
+            num_workers (int): Number of inference worker processes. Each loads its own copy of the LLM.
+            model_name (str): Model name on Hugging Face Hub.
+            local_dir (str): Local directory of the model.
+            precision (str, optional): Weight precision. Defaults to env `MODEL_PRECISION` or "fp32".
+            num_threads (int, optional): Torch threads per worker. Defaults to the number of cores of the worker.
+            address (str, optional): Unix socket path of the queues. Defaults to a new temporary path.
+        """
+        self.num_workers = num_workers
+        self.model_name = model_name
+        self.local_dir = local_dir
+        self.precision = precision
+        self.num_threads = num_threads
+        self.address = address or os.path.join(tempfile.mkdtemp(prefix="model-server-"), "queues.sock")
+        self.authkey = os.urandom(16)
+        self.workers = []
+        self._requests = queue.Queue()
+        self._responses = {}
+        self._status = {}
+        # Request each worker is generating, as (client id, request id)
+        self._current = {}
+        # Ids of the requests whose client stopped waiting
+        self._cancelled = {}
+        self._lock = threading.Lock()
+        self._server = None
+        # Set once the workers are being stopped, then once they are gone
+        self._stopping = threading.Event()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def _get_response_queue(self, client_id: str) -> queue.Queue:
+        with self._lock:
+            return self._responses.setdefault(client_id, queue.Queue())
+
+    def _remove_response_queue(self, client_id: str):
+        with self._lock:
+            self._responses.pop(client_id, None)
+
+    def _fail(self, client_id: str, request_id: str, message: str):
+        """Send an error for a request to its client, unless the client is gone."""
+        with self._lock:
+            responses = self._responses.get(client_id)
+        if responses is not None:
+            responses.put(("error", request_id, message))
+
+    def start(self) -> "ModelServer":
+        """Serve the queues and start the inference workers."""
+        manager_class = type("ModelServerManager", (_ServerManager,), {})
+        manager_class.register("get_request_queue", callable=lambda: self._requests)
+        manager_class.register("get_response_queue", callable=self._get_response_queue)
+        manager_class.register("remove_response_queue", callable=self._remove_response_queue)
+        manager_class.register("get_worker_status", callable=lambda: self._status, proxytype=DictProxy)
+        manager_class.register("get_worker_requests", callable=lambda: self._current, proxytype=DictProxy)
+        manager_class.register("get_cancelled_requests", callable=lambda: self._cancelled, proxytype=DictProxy)
+        self._server = manager_class(address=self.address, authkey=self.authkey).get_server()
+        # Connections are served until the server stops
+        self._server.stop_event = self._stopped
+        self._threads = [threading.Thread(target=self._serve, name="model-server", daemon=True)]
+        self._threads[0].start()
+
+        # Spawn, since forking a process that already runs torch threads is unsafe
+        context = multiprocessing.get_context("spawn")
+        for worker_index, cores in enumerate(plan_core_sets(self.num_workers)):
+            worker = context.Process(
+                target=run_inference_worker,
+                args=(self.address, self.authkey, worker_index, cores, self.num_threads or len(cores),
+                      self.model_name, self.local_dir, self.precision),
+                name=f"inference-worker-{worker_index}",
+                daemon=True
+            )
+            worker.start()
+            self.workers.append(worker)
+        # Workers are only watched once started
+        self._threads.append(threading.Thread(target=self._monitor, name="model-server-monitor", daemon=True))
+        self._threads[1].start()
+        logger.info(f"Started {self.num_workers} inference workers, queues at {self.address}")
+        return self
+
+    def _serve(self):
+        """Accept connections until the server stops.
+
+        `Server.serve_forever` ends its thread with `sys.exit` and leaves the socket open, so the
+        connections are accepted here instead.
+        """
+        listener = self._server.listener
+        while not self._stopped.is_set():
+            try:
+                connection = listener.accept()
+            except OSError:
+                continue
+            if self._stopped.is_set():
+                connection.close()
+                break
+            threading.Thread(target=self._server.handle_request, args=(connection,), daemon=True).start()
+        listener.close()
+
+    def _monitor(self):
+        """Fail the requests of workers that died, which would otherwise wait forever."""
+        while not self._stopping.wait(self.MONITOR_INTERVAL):
+            for worker_index, worker in enumerate(self.workers):
+                status = self._status.get(worker_index, {})
+                if worker.is_alive() or status.get("state") == FAILED:
+                    continue
+                logger.error(f"❌ Inference worker {worker_index} exited with code {worker.exitcode}")
+                self._status[worker_index] = {**status, "state": FAILED, "error": f"exited with code {worker.exitcode}"}
+                if worker_index in self._current:
+                    client_id, request_id = self._current.pop(worker_index)
+                    self._fail(client_id, request_id, f"Inference worker {worker_index} died")
+            if self.workers and not any(worker.is_alive() for worker in self.workers):
+                # Nobody is left to take the queued requests
+                while True:
+                    try:
+                        kind, client_id, request_id, _ = self._requests.get_nowait()
+                    except queue.Empty:
+                        break
+                    if kind != "stop":
+                        self._fail(client_id, request_id, "No inference worker is running")
+
+    def status(self) -> dict:
+        """Get the state, pid, cores and torch threads of each worker."""
+        return dict(self._status)
+
+    def wait_ready(self, timeout: float = None) -> bool:
+        """Block until every worker loaded the LLM.
+
+        Returns:
+            bool: Whether every worker is ready. False if a worker failed or the timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            states = [self._status.get(i, {}).get("state") for i in range(self.num_workers)]
+            if FAILED in states or not all(worker.is_alive() or state == READY for worker, state in zip(self.workers, states)):
+                return False
+            if all(state == READY for state in states):
+                return True
+            time.sleep(0.1)
+        return False
+
+    def stop(self, timeout: float = 10):
+        """Stop the workers once they finish their current request, then close the socket."""
+        self._stopping.set()
+        for _ in self.workers:
+            self._requests.put(("stop", None, None, None))
+        for worker in self.workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        self._stopped.set()
+        if self._server is not None:
+            try:
+                # Wakes the accept loop up, which sees the server stopped
+                Client(self.address).close()
+            except OSError:
+                pass
+        for thread in self._threads:
+            thread.join(timeout)
+        self.workers = []
+
+class ModelClient:
+    # How often a stream waiting for its next token checks whether it was cancelled
+    CANCEL_POLL_SECONDS = 0.1
+
+    def __init__(self, address: str = None, authkey: bytes = None, timeout: float = None):
+        """Client of a `ModelServer`, used by the HTTP process instead of an in-process LLM.
+
+        Args:
+            address (str, optional): Socket of the server. Defaults to env `MODEL_SERVER_ADDRESS`.
+            authkey (bytes, optional): Key of the server. Defaults to hex env `MODEL_SERVER_AUTHKEY`.
+            timeout (float, optional): Seconds to wait for generated text, or for the next token of a stream.
+            Defaults to env `MODEL_SERVER_TIMEOUT` or 300.
+        """
+        self.address = address or os.environ["MODEL_SERVER_ADDRESS"]
+        self.authkey = authkey or bytes.fromhex(os.environ["MODEL_SERVER_AUTHKEY"])
+        self.timeout = timeout or float(os.getenv("MODEL_SERVER_TIMEOUT", 300))
+        self.client_id = uuid.uuid4().hex
+        self._manager = _ClientManager(address=self.address, authkey=self.authkey)
+        self._manager.connect()
+        self._requests = self._manager.get_request_queue()
+        self._status = self._manager.get_worker_status()
+        self._cancelled = self._manager.get_cancelled_requests()
+        self._pending = {}
+        self._lock = threading.Lock()
+        threading.Thread(target=self._listen, name="model-client", daemon=True).start()
+
+    @property
+    def num_workers(self) -> int:
+        return len(self._status)
+
+    def ready(self) -> bool:
+        """Whether at least one worker can generate."""
+        return any(status["state"] == READY for status in self._status.values())
+
+    def _send(self, kind: str, payload, pending) -> str:
+        request_id = uuid.uuid4().hex
+        with self._lock:
+            self._pending[request_id] = pending
+        self._requests.put((kind, self.client_id, request_id, payload))
+        return request_id
+
+    def generate(self, prompts: list, options: list = None) -> list:
+        """Generate prompts together on one worker.
+
+        Args:
+            prompts (list): Prompts to generate from.
+            options (list, optional): Generation options of each prompt, see `generate_batch`.
+
+        Returns:
+            list: Generated text of each prompt, without the prompt.
+
+        Raises:
+            TimeoutError: If the text is not generated within `timeout` seconds.
+        """
+        future = Future()
+        request_id = self._send("generate", (list(prompts), options), future)
+        try:
+            return future.result(self.timeout)
+        except FutureTimeoutError:
+            self._cancel(request_id)
+            raise TimeoutError(f"No answer from the inference workers within {self.timeout} s") from None
+
+    def stream(self, prompt: str, options: dict = None, cancel: threading.Event = None) -> Iterator[str]:
+        """Generate an answer on one worker and yield its text as soon as tokens are decoded.
+
+        Args:
+            prompt (str): Prompt to generate from.
+            options (dict, optional): Generation options of the request, see `stream_generate`.
+            cancel (threading.Event, optional): Stops the generation once set. Closing the iterator early does too.
+
+        Yields:
+            str: Newly generated text, without the prompt.
+
+        Raises:
+            TimeoutError: If no token comes within `timeout` seconds, which cancels the generation.
+        """
+        tokens = queue.Queue()
+        request_id = self._send("stream", (prompt, options), tokens)
+        finished = False
+        deadline = time.monotonic() + self.timeout
+        try:
+            while cancel is None or not cancel.is_set():
+                try:
+                    kind, payload = tokens.get(timeout=max(0, min(self.CANCEL_POLL_SECONDS, deadline - time.monotonic())))
+                except queue.Empty:
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError(f"No token from the inference workers within {self.timeout} s")
+                    continue
+                deadline = time.monotonic() + self.timeout
+                if kind == "end":
+                    finished = True
+                    return
+                if kind == "error":
+                    finished = True
+                    raise RuntimeError(payload)
+                yield payload
+        finally:
+            if not finished:
+                self._cancel(request_id)
+
+    def _cancel(self, request_id: str):
+        """Tell the worker of a request to skip or stop it, unless it already finished."""
+        with self._lock:
+            if self._pending.pop(request_id, None) is not None:
+                self._cancelled[request_id] = True
+
+    def get_llm(self) -> "LLM":
+        """Get a LangChain LLM generating on the server, e.g. for a `RetrievalQA` chain."""
+        # LangChain language models import transformers and torch, which the HTTP process does not need otherwise
+        from model_server_llm import ModelServerLLM
+        return ModelServerLLM(client=self)
+
+    def _listen(self):
+        """Route the responses of the workers to their pending request."""
+        try:
+            responses = self._manager.get_response_queue(self.client_id)
+            while True:
+                kind, request_id, payload = responses.get()
+                with self._lock:
+                    pending = self._pending.get(request_id)
+                    if kind != "token":
+                        self._pending.pop(request_id, None)
+                if pending is None:
+                    if kind != "token":
+                        # The request was cancelled after its worker last looked, which can no longer see it
+                        self._cancelled.pop(request_id, None)
+                    continue
+                self._deliver(pending, kind, payload)
+        except (EOFError, OSError) as e:
+            # No response can come any more, fail the requests instead of letting them wait
+            logger.error(f"❌ Lost the connection to the model server: {e}")
+            with self._lock:
+                pending_requests, self._pending = list(self._pending.values()), {}
+            for pending in pending_requests:
+                self._deliver(pending, "error", "Lost the connection to the model server")
+
+    @staticmethod
+    def _deliver(pending, kind: str, payload):
+        if isinstance(pending, Future):
+            if kind == "error":
+                pending.set_exception(RuntimeError(payload))
+            else:
+                pending.set_result(payload)
+        else:
+            pending.put((kind, payload))
+
+    def close(self):
+        self._manager.remove_response_queue(self.client_id)
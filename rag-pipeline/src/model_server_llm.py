@@ -0,0 +1,14 @@
+from typing import Any, List, Optional
+from langchain_core.language_models.llms import LLM
+
+class ModelServerLLM(LLM):
+    """LangChain LLM generating on a `ModelServer`."""
+    client: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "model_server"
+
+    def _call(self, prompt: str, stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> str:
+        # Workers only return the answer, cut before the first stop sequence
+        return self.client.generate([prompt], [{"stop": stop}] if stop else None)[0]
@@ -1,20 +1,110 @@
 import os
+import json
+import shutil
 import logging
-from huggingface_hub import snapshot_download
-from transformers import AutoModelForCausalLM
 from utils import get_hardware, get_model_dir
 
 # Initialize logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+
+PRECISIONS = ("fp32", "bf16", "dynamic-int8")
+QUANTIZED_MODEL_FILE = "model.pt"
+
+def get_precision_dir(local_dir: str, precision: str) -> str:
+    """Get the directory where the converted weights of a model are cached, next to the model directory.
+
+    Args:
+        local_dir (str): Local directory of the fp32 model.
+        precision (str): One of `PRECISIONS`.
+    """
+    return f"{os.path.normpath(local_dir)}-{precision}"
+
+def _cache_info(precision: str) -> dict:
+    import torch
+    import transformers
+    # Pickled quantized modules are only valid for the library versions that wrote them
+    return {"precision": precision, "torch": torch.__version__, "transformers": transformers.__version__}
+
+def _is_cached(precision_dir: str, precision: str) -> bool:
+    info_path = os.path.join(precision_dir, "precision.json")
+    if not os.path.exists(info_path):
+        return False
+    with open(info_path, "r") as f:
+        return json.load(f) == _cache_info(precision)
+
+def _save_cache(precision_dir: str, precision: str, save_fn):
+    """Write converted weights to a temporary directory, then move it into place."""
+    tmp_dir = f"{precision_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    save_fn(tmp_dir)
+    with open(os.path.join(tmp_dir, "precision.json"), "w") as f:
+        json.dump(_cache_info(precision), f)
+    shutil.rmtree(precision_dir, ignore_errors=True)
+    os.rename(tmp_dir, precision_dir)
+
+def _load_bf16(local_dir: str, hardware: str) -> any:
+    import torch
+    from transformers import AutoModelForCausalLM
+    precision_dir = get_precision_dir(local_dir, "bf16")
+    if _is_cached(precision_dir, "bf16"):
+        logger.info(f"Loading bf16 weights from {precision_dir} on {hardware}...")
+        return AutoModelForCausalLM.from_pretrained(
+            pretrained_model_name_or_path=precision_dir,
+            device_map=hardware,
+            torch_dtype=torch.bfloat16
+            )
+
+    logger.info(f"Loading model from {local_dir} on {hardware} in bf16...")
+    model = AutoModelForCausalLM.from_pretrained(
+        pretrained_model_name_or_path=local_dir,
+        device_map=hardware,
+        torch_dtype=torch.bfloat16
+        )
+    _save_cache(precision_dir, "bf16", model.save_pretrained)
+    logger.info(f"bf16 weights cached in {precision_dir}")
+    return model
+
+def _load_dynamic_int8(local_dir: str) -> any:
+    import torch
+    from transformers import AutoModelForCausalLM
+    precision_dir = get_precision_dir(local_dir, "dynamic-int8")
+    if _is_cached(precision_dir, "dynamic-int8"):
+        logger.info(f"Loading dynamic int8 model from {precision_dir}...")
+        return torch.load(os.path.join(precision_dir, QUANTIZED_MODEL_FILE), weights_only=False)
+
+    logger.info(f"Loading model from {local_dir} on cpu and quantizing linear layers to int8...")
+    model = AutoModelForCausalLM.from_pretrained(
+        pretrained_model_name_or_path=local_dir,
+        device_map="cpu"
+        )
+    model.eval()
+    model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    _save_cache(
+        precision_dir, "dynamic-int8",
+        lambda tmp_dir: torch.save(model, os.path.join(tmp_dir, QUANTIZED_MODEL_FILE))
+        )
+    logger.info(f"Dynamic int8 model cached in {precision_dir}")
+    return model
     
-def load_model(model_name: str, local_dir: str) -> any:
+def load_model(model_name: str, local_dir: str, precision: str = None) -> any:
     """Setup local LLM model for inference.
 
     Args:
         model_name (str): Path to download the model from Hugging Face Hub.
         local_dir (str): Local directory to save the model.
+        precision (str, optional): Weight precision, one of "fp32", "bf16" or "dynamic-int8".
+        Converted weights are cached next to `local_dir`, so later startups skip the conversion.
+        Defaults to env `MODEL_PRECISION` or "fp32".
     """
+    # Torch and transformers take seconds to import, only pay for them when loading a model
+    from huggingface_hub import snapshot_download
+    from transformers import AutoModelForCausalLM
+    precision = precision or os.getenv("MODEL_PRECISION", "fp32")
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+
     # Ensure the directory exists
     os.makedirs(local_dir, exist_ok=True)
     
@@ -28,6 +118,14 @@ def load_model(model_name: str, local_dir: str) -> any:
     # Get hardware
     hardware = get_hardware()
     
+    if precision == "bf16":
+        return _load_bf16(local_dir, hardware)
+    if precision == "dynamic-int8":
+        # Dynamically quantized kernels only run on CPU
+        if hardware != "cpu":
+            logger.warning(f"dynamic-int8 runs on cpu only, ignoring {hardware}")
+        return _load_dynamic_int8(local_dir)
+    
     logger.info(f"Loading model from {local_dir} on {hardware}...")
     model = AutoModelForCausalLM.from_pretrained(
         pretrained_model_name_or_path=local_dir,
@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable
+from mmap_index import ChunkFile
+from utils import logger, RESIDENT_PIPELINES, RESIDENT_INDEX_BYTES
+
+def estimate_pipeline_bytes(qa_pipeline: Any) -> int:
+    """Estimate the memory held by the vector index of a QA pipeline.
+
+    Args:
+        qa_pipeline (Any): QA chain whose retriever wraps a FAISS vector store, in memory or
+        memory-mapped from a `ChunkFile`.
+
+    Returns:
+        int: Estimated bytes of the vectors and chunk texts, 0 if unknown.
+    """
+    try:
+        vector_store = qa_pipeline.retriever.vectorstore
+        index = vector_store.index
+        vector_bytes = int(index.ntotal) * int(index.d) * 4
+        docstore = vector_store.docstore
+        if isinstance(docstore, ChunkFile):
+            # Mapped pages count once they are read, like the chunk records and their offsets
+            text_bytes = int(docstore.offsets[-1]) + docstore.offsets.nbytes
+        else:
+            text_bytes = sum(len(doc.page_content) for doc in docstore._dict.values())
+        return vector_bytes + text_bytes
+    except (AttributeError, TypeError):
+        return 0
+
+class PipelineCache:
+    def __init__(
+        self,
+        loader: Callable[[str], Any] = None,
+        max_entries: int = None,
+        max_bytes: int = None,
+        ttl_seconds: float = None
+        ):
+        """LRU cache of per-user QA pipelines, bounded by count, estimated index memory and idle time.
+
+        The source document of each user is remembered after eviction, so the pipeline can be
+        rebuilt lazily from the on-disk index store the next time the user chats.
+
+        Args:
+            loader (Callable[[str], Any], optional): Rebuilds a pipeline from its source file path.
+            max_entries (int, optional): Maximum resident pipelines. Defaults to env `QA_PIPELINE_MAX_ENTRIES` or 32.
+            max_bytes (int, optional): Maximum estimated index bytes. Defaults to env `QA_PIPELINE_MAX_BYTES` or 1 GiB.
+            ttl_seconds (float, optional): Idle time before a pipeline is evicted.
+            Defaults to env `QA_PIPELINE_TTL_SECONDS` or 3600.
+        """
+        self.loader = loader
+        self.max_entries = max_entries or int(os.getenv("QA_PIPELINE_MAX_ENTRIES", 32))
+        self.max_bytes = max_bytes or int(os.getenv("QA_PIPELINE_MAX_BYTES", 1024 ** 3))
+        self.ttl_seconds = ttl_seconds or float(os.getenv("QA_PIPELINE_TTL_SECONDS", 3600))
+        self._entries = OrderedDict()  # user_id -> (pipeline, size_bytes, last_access)
+        self._sources = {}  # user_id -> source file path
+        self._lock = threading.Lock()
+        # Locks of the pipelines being reloaded, dropped once no thread holds on to them
+        self._load_locks = weakref.WeakValueDictionary()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, user_id: str) -> bool:
+        return user_id in self._entries
+
+    def __setitem__(self, user_id: str, pipeline: Any):
+        self.put(user_id, pipeline)
+
+    def __getitem__(self, user_id: str) -> Any:
+        pipeline = self.get(user_id)
+        if pipeline is None:
+            raise KeyError(user_id)
+        return pipeline
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries.values())
+
+    def put(self, user_id: str, pipeline: Any, source: str = None):
+        """Add or replace the pipeline of a user.
+
+        Args:
+            user_id (str): User ID.
+            pipeline (Any): QA pipeline of the user.
+            source (str, optional): File path the pipeline can be rebuilt from.
+        """
+        size = estimate_pipeline_bytes(pipeline)
+        with self._lock:
+            if source is not None:
+                self._sources[user_id] = source
+            self._entries[user_id] = (pipeline, size, time.time())
+            self._entries.move_to_end(user_id)
+            self._evict(keep=user_id)
+
+    def set_source(self, user_id: str, source: str):
+        """Remember the file path a user's pipeline can be rebuilt from, without loading it."""
+        with self._lock:
+            self._sources[user_id] = source
+
+    def get(self, user_id: str, default: Any = None) -> Any:
+        """Get the pipeline of a user, reloading it if it was evicted.
+
+        Args:
+            user_id (str): User ID.
+            default (Any, optional): Returned if the user has no pipeline. Defaults to None.
+        """
+        with self._lock:
+            self._evict()
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries[user_id] = (entry[0], entry[1], time.time())
+                self._entries.move_to_end(user_id)
+                return entry[0]
+            source = self._sources.get(user_id)
+            if source is None or self.loader is None:
+                return default
+            load_lock = self._load_locks.setdefault(user_id, threading.Lock())
+
+        # Rebuild outside of the cache lock, once per user
+        with load_lock:
+            with self._lock:
+                entry = self._entries.get(user_id)
+            if entry is not None:
+                return entry[0]
+            logger.info(f"Reloading evicted QA pipeline of user {user_id} from {source}")
+            pipeline = self.loader(source)
+            if pipeline is None:
+                return default
+            self.put(user_id, pipeline)
+            return pipeline
+
+    def pop(self, user_id: str, default: Any = None) -> Any:
+        """Remove the pipeline and the source of a user."""
+        with self._lock:
+            self._sources.pop(user_id, None)
+            entry = self._entries.pop(user_id, None)
+            self._update_metrics()
+        return default if entry is None else entry[0]
+
+    def _evict(self, keep: str = None):
+        """Drop idle pipelines, then least recently used ones until within limits."""
+        now = time.time()
+        for user_id in [u for u, (_, _, last_access) in self._entries.items() if now - last_access > self.ttl_seconds]:
+            if user_id != keep:
+                logger.info(f"Evicting idle QA pipeline of user {user_id}")
+                del self._entries[user_id]
+
+        total_bytes = self.total_bytes
+        for user_id in list(self._entries):
+            if len(self._entries) <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            if user_id == keep:
+                continue
+            logger.info(f"Evicting QA pipeline of user {user_id}")
+            total_bytes -= self._entries.pop(user_id)[1]
+        self._update_metrics()
+
+    def _update_metrics(self):
+        RESIDENT_PIPELINES.set(len(self._entries))
+        RESIDENT_INDEX_BYTES.set(self.total_bytes)
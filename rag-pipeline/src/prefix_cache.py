@@ -0,0 +1,103 @@
+import os
+import copy
+import threading
+from collections import OrderedDict
+from utils import logger, PREFIX_CACHE_HITS, PREFIX_CACHE_MISSES, PREFILL_TOKENS_REUSED
+
+class PrefixCache:
+    def __init__(self, max_entries: int = None, max_tokens: int = None):
+        """LRU cache of past key values, keyed by the token ids of a prompt prefix.
+
+        Generating from a prompt whose prefix is cached only prefills the remaining tokens.
+        The cache is bounded by number of entries and by the total number of cached tokens,
+        which is proportional to the memory held by the key/value tensors.
+
+        Args:
+            max_entries (int, optional): Maximum cached prefixes. Defaults to env `PREFIX_CACHE_MAX_ENTRIES` or 32.
+            max_tokens (int, optional): Maximum cached tokens over all prefixes, 0 disables the cache.
+            Defaults to env `PREFIX_CACHE_MAX_TOKENS` or 8192.
+        """
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv("PREFIX_CACHE_MAX_ENTRIES", 32))
+        self.max_tokens = max_tokens if max_tokens is not None else int(os.getenv("PREFIX_CACHE_MAX_TOKENS", 8192))
+        self._entries = OrderedDict()  # (model_key, token ids) -> DynamicCache
+        self._num_tokens = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_tokens > 0
+
+    @property
+    def num_tokens(self) -> int:
+        return self._num_tokens
+
+    def lookup(self, model_key, input_ids: list, prefix_lengths: list) -> tuple:
+        """Find the longest cached prefix of a prompt.
+
+        Args:
+            model_key: Identifies the model the key/value tensors were computed with.
+            input_ids (list): Token ids of the prompt.
+            prefix_lengths (list): Candidate prefix lengths, in tokens.
+
+        Returns:
+            tuple: (prefix length, copy of its DynamicCache), or (0, None) on a miss.
+        """
+        with self._lock:
+            for length in sorted(prefix_lengths, reverse=True):
+                # At least one token has to be left to prefill
+                if not 0 < length < len(input_ids):
+                    continue
+                key = (model_key, tuple(input_ids[:length]))
+                cache = self._entries.get(key)
+                if cache is not None:
+                    self._entries.move_to_end(key)
+                    PREFIX_CACHE_HITS.inc()
+                    PREFILL_TOKENS_REUSED.inc(length)
+                    # Generation appends to the cache in place, so hand out a copy
+                    return length, copy.deepcopy(cache)
+        PREFIX_CACHE_MISSES.inc()
+        return 0, None
+
+    def store(self, model_key, input_ids: list, prefix_lengths: list, past_key_values):
+        """Cache the past key values of several prefixes of a prompt.
+
+        Args:
+            model_key: Identifies the model the key/value tensors were computed with.
+            input_ids (list): Token ids of the prompt.
+            prefix_lengths (list): Prefix lengths to cache, in tokens.
+            past_key_values: Key/value cache covering at least the longest prefix. It is cropped in place.
+        """
+        if not self.enabled:
+            return
+        from transformers import DynamicCache
+        if not isinstance(past_key_values, DynamicCache):
+            past_key_values = DynamicCache.from_legacy_cache(past_key_values)
+        for length in sorted(set(prefix_lengths), reverse=True):
+            if not 0 < length <= min(len(input_ids), self.max_tokens):
+                continue
+            key = (model_key, tuple(input_ids[:length]))
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    continue
+            past_key_values.crop(length)
+            entry = copy.deepcopy(past_key_values)
+            with self._lock:
+                if key not in self._entries:
+                    self._entries[key] = entry
+                    self._num_tokens += length
+                    self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._num_tokens = 0
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_entries or self._num_tokens > self.max_tokens):
+            (_, token_ids), _ = self._entries.popitem(last=False)
+            self._num_tokens -= len(token_ids)
+            logger.debug(f"Evicted a cached prefix of {len(token_ids)} tokens")
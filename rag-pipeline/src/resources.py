@@ -0,0 +1,166 @@
+import os
+import threading
+from typing import TYPE_CHECKING
+from model_setup import load_model
+from embedding_cache import EmbeddingCache
+from utils import get_hardware, get_model_dir, get_embedding_cache_dir, logger
+
+if TYPE_CHECKING:
+    # Imported on first use, transformers and sentence-transformers pull in torch
+    from transformers.modeling_utils import PreTrainedModel
+    from langchain_huggingface import HuggingFaceEmbeddings, HuggingFacePipeline
+    from langchain_core.prompts import PromptTemplate
+
+DEFAULT_MODEL_NAME = "Qwen/Qwen2.5-0.5B-Instruct"
+# Any sentence-transformers model name or local directory, e.g. a small stand-in model for load tests
+DEFAULT_EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+PROMPT_TEMPLATE = """Answer based on context:\n{context}\nQuestion: {question}\nAnswer:"""
+# Default answer length, requests may ask for less, see `generation_controls`
+GENERATION_KWARGS = {"repetition_penalty": 1.2, "max_new_tokens": int(os.getenv("MAX_NEW_TOKENS", 500))}
+
+class ResourceRegistry:
+    def __init__(self):
+        """Process-wide registry of the heavyweight objects shared by every user pipeline.
+
+        The tokenizer, embedding model, LLM and generation pipeline are created lazily on
+        first use and then reused, so building a per-user pipeline only costs a retriever.
+        """
+        self._lock = threading.RLock()
+        self.model = None
+        self.precision = None
+        self._tokenizers = {}
+        self._embeddings = {}
+        self._embedding_caches = {}
+        self._rerankers = {}
+        self._prompt = None
+
+    def get_model(self, model_name: str = DEFAULT_MODEL_NAME, local_dir: str = None) -> "PreTrainedModel":
+        """Get the shared LLM, loading it on first use with the precision set in `self.precision`.
+
+        Args:
+            model_name (str, optional): Model name on Hugging Face Hub. Defaults to "Qwen/Qwen2.5-0.5B-Instruct".
+            local_dir (str, optional): Local directory of the model. Defaults to `get_model_dir(model_name)`.
+        """
+        with self._lock:
+            if self.model is None:
+                self.model = load_model(
+                    model_name=model_name,
+                    local_dir=local_dir or get_model_dir(model_name),
+                    precision=self.precision
+                )
+            return self.model
+
+    def get_tokenizer(self, local_dir: str):
+        """Get the tokenizer saved in `local_dir`, loading it on first use.
+
+        Args:
+            local_dir (str): Directory of the local LLM model.
+        """
+        with self._lock:
+            if local_dir not in self._tokenizers:
+                logger.info(f"Loading tokenizer from {local_dir}...")
+                from transformers import AutoTokenizer
+                tokenizer = AutoTokenizer.from_pretrained(local_dir)
+                # Batched generation with a decoder-only model needs left padding
+                if tokenizer.pad_token is None:
+                    tokenizer.pad_token = tokenizer.eos_token
+                tokenizer.padding_side = "left"
+                self._tokenizers[local_dir] = tokenizer
+            return self._tokenizers[local_dir]
+
+    def get_embeddings(self, embedding_model_name: str = DEFAULT_EMBEDDING_MODEL_NAME) -> "HuggingFaceEmbeddings":
+        """Get an embedding model, loading it on first use.
+
+        Args:
+            embedding_model_name (str, optional): Embedding model that maps text to vectors.
+            Defaults to env `EMBEDDING_MODEL` or "sentence-transformers/all-MiniLM-L6-v2".
+        """
+        with self._lock:
+            if embedding_model_name not in self._embeddings:
+                from langchain_huggingface import HuggingFaceEmbeddings
+                logger.info(f"Loading embedding model {embedding_model_name}...")
+                self._embeddings[embedding_model_name] = HuggingFaceEmbeddings(
+                    model_name=embedding_model_name,
+                    model_kwargs={"device": get_hardware()}
+                )
+            return self._embeddings[embedding_model_name]
+
+    def get_embedding_cache(self, embedding_model_name: str = DEFAULT_EMBEDDING_MODEL_NAME) -> EmbeddingCache:
+        """Get the on-disk chunk embedding cache of an embedding model.
+
+        Args:
+            embedding_model_name (str, optional): Embedding model name.
+            Defaults to env `EMBEDDING_MODEL` or "sentence-transformers/all-MiniLM-L6-v2".
+        """
+        with self._lock:
+            if embedding_model_name not in self._embedding_caches:
+                self._embedding_caches[embedding_model_name] = EmbeddingCache(
+                    get_embedding_cache_dir(), embedding_model_name
+                )
+            return self._embedding_caches[embedding_model_name]
+
+    def get_reranker(self, reranker_model_name: str):
+        """Get a cross-encoder that scores (question, chunk) pairs, loading it on first use.
+
+        Args:
+            reranker_model_name (str): Cross-encoder model name, e.g. "cross-encoder/ms-marco-MiniLM-L-6-v2".
+        """
+        with self._lock:
+            if reranker_model_name not in self._rerankers:
+                # Only imported when reranking is enabled
+                from sentence_transformers import CrossEncoder
+                logger.info(f"Loading reranker {reranker_model_name}...")
+                self._rerankers[reranker_model_name] = CrossEncoder(reranker_model_name, device=get_hardware())
+            return self._rerankers[reranker_model_name]
+
+    def get_llm(self, local_dir: str, model: "PreTrainedModel" = None) -> "HuggingFacePipeline":
+        """Get the LangChain wrapper of the text-generation pipeline.
+
+        Args:
+            local_dir (str): Directory of the local LLM model.
+            model (PreTrainedModel, optional): Pre-loaded LLM. Defaults to the shared model.
+        """
+        with self._lock:
+            if model is None:
+                model = self.get_model(local_dir=local_dir)
+            # Wrappers live on their model, so they go away with it. A registry keyed on `id(model)`
+            # could hand a new model the wrapper of a collected one that had the same id.
+            llms = vars(model).setdefault("_rag_llms", {})
+            if local_dir not in llms:
+                from transformers.pipelines import pipeline
+                from langchain_huggingface import HuggingFacePipeline
+                pipe = pipeline(
+                    "text-generation",
+                    model=model,
+                    tokenizer=self.get_tokenizer(local_dir),
+                    # Only the answer is decoded and returned, not the prompt
+                    return_full_text=False,
+                    **GENERATION_KWARGS
+                )
+                llms[local_dir] = HuggingFacePipeline(pipeline=pipe)
+            return llms[local_dir]
+
+    def get_prompt(self) -> "PromptTemplate":
+        """Get the shared RAG prompt template."""
+        with self._lock:
+            if self._prompt is None:
+                from langchain_core.prompts import PromptTemplate
+                self._prompt = PromptTemplate(
+                    input_variables=["context", "question"],
+                    template=PROMPT_TEMPLATE
+                )
+            return self._prompt
+
+    def warm_up(self, local_dir: str, embedding_model_name: str = DEFAULT_EMBEDDING_MODEL_NAME):
+        """Eagerly create every shared resource so that the first upload is fast.
+
+        Args:
+            local_dir (str): Directory of the local LLM model.
+            embedding_model_name (str, optional): Embedding model to load.
+        """
+        self.get_llm(local_dir)
+        self.get_embeddings(embedding_model_name)
+        self.get_prompt()
+
+# Shared resources of this process
+resources = ResourceRegistry()
@@ -0,0 +1,125 @@
+import os
+import time
+from utils import SPECULATIVE_DRAFT_TOKENS, SPECULATIVE_ACCEPTED_TOKENS, SPECULATIVE_ACCEPTANCE_RATE
+
+PROMPT_LOOKUP = "prompt_lookup"
+
+def speculative_decoding_enabled() -> bool:
+    """Whether answers are generated with prompt lookup decoding, opted in with env `SPECULATIVE_DECODING`."""
+    return os.getenv("SPECULATIVE_DECODING", "off").lower() == PROMPT_LOOKUP
+
+def find_draft(tokens: list, num_draft_tokens: int, max_ngram: int = 3) -> list:
+    """Propose the tokens that followed the latest earlier occurrence of the last n-gram.
+
+    RAG answers often copy spans of the retrieved context, so the tokens following a match of
+    the end of the sequence in the prompt are likely to be generated next. Longer n-grams are
+    tried first.
+
+    Args:
+        tokens (list): Token ids of the prompt and of the answer so far.
+        num_draft_tokens (int): Maximum number of tokens to propose.
+        max_ngram (int, optional): Longest n-gram to match. Defaults to 3.
+
+    Returns:
+        list: Proposed token ids, empty if the end of the sequence does not occur earlier.
+    """
+    for n in range(min(max_ngram, len(tokens) - 1), 0, -1):
+        ngram = tokens[-n:]
+        # Latest match first, it continues the part of the context the answer is copying
+        for start in range(len(tokens) - n - 1, -1, -1):
+            if tokens[start:start + n] == ngram:
+                return tokens[start + n:start + n + num_draft_tokens]
+    return []
+
+def penalize_repetitions(logits, tokens: list, penalty: float):
+    """Apply the repetition penalty of `transformers.RepetitionPenaltyLogitsProcessor` to one position."""
+    if penalty == 1.0:
+        return logits
+    import torch
+    ids = torch.tensor(sorted(set(tokens)), device=logits.device)
+    scores = logits[ids]
+    logits = logits.clone()
+    logits[ids] = torch.where(scores < 0, scores * penalty, scores / penalty)
+    return logits
+
+def prompt_lookup_generate(model, input_ids: list, max_new_tokens: int, eos_token_id=None, past_key_values=None,
+                           repetition_penalty: float = 1.0, num_draft_tokens: int = None, max_ngram: int = None,
+                           streamer=None, stopping_criteria=None) -> tuple:
+    """Greedy generation verifying draft tokens copied from the prompt in one forward pass.
+
+    Each step drafts up to `num_draft_tokens` tokens with `find_draft` and runs the model once
+    over them. Drafts are accepted up to the first token that greedy decoding would not have
+    picked, and that pick is appended too, so a step yields at least one token and the answer
+    is the one greedy decoding gives, up to floating point ties. The key/value cache is cropped
+    back to the accepted tokens after each step.
+
+    Args:
+        model: Local LLM model.
+        input_ids (list): Token ids of the prompt.
+        max_new_tokens (int): Maximum number of tokens to generate.
+        eos_token_id (int or list, optional): Token ids ending the answer.
+        past_key_values (DynamicCache, optional): Cache of a prefix of the prompt, e.g. from the prefix cache.
+        repetition_penalty (float, optional): Penalty of tokens already in the sequence. Defaults to 1.0.
+        num_draft_tokens (int, optional): Maximum draft length. Defaults to env `PROMPT_LOOKUP_NUM_TOKENS` or 10.
+        max_ngram (int, optional): Longest n-gram matched in the sequence. Defaults to env `PROMPT_LOOKUP_MAX_NGRAM` or 3.
+        streamer (BaseStreamer, optional): Receives the prompt, then the tokens as they are accepted.
+        stopping_criteria (Callable, optional): Called like a `generate` stopping criterion after each
+        step, e.g. a `generation_controls.StopCriteria` ending the answer at a stop sequence.
+
+    Returns:
+        tuple: Token ids of the answer, the key/value cache of the sequence and generation statistics
+        (`forward_passes`, `draft_tokens`, `accepted_tokens`, `tokens_per_second`).
+    """
+    import torch
+    from transformers import DynamicCache
+
+    num_draft_tokens = num_draft_tokens or int(os.getenv("PROMPT_LOOKUP_NUM_TOKENS", 10))
+    max_ngram = max_ngram or int(os.getenv("PROMPT_LOOKUP_MAX_NGRAM", 3))
+    eos_token_ids = set([eos_token_id] if isinstance(eos_token_id, int) else eos_token_id or [])
+    cache = past_key_values if past_key_values is not None else DynamicCache()
+    if streamer is not None:
+        streamer.put(torch.tensor([input_ids]))
+
+    tokens = list(input_ids)
+    stats = {"forward_passes": 0, "draft_tokens": 0, "accepted_tokens": 0}
+    start_time = time.perf_counter()
+    finished = False
+    with torch.no_grad():
+        while not finished and len(tokens) - len(input_ids) < max_new_tokens:
+            # The last draft token is only worth verifying if one more token may follow it
+            remaining = max_new_tokens - (len(tokens) - len(input_ids))
+            draft = find_draft(tokens, min(num_draft_tokens, remaining - 1), max_ngram)
+            cached_length = cache.get_seq_length()
+            step_ids = torch.tensor([tokens[cached_length:] + draft], device=model.device)
+            logits = model(input_ids=step_ids, past_key_values=cache, use_cache=True).logits[0, -len(draft) - 1:]
+            stats["forward_passes"] += 1
+            stats["draft_tokens"] += len(draft)
+
+            new_tokens = []
+            for position in range(len(draft) + 1):
+                next_token = int(penalize_repetitions(logits[position], tokens + new_tokens, repetition_penalty).argmax())
+                new_tokens.append(next_token)
+                if next_token in eos_token_ids or len(tokens) + len(new_tokens) - len(input_ids) >= max_new_tokens:
+                    finished = next_token in eos_token_ids
+                    break
+                if position == len(draft) or next_token != draft[position]:
+                    break
+            stats["accepted_tokens"] += len(new_tokens) - 1
+            tokens.extend(new_tokens)
+            # The last token is not in the cache yet, nor are the rejected drafts
+            cache.crop(len(tokens) - 1)
+            if streamer is not None:
+                streamer.put(torch.tensor(new_tokens))
+            if stopping_criteria is not None and not finished:
+                finished = bool(stopping_criteria(torch.tensor([tokens]), None)[0])
+    if streamer is not None:
+        streamer.end()
+
+    elapsed = time.perf_counter() - start_time
+    answer_ids = tokens[len(input_ids):]
+    stats["tokens_per_second"] = len(answer_ids) / elapsed if elapsed > 0 else 0.0
+    SPECULATIVE_DRAFT_TOKENS.inc(stats["draft_tokens"])
+    SPECULATIVE_ACCEPTED_TOKENS.inc(stats["accepted_tokens"])
+    if stats["draft_tokens"]:
+        SPECULATIVE_ACCEPTANCE_RATE.observe(stats["accepted_tokens"] / stats["draft_tokens"])
+    return answer_ids, cache, stats
@@ -1,33 +1,55 @@
 import os
 import re
-import torch
 import psutil
 import time
 import logging
-from huggingface_hub import snapshot_download
-from transformers import AutoModelForCausalLM
+import threading
+from contextlib import contextmanager
 from prometheus_client import Counter, Histogram, Gauge
 from opentelemetry import trace
-from opentelemetry.exporter.jaeger.thrift import JaegerExporter
-from opentelemetry.sdk.resources import SERVICE_NAME, Resource
-from opentelemetry.sdk.trace import TracerProvider
-from opentelemetry.sdk.trace.export import BatchSpanProcessor
-from opentelemetry.trace import get_tracer_provider, set_tracer_provider
-
-# Initialize OpenTelemetry
-set_tracer_provider(
-    TracerProvider(resource=Resource.create({SERVICE_NAME: "rag-pipeline-service"}))
-)
-tracer = get_tracer_provider().get_tracer("rag-pipeline", "0.1.0")
-jaeger_exporter = JaegerExporter(
-    collector_endpoint="http://jaeger:14268/api/traces"
-)
-span_processor = BatchSpanProcessor(jaeger_exporter)
-get_tracer_provider().add_span_processor(span_processor)
+
+# Spans go to a no-op tracer until `setup_telemetry` installs the exporting provider
+tracer = trace.get_tracer("rag-pipeline", "0.1.0")
+_telemetry_lock = threading.Lock()
+_telemetry_started = False
+
+def setup_telemetry(service_name: str = "rag-pipeline-service", collector_endpoint: str = None) -> bool:
+    """Export the spans of this process to Jaeger.
+
+    Called when a server or worker process starts rather than on import, so that tests,
+    scripts and worker spawns do not load the SDK or start an exporter thread. Only the
+    first call of a process has an effect, and none if env `DISABLE_TRACING` is "true".
+
+    Args:
+        service_name (str, optional): Service name of the spans. Defaults to "rag-pipeline-service".
+        collector_endpoint (str, optional): Jaeger collector. Defaults to env `JAEGER_COLLECTOR_ENDPOINT`
+        or "http://jaeger:14268/api/traces".
+
+    Returns:
+        bool: Whether this call started the exporter.
+    """
+    global _telemetry_started
+    with _telemetry_lock:
+        if _telemetry_started or os.getenv("DISABLE_TRACING", "false").lower() == "true":
+            return False
+        from opentelemetry.exporter.jaeger.thrift import JaegerExporter
+        from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+
+        provider = TracerProvider(resource=Resource.create({SERVICE_NAME: service_name}))
+        jaeger_exporter = JaegerExporter(
+            collector_endpoint=collector_endpoint or os.getenv("JAEGER_COLLECTOR_ENDPOINT", "http://jaeger:14268/api/traces")
+        )
+        provider.add_span_processor(BatchSpanProcessor(jaeger_exporter))
+        trace.set_tracer_provider(provider)
+        _telemetry_started = True
+        return True
 
 def get_hardware() -> str:
     """Get hardware available for inference.
     """
+    import torch
     hardware = "cpu"
     if torch.cuda.is_available():
         hardware = "cuda"
@@ -65,15 +87,138 @@ def get_doc_dir() -> str:
     doc_dir = os.path.join(get_root_dir(), "rag-pipeline/examples/example.pdf")
     return doc_dir
 
+def get_embedding_cache_dir() -> str:
+    """Get root directory of the cached chunk embeddings.
+    """
+    embedding_cache_dir = os.path.join(get_root_dir(), "rag-pipeline/embedding_cache")
+    return embedding_cache_dir
+
+def get_corpus_dir() -> str:
+    """Get root directory of the per-user document corpora.
+    """
+    corpus_dir = os.path.join(get_root_dir(), "rag-pipeline/corpora")
+    return corpus_dir
+
+def get_vector_store_dir() -> str:
+    """Get root directory of the cached vector stores.
+    """
+    vector_store_dir = os.path.join(get_root_dir(), "rag-pipeline/vector_store")
+    return vector_store_dir
+
 # Prometheus metrics
 REQUEST_COUNT = Counter("chatbot_requests_total", "Total requests to chatbot")
 LATENCY = Histogram("chatbot_request_latency_seconds", "Chatbot request latency")
+TIME_TO_FIRST_TOKEN = Histogram("chatbot_time_to_first_token_seconds", "Time until the first streamed token of a chat answer")
+BATCH_SIZE = Histogram("chatbot_batch_size", "Number of chat requests per batched generation", 
+                       buckets=(1, 2, 4, 8, 16, 32))
+BATCH_WAIT_TIME = Histogram("chatbot_batch_wait_seconds", "Time chat requests wait in the batching queue",
+                            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+QUEUE_DEPTH = Gauge("chatbot_inference_queue_depth", "Chat requests waiting for an inference slot")
+QUEUE_REJECTED = Counter("chatbot_inference_rejected_total", "Chat requests rejected with 429 because the inference queue was full")
+EMBEDDING_THROUGHPUT = Histogram("chatbot_embedding_throughput_chunks_per_second", "Embedding throughput of ingested documents",
+                                 buckets=(1, 5, 10, 25, 50, 100, 250, 500, 1000))
+EMBEDDING_CACHE_HITS = Counter("chatbot_embedding_cache_hits_total", "Chunks whose embedding was found in the embedding cache")
+EMBEDDING_CACHE_MISSES = Counter("chatbot_embedding_cache_misses_total", "Chunks that had to be embedded")
+ANSWER_CACHE_HITS = Counter("chatbot_answer_cache_hits_total", "Chat questions answered from the semantic answer cache")
+ANSWER_CACHE_MISSES = Counter("chatbot_answer_cache_misses_total", "Chat questions that had to be answered by the LLM")
+PREFIX_CACHE_HITS = Counter("chatbot_prefix_cache_hits_total", "Generations that reused cached past key values of their prompt prefix")
+PREFIX_CACHE_MISSES = Counter("chatbot_prefix_cache_misses_total", "Generations that prefilled their whole prompt")
+PREFILL_TOKENS_REUSED = Counter("chatbot_prefill_tokens_reused_total", "Prompt tokens whose prefill was skipped thanks to the prefix cache")
+RETRIEVAL_STAGE_LATENCY = Histogram("chatbot_retrieval_stage_seconds", "Latency of each retrieval stage: dense, bm25, fusion and rerank",
+                                    ["stage"], buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+CONTEXT_TOKENS = Histogram("chatbot_context_tokens", "Tokens of retrieved context packed into each prompt",
+                           buckets=(0, 64, 128, 256, 384, 512, 768, 1024, 2048))
+SPECULATIVE_DRAFT_TOKENS = Counter("chatbot_speculative_draft_tokens_total", "Draft tokens proposed by prompt lookup decoding")
+SPECULATIVE_ACCEPTED_TOKENS = Counter("chatbot_speculative_accepted_tokens_total", "Draft tokens accepted by the LLM in prompt lookup decoding")
+SPECULATIVE_ACCEPTANCE_RATE = Histogram("chatbot_speculative_acceptance_rate", "Fraction of the draft tokens of a generation that were accepted",
+                                        buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0))
+GENERATION_TOKENS_PER_SECOND = Histogram("chatbot_generation_tokens_per_second", "Decode speed of generations after their prefill, over every sequence of a batch",
+                                         ["decoding"], buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200))
+CHAT_STAGE_LATENCY = Histogram("chatbot_chat_stage_seconds",
+                               "Latency of each stage of a chat request: embed_query, retrieve, pack_context, tokenize, prefill, decode, detokenize and postprocess",
+                               ["stage"], buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+UPLOAD_STAGE_LATENCY = Histogram("chatbot_upload_stage_seconds",
+                                 "Latency of each stage of a PDF upload: save, hash, extract, embed, index, corpus and load",
+                                 ["stage"], buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0))
+PROMPT_TOKENS = Counter("chatbot_prompt_tokens_total", "Prompt tokens given to the LLM, including those whose prefill was cached")
+GENERATED_TOKENS = Counter("chatbot_generated_tokens_total", "Tokens generated by the LLM")
 MODEL_LOAD_TIME = Histogram("chatbot_model_load_time_seconds", "Time to load the local LLM in secods")
+RESIDENT_PIPELINES = Gauge("chatbot_resident_pipelines", "Number of per-user QA pipelines held in memory")
+RESIDENT_INDEX_BYTES = Gauge("chatbot_resident_index_bytes", "Estimated bytes of the vector indexes held in memory")
 MEMORY_USAGE = Gauge("chatbot_memory_usage_bytes", "Memory usage in bytes for chatbot process")
 
 # Initialize logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+
+@contextmanager
+def timed_stage(histogram: Histogram, stage: str, span_name: str = None):
+    """Trace a stage as a child span and record its latency in a histogram labelled by stage.
+
+    Args:
+        histogram (Histogram): Histogram with a "stage" label, e.g. `CHAT_STAGE_LATENCY`.
+        stage (str): Stage label.
+        span_name (str, optional): Name of the span. Defaults to the stage label.
+    """
+    with tracer.start_as_current_span(span_name or stage):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            histogram.labels(stage=stage).observe(time.perf_counter() - start_time)
+
+# Serializes changes to the process-wide torch thread count, see `set_torch_threads` and `torch_threads`
+_torch_threads_lock = threading.RLock()
+
+def set_torch_threads(threads: int):
+    """Set the torch intra-op threads, waiting for any block run with `torch_threads` to restore its count first."""
+    import torch
+    with _torch_threads_lock:
+        torch.set_num_threads(threads)
+
+@contextmanager
+def torch_threads(threads: int = None):
+    """Run a block with `threads` torch intra-op threads, then restore the previous count.
+
+    Torch applies the count to the calling thread and to threads started later, so leaving it
+    set would also change e.g. LLM generation in the same process. The count is held for the
+    whole block, so another thread's `set_torch_threads` cannot change it midway or be undone
+    by the restore. Does nothing if `threads` is unset.
+    """
+    if not threads:
+        yield
+        return
+    import torch
+    with _torch_threads_lock:
+        previous = torch.get_num_threads()
+        torch.set_num_threads(threads)
+        try:
+            yield
+        finally:
+            torch.set_num_threads(previous)
+
+class StageTimer:
+    def __init__(self, histogram: Histogram):
+        """Sum the time spent in stages that alternate, e.g. per batch of chunks, and record each total once.
+
+        Args:
+            histogram (Histogram): Histogram with a "stage" label.
+        """
+        self.histogram = histogram
+        self.seconds = {}
+
+    @contextmanager
+    def stage(self, stage: str):
+        with tracer.start_as_current_span(stage):
+            start_time = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start_time
+
+    def observe(self):
+        for stage, seconds in self.seconds.items():
+            self.histogram.labels(stage=stage).observe(seconds)
         
 def monitor_memory_usage(interval: int=5):
     """Get memory usage of the LLM.
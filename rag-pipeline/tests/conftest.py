@@ -0,0 +1,18 @@
+import pytest
+from stand_in import build_stand_in_tokenizer, build_stand_in_model
+
+@pytest.fixture(scope="session")
+def stand_in_tokenizer():
+    return build_stand_in_tokenizer()
+
+@pytest.fixture(scope="session")
+def stand_in_model(stand_in_tokenizer):
+    return build_stand_in_model(len(stand_in_tokenizer))
+
+@pytest.fixture(scope="session")
+def stand_in_model_dir(tmp_path_factory, stand_in_tokenizer, stand_in_model):
+    """Directory of the stand-in tokenizer and model, loadable like a downloaded LLM."""
+    local_dir = str(tmp_path_factory.mktemp("stand-in"))
+    stand_in_tokenizer.save_pretrained(local_dir)
+    stand_in_model.save_pretrained(local_dir)
+    return local_dir
@@ -0,0 +1,42 @@
+"""Tiny stand-in tokenizer and LLM, so that tests and benchmarks do not download Qwen."""
+import string
+
+def build_stand_in_tokenizer():
+    """Character level tokenizer, every printable character is a token.
+
+    `<unk>` also pads and ends sequences.
+    """
+    from tokenizers import Tokenizer, Regex, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    vocab = {char: i for i, char in enumerate(["<unk>"] + list(string.printable))}
+    backend = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    backend.pre_tokenizer = pre_tokenizers.Split(Regex("."), behavior="isolated")
+    return PreTrainedTokenizerFast(tokenizer_object=backend, unk_token="<unk>", pad_token="<unk>", eos_token="<unk>")
+
+def build_stand_in_model(vocab_size: int, hidden_size: int = 32, intermediate_size: int = 64, seed: int = 0):
+    """Randomly initialized two layer Qwen2 model, the same for a given seed.
+
+    Args:
+        vocab_size (int): Vocabulary size, e.g. the length of `build_stand_in_tokenizer()`.
+        hidden_size (int, optional): Hidden size. Defaults to 32.
+        intermediate_size (int, optional): Size of the MLP layers. Defaults to 64.
+        seed (int, optional): Seed of the weights. Defaults to 0.
+
+    Returns:
+        Qwen2ForCausalLM: The model, in eval mode.
+    """
+    import torch
+    from transformers import Qwen2Config, Qwen2ForCausalLM
+    torch.manual_seed(seed)
+    config = Qwen2Config(
+        vocab_size=vocab_size, hidden_size=hidden_size, intermediate_size=intermediate_size, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=2, max_position_embeddings=4096
+    )
+    return Qwen2ForCausalLM(config).eval()
+
+def save_stand_in_model(local_dir: str, **kwargs) -> str:
+    """Save the stand-in tokenizer and a stand-in model built with `kwargs` in `local_dir`, and return it."""
+    tokenizer = build_stand_in_tokenizer()
+    tokenizer.save_pretrained(local_dir)
+    build_stand_in_model(len(tokenizer), **kwargs).save_pretrained(local_dir)
+    return local_dir
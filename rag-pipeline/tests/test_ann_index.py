@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+import faiss
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from ann_index import choose_index_type, convert_index, default_params
+from index_store import IndexStore
+from data_preparation import get_vector_store
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    model_name: str = "fake-model"
+
+@pytest.fixture
+def flat_index():
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((2000, 16)).astype(np.float32)
+    index = faiss.IndexFlatL2(16)
+    index.add(vectors)
+    return index
+
+def test_choose_index_type(monkeypatch):
+    assert choose_index_type(100) == "flat"
+    assert choose_index_type(50000) == "hnsw"
+    assert choose_index_type(500000) == "ivf"
+    monkeypatch.setenv("VECTOR_INDEX_PQ", "true")
+    assert choose_index_type(500000) == "ivf-pq"
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", "hnsw")
+    assert choose_index_type(100) == "hnsw"
+
+@pytest.mark.parametrize("index_type", ["hnsw", "ivf", "ivf-pq"])
+def test_convert_index_recall(flat_index, index_type):
+    index, params = convert_index(flat_index, index_type)
+    assert params["type"] == index_type
+    assert index.ntotal == flat_index.ntotal
+
+    # Vectors keep their position, so the docstore mapping stays valid
+    queries = flat_index.reconstruct_n(0, 50)
+    _, ids = index.search(queries, 1)
+    if index_type != "ivf-pq":
+        assert (ids[:, 0] == np.arange(50)).mean() > 0.9
+
+def test_pq_params():
+    params = default_params("ivf-pq", 100000, 384)
+    assert 384 % params["pq_m"] == 0
+    assert params["nlist"] <= 100000 // 40
+
+def test_params_persisted(tmp_path, monkeypatch):
+    monkeypatch.setenv("VECTOR_INDEX_NPROBE", "3")
+    embeddings = FakeEmbeddings(size=8)
+    chunks = [f"chunk number {i}" for i in range(200)]
+    get_vector_store(chunks, embeddings, str(tmp_path), cache_key="abc", index_type="ivf")
+
+    store = IndexStore(str(tmp_path))
+    assert store.get_params("abc")["nprobe"] == 3
+    vector_store = store.get("abc", embeddings)
+    assert faiss.extract_index_ivf(vector_store.index).nprobe == 3
+    assert vector_store.similarity_search("chunk number 7", k=1)[0].page_content == "chunk number 7"
+
+def test_choose_index_type_supports_removal():
+    assert choose_index_type(50000, supports_removal=True) == "ivf"
+    assert choose_index_type(100, supports_removal=True) == "flat"
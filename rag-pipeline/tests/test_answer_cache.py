@@ -0,0 +1,31 @@
+from answer_cache import AnswerCache
+
+def test_similar_question_hits():
+    cache = AnswerCache(threshold=0.9)
+    cache.put("doc", "What is the capital of France?", [1.0, 0.0, 0.1], "Paris")
+
+    assert cache.get("doc", [2.0, 0.0, 0.25]) == "Paris"
+    # Dissimilar question, or same question about another document
+    assert cache.get("doc", [0.0, 1.0, 0.0]) is None
+    assert cache.get("other_doc", [1.0, 0.0, 0.1]) is None
+
+def test_same_question_replaces_answer():
+    cache = AnswerCache(threshold=0.9)
+    cache.put("doc", "question", [1.0, 0.0], "old answer")
+    cache.put("doc", "question", [1.0, 0.0], "new answer")
+
+    assert len(cache) == 1
+    assert cache.get("doc", [1.0, 0.0]) == "new answer"
+
+def test_lru_eviction():
+    cache = AnswerCache(threshold=0.99, max_entries=2)
+    cache.put("doc", "first", [1.0, 0.0, 0.0], "1")
+    cache.put("doc", "second", [0.0, 1.0, 0.0], "2")
+    # Use the oldest answer so that "second" becomes least recently used
+    assert cache.get("doc", [1.0, 0.0, 0.0]) == "1"
+    cache.put("other_doc", "third", [0.0, 0.0, 1.0], "3")
+
+    assert len(cache) == 2
+    assert cache.get("doc", [0.0, 1.0, 0.0]) is None
+    assert cache.get("doc", [1.0, 0.0, 0.0]) == "1"
+    assert cache.get("other_doc", [0.0, 0.0, 1.0]) == "3"
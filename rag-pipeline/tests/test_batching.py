@@ -0,0 +1,148 @@
+import time
+import threading
+import pytest
+from batching import BatchScheduler, QueueFullError
+from utils import QUEUE_DEPTH, QUEUE_REJECTED
+
+def test_single_request():
+    scheduler = BatchScheduler(lambda prompts, options: [p.upper() for p in prompts], max_batch_size=4, max_wait_ms=1)
+    assert scheduler.submit("hello").result(timeout=5) == "HELLO"
+
+def test_concurrent_requests_are_batched():
+    batch_sizes = []
+    def generate(prompts, options):
+        batch_sizes.append(len(prompts))
+        return [p + "!" for p in prompts]
+
+    scheduler = BatchScheduler(generate, max_batch_size=4, max_wait_ms=200)
+    futures = [scheduler.submit(f"q{i}") for i in range(4)]
+
+    assert [f.result(timeout=5) for f in futures] == ["q0!", "q1!", "q2!", "q3!"]
+    assert batch_sizes == [4]
+
+def test_max_batch_size():
+    batch_sizes = []
+    release = threading.Event()
+    def generate(prompts, options):
+        release.wait(timeout=5)
+        batch_sizes.append(len(prompts))
+        return prompts
+
+    scheduler = BatchScheduler(generate, max_batch_size=2, max_wait_ms=100)
+    futures = [scheduler.submit(f"q{i}") for i in range(5)]
+    release.set()
+
+    assert [f.result(timeout=5) for f in futures] == [f"q{i}" for i in range(5)]
+    assert max(batch_sizes) <= 2
+    assert sum(batch_sizes) == 5
+
+def test_generation_error():
+    def generate(prompts, options):
+        raise RuntimeError("generation failed")
+
+    scheduler = BatchScheduler(generate, max_batch_size=2, max_wait_ms=1)
+    with pytest.raises(RuntimeError):
+        scheduler.submit("hello").result(timeout=5)
+
+    # The scheduler keeps serving after a failed batch
+    scheduler.generate_fn = lambda prompts, options: prompts
+    assert scheduler.submit("again").result(timeout=5) == "again"
+
+def test_concurrent_batches():
+    running = []
+    release = threading.Event()
+    def generate(prompts, options):
+        running.append(prompts)
+        release.wait(timeout=5)
+        return prompts
+
+    # A second batch starts while the first one is still generating
+    scheduler = BatchScheduler(generate, max_batch_size=1, max_wait_ms=1, max_concurrent_batches=2)
+    futures = [scheduler.submit(f"q{i}") for i in range(2)]
+    deadline = time.time() + 5
+    while len(running) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert len(running) == 2
+    release.set()
+    assert [f.result(timeout=5) for f in futures] == ["q0", "q1"]
+
+def test_generation_options():
+    scheduler = BatchScheduler(lambda prompts, options: [(p, o) for p, o in zip(prompts, options)],
+                               max_batch_size=2, max_wait_ms=200)
+    futures = [scheduler.submit("q0", {"max_tokens": 8}), scheduler.submit("q1")]
+    # Options stay with their prompt, missing ones are empty
+    assert [f.result(timeout=5) for f in futures] == [("q0", {"max_tokens": 8}), ("q1", {})]
+
+def test_queue_full():
+    release = threading.Event()
+    def generate(prompts, options):
+        release.wait(timeout=5)
+        return prompts
+
+    scheduler = BatchScheduler(generate, max_batch_size=1, max_wait_ms=1, max_queue_size=2)
+    running = scheduler.submit("q0")
+    deadline = time.time() + 5
+    while scheduler._size and time.time() < deadline:
+        time.sleep(0.01)
+    # One prompt is generating, two more may wait
+    waiting = [scheduler.submit("q1"), scheduler.submit("q2")]
+    rejected_before = QUEUE_REJECTED._value.get()
+    with pytest.raises(QueueFullError) as error:
+        scheduler.submit("q3")
+    assert error.value.retry_after >= 1
+    assert QUEUE_REJECTED._value.get() == rejected_before + 1
+    assert QUEUE_DEPTH._value.get() == 2
+    release.set()
+    assert [f.result(timeout=5) for f in [running] + waiting] == ["q0", "q1", "q2"]
+
+def test_fair_scheduling():
+    release = threading.Event()
+    batches = []
+    def generate(prompts, options):
+        release.wait(timeout=5)
+        batches.append(prompts)
+        return prompts
+
+    scheduler = BatchScheduler(generate, max_batch_size=2, max_wait_ms=1, fair=True)
+    first = scheduler.submit("blocker", user_id="a")
+    deadline = time.time() + 5
+    while scheduler._size and time.time() < deadline:
+        time.sleep(0.01)
+    # A burst of one user does not hold back the next user
+    futures = [scheduler.submit(f"a{i}", user_id="a") for i in range(3)] + [scheduler.submit("b0", user_id="b")]
+    release.set()
+    for future in [first] + futures:
+        future.result(timeout=5)
+    assert batches[1] == ["a0", "b0"]
+
+def test_stream():
+    def stream(prompt, options, cancel):
+        yield from prompt.upper()
+
+    scheduler = BatchScheduler(lambda prompts, options: prompts, stream_fn=stream, max_wait_ms=1)
+    assert "".join(scheduler.stream("hello")) == "HELLO"
+    assert scheduler.submit("again").result(timeout=5) == "again"
+
+def test_stream_disconnect_stops_generation():
+    cancelled = threading.Event()
+    def stream(prompt, options, cancel):
+        while not cancel.wait(0.01):
+            yield "token"
+        cancelled.set()
+
+    scheduler = BatchScheduler(lambda prompts, options: prompts, stream_fn=stream, max_wait_ms=1)
+    tokens = scheduler.stream("hello")
+    assert next(tokens) == "token"
+    # The client leaves before the answer is finished
+    tokens.close()
+    assert cancelled.wait(5)
+    # The slot is free again
+    assert scheduler.submit("again").result(timeout=5) == "again"
+
+def test_missing_outputs():
+    scheduler = BatchScheduler(lambda prompts, options: prompts[:1], max_batch_size=2, max_wait_ms=200)
+    futures = [scheduler.submit("q0"), scheduler.submit("q1")]
+    # Every request of the batch fails rather than one waiting forever
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
@@ -0,0 +1,47 @@
+import numpy as np
+from bm25_index import BM25Index, SegmentedBM25Index, tokenize, write_bm25_index
+
+TEXTS = [
+    "Section 3.2 describes the retry policy of the client.",
+    "Error ERR-404 is returned when the document is missing.",
+    "The client retries failed requests, see section 4.1.",
+    "Unrelated text about the weather.",
+]
+
+def test_tokenize():
+    assert tokenize("See Section 3.2, ERR-404!") == ["see", "section", "3.2", "err-404", "3", "2", "err", "404"]
+    assert tokenize("") == []
+
+def test_search(tmp_path):
+    write_bm25_index(str(tmp_path), TEXTS)
+    index = BM25Index(str(tmp_path))
+    assert len(index) == len(TEXTS)
+    # Identifiers and section numbers match the chunk that contains them
+    assert index.search("ERR-404", k=1)[0][0] == 1
+    assert index.search("what does section 3.2 say?", k=1)[0][0] == 0
+    assert [row for row, _ in index.search("client", k=5)] in ([0, 2], [2, 0])
+    # Chunks without any query term are left out
+    assert index.search("nothing matches", k=5) == []
+
+def test_search_row_ranges(tmp_path):
+    write_bm25_index(str(tmp_path), TEXTS)
+    index = BM25Index(str(tmp_path))
+    assert [row for row, _ in index.search("client section", k=5, row_ranges=[[2, 4]])] == [2]
+    assert index.search("client", k=5, row_ranges=[]) == []
+
+def test_empty_index(tmp_path):
+    write_bm25_index(str(tmp_path), [])
+    assert BM25Index.exists(str(tmp_path))
+    assert BM25Index(str(tmp_path)).search("client", k=2) == []
+
+def test_segmented_index(tmp_path):
+    write_bm25_index(str(tmp_path / "all"), TEXTS)
+    write_bm25_index(str(tmp_path / "base"), TEXTS[:2])
+    write_bm25_index(str(tmp_path / "appended"), TEXTS[2:])
+    index = SegmentedBM25Index([BM25Index(str(tmp_path / "base")), BM25Index(str(tmp_path / "appended"), first_row=2)])
+    assert len(index) == len(TEXTS)
+    # Appended chunks score as if every chunk had been indexed together
+    assert index.search("client section", k=5) == BM25Index(str(tmp_path / "all")).search("client section", k=5)
+    assert [row for row, _ in index.search("client", k=5, row_ranges=[[2, 4]])] == [2]
+    excluded = np.array([False, False, True, False])
+    assert [row for row, _ in index.search("client", k=5, excluded=excluded)] == [0]
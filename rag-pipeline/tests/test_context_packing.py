@@ -0,0 +1,41 @@
+from langchain_core.documents import Document
+from context_packing import count_tokens, find_overlap, pack_context
+
+def make_doc(text: str, page: int = 0, doc_id: str = "a") -> Document:
+    return Document(page_content=text, metadata={"doc_id": doc_id, "page": page})
+
+def test_find_overlap():
+    assert find_overlap("the retry policy backs off exponentially", "backs off exponentially, up to 5 times", min_overlap=8) == 23
+    assert find_overlap("no shared text here", "something else", min_overlap=4) == 0
+    # Short overlaps, e.g. a shared word, are not merged
+    assert find_overlap("ends with the", "the start", min_overlap=4) == 0
+
+def test_pack_merges_overlap_and_skips_duplicates(stand_in_tokenizer):
+    first = "Section 3.2 covers the retry policy, which backs off exponentially."
+    second = "which backs off exponentially. Requests are retried five times."
+    other = "which backs off exponentially. Other documents are not merged."
+    docs = [make_doc(first), make_doc(first), make_doc(second), make_doc(other, doc_id="b")]
+    context = pack_context(docs, stand_in_tokenizer, budget=1000)
+    # The overlap of consecutive chunks is kept once and the duplicate chunk is dropped
+    merged = "Section 3.2 covers the retry policy, which backs off exponentially. Requests are retried five times."
+    assert context == merged + "\n\n" + other
+
+def test_pack_respects_budget(stand_in_tokenizer):
+    docs = [make_doc("a" * 40, page=0), make_doc("b" * 100, page=1), make_doc("c" * 30, page=2)]
+    # The second chunk does not fit and is skipped, the third still does
+    context = pack_context(docs, stand_in_tokenizer, budget=80)
+    assert context == "a" * 40 + "\n\n" + "c" * 30
+    assert count_tokens(stand_in_tokenizer, context) <= 80
+    # A first chunk larger than the budget is truncated
+    assert pack_context([make_doc("d" * 100)], stand_in_tokenizer, budget=10) == "d" * 10
+    assert pack_context([], stand_in_tokenizer, budget=10) == ""
+
+def test_pack_merge_into_later_passage_respects_budget(stand_in_tokenizer):
+    second = "Requests are retried five times."
+    third = "retried five times. Then they fail."
+    docs = [make_doc("a" * 40, page=0), make_doc(second, page=1), make_doc(third, page=1)]
+    merged = "Requests are retried five times. Then they fail."
+    exact = count_tokens(stand_in_tokenizer, "a" * 40) + count_tokens(stand_in_tokenizer, "\n\n") + count_tokens(stand_in_tokenizer, merged)
+    # The merged passage still pays for its separator
+    assert pack_context(docs, stand_in_tokenizer, budget=exact) == "a" * 40 + "\n\n" + merged
+    assert pack_context(docs, stand_in_tokenizer, budget=exact - 1) == "a" * 40 + "\n\n" + second
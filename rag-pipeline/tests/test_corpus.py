@@ -0,0 +1,195 @@
+import os
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from corpus import CorpusStore, CorpusVectorStore, ReadOnlyCorpusVectorStore, ReadOnlyCorpusError, get_doc_id_filter, parse_version
+from mmap_index import MMAP_INDEX_FILE
+
+@pytest.fixture
+def embeddings():
+    return DeterministicFakeEmbedding(size=16)
+
+def make_document(embeddings, name: str, num_chunks: int) -> FAISS:
+    return FAISS.from_texts([f"{name} chunk {i}" for i in range(num_chunks)], embeddings)
+
+def test_get_doc_id_filter():
+    assert get_doc_id_filter({"doc_id": "a"}) == {"a"}
+    assert get_doc_id_filter({"doc_id": ["a", "b"]}) == {"a", "b"}
+    assert get_doc_id_filter({"doc_id": {"$in": ["a"]}}) == {"a"}
+    assert get_doc_id_filter({"page": 1}) is None
+    assert get_doc_id_filter(None) is None
+
+def test_add_delete_and_filter(embeddings):
+    corpus = CorpusVectorStore.create(embeddings, 16)
+    corpus.add_document("a", make_document(embeddings, "a", 3))
+    corpus.add_document("b", make_document(embeddings, "b", 4))
+    assert corpus.document_ids() == {"a", "b"}
+    assert corpus.index.ntotal == 7
+
+    # The exact text of a chunk is its own nearest neighbour, unless filtered out
+    query = embeddings.embed_query("a chunk 1")
+    assert corpus.similarity_search_by_vector(query, k=1)[0].page_content == "a chunk 1"
+    results = corpus.similarity_search_by_vector(query, k=3, filter={"doc_id": ["b"]})
+    assert len(results) == 3
+    assert all(document.metadata["doc_id"] == "b" for document in results)
+    assert corpus.similarity_search_by_vector(query, k=1, filter={"doc_id": "unknown"}) == []
+
+    # Re-adding a document replaces its chunks
+    corpus.add_document("a", make_document(embeddings, "a", 2))
+    assert corpus.index.ntotal == 6
+    assert corpus.delete_document("b")
+    assert not corpus.delete_document("b")
+    assert corpus.document_ids() == {"a"}
+    assert corpus.index.ntotal == 2
+
+def test_corpus_store_persistence(tmp_path, embeddings):
+    store = CorpusStore(str(tmp_path))
+    assert store.load("user/1", embeddings) is None
+    store.add_document("user/1", "a", make_document(embeddings, "a", 3), embeddings)
+    store.add_document("user/1", "b", make_document(embeddings, "b", 2), embeddings, keep_doc_ids={"b"})
+
+    # A new store reads the saved corpus, stale documents were dropped
+    corpus = CorpusStore(str(tmp_path)).load("user/1", embeddings)
+    assert corpus.document_ids() == {"b"}
+    query = embeddings.embed_query("b chunk 0")
+    assert corpus.similarity_search_by_vector(query, k=1)[0].page_content == "b chunk 0"
+
+    assert store.delete_document("user/1", "b", embeddings)
+    assert CorpusStore(str(tmp_path)).load("user/1", embeddings).document_ids() == set()
+    # Every row was removed, so the corpus is compacted and only the new base is kept on disk
+    store.wait_for_compactions()
+    assert parse_version(store.current_version("user/1"))[1] == 0
+    assert len([path for path in (tmp_path / store.user_dir("user/1").rsplit("/", 1)[-1]).iterdir() if path.is_dir()]) == 1
+
+def test_convert_to_ivf(tmp_path, embeddings, monkeypatch):
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", "ivf")
+    store = CorpusStore(str(tmp_path))
+    store.add_document("user", "a", make_document(embeddings, "a", 200), embeddings)
+    corpus = store.add_document("user", "b", make_document(embeddings, "b", 100), embeddings)
+    assert corpus.index_params["type"] == "ivf"
+
+    corpus = CorpusStore(str(tmp_path)).load("user", embeddings)
+    assert corpus.index_params["type"] == "ivf"
+    query = embeddings.embed_query("b chunk 5")
+    results = corpus.similarity_search_by_vector(query, k=1, filter={"doc_id": ["b"]})
+    assert results[0].page_content == "b chunk 5"
+
+    assert corpus.delete_document("a")
+    assert corpus.index.ntotal == 100
+    assert all(document.metadata["doc_id"] == "b" for document in corpus.similarity_search_by_vector(query, k=5))
+
+def test_delete_from_ivf(tmp_path, embeddings, monkeypatch):
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", "ivf")
+    store = CorpusStore(str(tmp_path))
+    store.add_document("user", "a", make_document(embeddings, "a", 200), embeddings)
+    store.add_document("user", "b", make_document(embeddings, "b", 100), embeddings)
+    # The vectors left have ids 200 to 299
+    assert store.delete_document("user", "a", embeddings)
+
+    corpus = store.load_read_only("user", embeddings)
+    assert corpus.document_ids() == {"b"}
+    assert corpus.index.ntotal == 100
+    query = embeddings.embed_query("b chunk 5")
+    assert corpus.similarity_search_by_vector(query, k=1, filter={"doc_id": ["b"]})[0].page_content == "b chunk 5"
+    # The corpus can still be updated after the save
+    store.add_document("user", "c", make_document(embeddings, "c", 2), embeddings)
+    assert store.load_read_only("user", embeddings).document_ids() == {"b", "c"}
+
+def test_load_read_only(tmp_path, embeddings):
+    store = CorpusStore(str(tmp_path))
+    assert store.load_read_only("user", embeddings) is None
+    store.add_document("user", "a", make_document(embeddings, "a", 3), embeddings)
+    store.add_document("user", "b", make_document(embeddings, "b", 4), embeddings)
+
+    # Another process opens the saved corpus
+    corpus = CorpusStore(str(tmp_path)).load_read_only("user", embeddings)
+    assert isinstance(corpus, ReadOnlyCorpusVectorStore)
+    assert corpus.version == store.current_version("user")
+    assert corpus.document_ids() == {"a", "b"}
+    query = embeddings.embed_query("a chunk 2")
+    assert corpus.similarity_search_by_vector(query, k=1)[0].page_content == "a chunk 2"
+    results = corpus.similarity_search_by_vector(query, k=4, filter={"doc_id": "b"})
+    assert sorted(document.page_content for document in results) == [f"b chunk {i}" for i in range(4)]
+    # Only the store writes the corpus
+    with pytest.raises(ReadOnlyCorpusError, match="add_document"):
+        corpus.add_texts(["c chunk 0"])
+    with pytest.raises(ReadOnlyCorpusError, match="add_document"):
+        corpus.add_embeddings([("c chunk 0", query)])
+    with pytest.raises(ReadOnlyCorpusError, match="delete_document"):
+        corpus.delete(["0"])
+    assert corpus.document_ids() == {"a", "b"}
+
+    # Updates are saved as a new version, the opened one stays readable
+    store.delete_document("user", "a", embeddings)
+    assert store.current_version("user") != corpus.version
+    assert store.load_read_only("user", embeddings).document_ids() == {"b"}
+    assert corpus.similarity_search_by_vector(query, k=1)[0].page_content == "a chunk 2"
+
+def test_incremental_saves(tmp_path, embeddings):
+    store = CorpusStore(str(tmp_path), max_deltas=10, max_removed_fraction=0.9)
+    store.add_document("user", "a", make_document(embeddings, "a", 20), embeddings)
+    base, _ = parse_version(store.current_version("user"))
+    base_dir = tmp_path / store.user_dir("user").rsplit("/", 1)[-1] / base
+    index_mtime = os.path.getmtime(base_dir / MMAP_INDEX_FILE)
+
+    # Later updates only append to the base
+    store.add_document("user", "b", make_document(embeddings, "b", 4), embeddings)
+    store.add_document("user", "c", make_document(embeddings, "c", 3), embeddings)
+    assert store.delete_document("user", "a", embeddings)
+    assert parse_version(store.current_version("user")) == (base, 3)
+    assert os.path.getmtime(base_dir / MMAP_INDEX_FILE) == index_mtime
+
+    corpus = CorpusStore(str(tmp_path)).load_read_only("user", embeddings)
+    assert corpus.document_ids() == {"b", "c"}
+    assert corpus.index.ntotal == 7
+    # Rows of the removed document are skipped by every search
+    query = embeddings.embed_query("a chunk 2")
+    assert all(document.metadata["doc_id"] != "a" for document in corpus.similarity_search_by_vector(query, k=10))
+    assert all(corpus.docstore.search(row).metadata["doc_id"] != "a" for row, _ in corpus.search_keywords("chunk", k=30))
+    query = embeddings.embed_query("c chunk 1")
+    assert corpus.similarity_search_by_vector(query, k=1)[0].page_content == "c chunk 1"
+    assert corpus.similarity_search_by_vector(query, k=1, filter={"doc_id": "b"})[0].metadata["doc_id"] == "b"
+    assert corpus.docstore.search(corpus.search_keywords("c chunk 1", k=1)[0][0]).page_content == "c chunk 1"
+
+    # Another process replays the deltas, and only the new ones once it has loaded the corpus
+    other_store = CorpusStore(str(tmp_path))
+    loaded = other_store.load("user", embeddings)
+    assert loaded.document_ids() == {"b", "c"}
+    store.add_document("user", "b", make_document(embeddings, "b", 2), embeddings)
+    assert other_store.load("user", embeddings) is loaded
+    assert loaded.document_ids() == {"b", "c"}
+    assert loaded.index.ntotal == 5
+
+def test_compaction(tmp_path, embeddings):
+    store = CorpusStore(str(tmp_path), max_deltas=2)
+    store.add_document("user", "a", make_document(embeddings, "a", 3), embeddings)
+    store.add_document("user", "b", make_document(embeddings, "b", 4), embeddings)
+    store.add_document("user", "c", make_document(embeddings, "c", 5), embeddings)
+    # The second delta triggers a compaction in the background
+    store.wait_for_compactions()
+    base, num_deltas = parse_version(store.current_version("user"))
+    assert num_deltas == 0
+    assert [path.name for path in (tmp_path / store.user_dir("user").rsplit("/", 1)[-1]).iterdir() if path.is_dir()] == [base]
+
+    corpus = store.load_read_only("user", embeddings)
+    assert corpus.document_ids() == {"a", "b", "c"}
+    assert corpus.removed is None
+    assert corpus.doc_ranges == {"a": [0, 3], "b": [3, 7], "c": [7, 12]}
+    query = embeddings.embed_query("b chunk 3")
+    assert corpus.similarity_search_by_vector(query, k=1)[0].page_content == "b chunk 3"
+    assert not store.compact("user", embeddings)
+
+def test_doc_labels_are_updated(embeddings):
+    corpus = CorpusVectorStore.create(embeddings, 16)
+    corpus.add_document("a", make_document(embeddings, "a", 3))
+    doc_labels = corpus._get_doc_labels()
+    corpus.add_document("b", make_document(embeddings, "b", 2))
+    corpus.delete_document("a")
+    corpus.add_document("a", make_document(embeddings, "a", 1))
+    # The map is updated in place rather than rebuilt from every chunk
+    assert corpus._get_doc_labels() is doc_labels
+    assert {doc_id: labels.tolist() for doc_id, labels in doc_labels.items()} == {"b": [3, 4], "a": [5]}
+    vectors, chunks = corpus.get_document("b")
+    assert [chunk.page_content for chunk in chunks] == ["b chunk 0", "b chunk 1"]
+    assert np.array_equal(vectors, np.array(embeddings.embed_documents(["b chunk 0", "b chunk 1"]), dtype=np.float32))
@@ -3,7 +3,8 @@ import pytest
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from utils import get_doc_dir
-from data_extraction import extract_data
+from data_extraction import (extract_data, iter_chunks, get_chunk_tokenizer_dir, get_chunking_key,
+                             get_text_splitter, start_extraction_pool, CHUNK_TOKENS)
 
 def test_pdf_loader():
     """Test the PyPDFLoader class."""
@@ -28,5 +29,45 @@ def test_full_processing_loop():
     assert len(chunk) > 0
     assert isinstance(chunk, list)
     assert isinstance(chunk[0], str)
+
+def test_iter_chunks_matches_pdf_loader():
+    """Test parallel extraction yields the same chunks, in page order"""
+    pdf_path = get_doc_dir()
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
+    docs = PyPDFLoader(pdf_path).load()
+    expected = [chunk for doc in docs for chunk in text_splitter.split_text(doc.page_content)]
+    
+    updates = []
+    chunks = list(iter_chunks(pdf_path, progress=lambda **p: updates.append(p), workers=2))
+    assert [chunk.page_content for chunk in chunks] == expected
+    assert [chunk.metadata["page"] for chunk in chunks] == sorted(chunk.metadata["page"] for chunk in chunks)
+    assert updates[0] == {"pages_total": len(docs)}
+    assert updates[1:] == [{"pages_parsed": page} for page in range(1, len(docs) + 1)]
     
-    
\ No newline at end of file
+def test_extraction_pool_is_shared():
+    """Test documents extracted with different parallelism share the one pool"""
+    pool = start_extraction_pool()
+    first = list(iter_chunks(get_doc_dir(), workers=2))
+    second = list(iter_chunks(get_doc_dir(), workers=3))
+    assert [chunk.page_content for chunk in first] == [chunk.page_content for chunk in second]
+    assert start_extraction_pool() is pool
+
+def test_iter_chunks_is_lazy():
+    """Test chunks are yielded before the whole document is parsed"""
+    updates = []
+    chunks = iter_chunks(get_doc_dir(), progress=lambda **p: updates.append(p), workers=1)
+    first = next(chunks)
+    assert first.metadata["page"] == 0
+    assert not any("pages_parsed" in update for update in updates)
+
+def test_token_text_splitter(tmp_path, stand_in_tokenizer):
+    """Test chunks are measured in tokens of the LLM tokenizer when it is available"""
+    stand_in_tokenizer.save_pretrained(str(tmp_path))
+    assert get_chunk_tokenizer_dir(str(tmp_path)) == str(tmp_path)
+    assert get_chunk_tokenizer_dir(str(tmp_path / "missing")) is None
+    assert get_chunking_key(str(tmp_path)) != get_chunking_key(None)
+
+    text = " ".join(f"word{i}" for i in range(500))
+    chunks = get_text_splitter(str(tmp_path)).split_text(text)
+    assert len(chunks) > 1
+    assert all(len(stand_in_tokenizer(chunk)["input_ids"]) <= CHUNK_TOKENS for chunk in chunks)
@@ -6,8 +6,9 @@ from langchain_huggingface import HuggingFacePipeline
 from langchain.prompts import PromptTemplate
 from langchain.chains.retrieval_qa.base import RetrievalQA
 from model_setup import load_model
-from data_pipeline import setup_pipeline, chat_with_llm
-from utils import get_model_dir, get_doc_dir
+import data_pipeline
+from data_pipeline import setup_pipeline, chat_with_llm, generate_batch, stream_generate
+from utils import get_model_dir, get_doc_dir, CHAT_STAGE_LATENCY, PROMPT_TOKENS, GENERATED_TOKENS
 
 @pytest.fixture
 def mock_setup_pipeline():
@@ -39,12 +40,32 @@ def test_chat_with_llm(mock_setup_pipeline):
     assert answer == expected_answer
     mock_setup_pipeline.assert_called_once_with(local_dir=get_model_dir())
     mock_qa_chain.assert_called_once_with(test_question)
-    
-    
 
-    
+def test_generate_batch_stages(stand_in_model_dir, stand_in_model, monkeypatch):
+    monkeypatch.setitem(data_pipeline.GENERATION_KWARGS, "max_new_tokens", 6)
 
+    def count(stage):
+        return sum(bucket.get() for bucket in CHAT_STAGE_LATENCY.labels(stage=stage)._buckets)
+
+    stages = ("tokenize", "prefill", "decode", "detokenize")
+    before = {stage: count(stage) for stage in stages}
+    prompt_tokens, generated_tokens = PROMPT_TOKENS._value.get(), GENERATED_TOKENS._value.get()
+    prompts = ["Question: a?\nAnswer:", "Question: longer?\nAnswer:"]
+    outputs = generate_batch(stand_in_model_dir, prompts, model=stand_in_model)
+
+    # Left padding gives every prompt the answer it gets alone
+    for prompt, output in zip(prompts, outputs):
+        assert prompt not in output
+        assert output == generate_batch(stand_in_model_dir, [prompt], model=stand_in_model)[0]
+    for stage in stages:
+        assert count(stage) > before[stage]
+    assert PROMPT_TOKENS._value.get() >= prompt_tokens + sum(len(prompt) for prompt in prompts)
+    assert GENERATED_TOKENS._value.get() > generated_tokens
+
+@patch("data_pipeline.resources")
+@patch("data_pipeline.generate_with_prefix_cache")
+def test_stream_generate_raises_errors(mock_generate, mock_resources):
+    mock_generate.side_effect = RuntimeError("Out of memory")
     
-    
-    
-    
\ No newline at end of file
+    with pytest.raises(RuntimeError, match="Out of memory"):
+        list(stream_generate("model_dir", "Question: a?\nAnswer:", model=MagicMock()))
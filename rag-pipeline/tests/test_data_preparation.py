@@ -4,7 +4,12 @@ import hashlib
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_core.vectorstores.base import VectorStoreRetriever
-from data_preparation import compute_content_hash, get_vector_store, prepare_retriever
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from embedding_cache import EmbeddingCache
+import data_preparation
+from data_preparation import (compute_content_hash, compute_file_hash, build_vector_store, 
+                              get_vector_store, prepare_vector_store, prepare_retriever)
 from utils import get_hardware, get_doc_dir
 
 def test_compute_content_hash():
@@ -39,4 +44,87 @@ def test_prepare_retriever():
     file_path = get_doc_dir()
     retriever = prepare_retriever(embedding_model_name, file_path)
     assert isinstance(retriever, VectorStoreRetriever)
-    
\ No newline at end of file
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    model_name: str = "fake-model"
+    batches: list = []
+    
+    def embed_documents(self, texts):
+        self.batches.append(len(texts))
+        return super().embed_documents(texts)
+
+def test_build_vector_store_in_batches():
+    embeddings = FakeEmbeddings(size=8, batches=[])
+    chunks = (Document(page_content=f"chunk {i}", metadata={"page": i}) for i in range(10))
+    progress = []
+    vector_store = build_vector_store(chunks, embeddings, batch_size=4, progress=lambda **p: progress.append(p))
+    
+    assert embeddings.batches == [4, 4, 2]
+    assert vector_store.index.ntotal == 10
+    assert [p["chunks_embedded"] for p in progress] == [4, 8, 10]
+    assert all(p["chunks_per_second"] > 0 for p in progress)
+    doc = vector_store.similarity_search("chunk 3", k=1)[0]
+    assert doc.page_content == "chunk 3" and doc.metadata == {"page": 3}
+
+def test_build_vector_store_restores_threads():
+    import torch
+    threads = torch.get_num_threads()
+    seen = []
+    class ThreadsEmbeddings(DeterministicFakeEmbedding):
+        def embed_documents(self, texts):
+            seen.append(torch.get_num_threads())
+            return super().embed_documents(texts)
+
+    build_vector_store(["page 1", "page 2"], ThreadsEmbeddings(size=8), threads=threads + 1)
+    # Embedding ran with its own threads, generation in the same process keeps the previous count
+    assert seen == [threads + 1]
+    assert torch.get_num_threads() == threads
+
+def test_build_vector_store_with_embedding_cache(tmp_path):
+    embeddings = FakeEmbeddings(size=8, batches=[])
+    cache = EmbeddingCache(str(tmp_path), embeddings.model_name)
+    build_vector_store(["page 1", "page 2"], embeddings, embedding_cache=cache)
+    
+    # Only the edited chunk is embedded again
+    vector_store = build_vector_store(["page 1", "page 2 edited"], embeddings, embedding_cache=cache)
+    assert embeddings.batches == [2, 1]
+    assert vector_store.similarity_search("page 1", k=1)[0].page_content == "page 1"
+
+def test_build_vector_store_empty():
+    with pytest.raises(ValueError):
+        build_vector_store(iter([]), DeterministicFakeEmbedding(size=8))
+
+def test_get_vector_store_with_cache_key_skips_parsing(tmp_path):
+    embeddings = FakeEmbeddings(size=8)
+    get_vector_store(iter(["this is", "a test"]), embeddings, str(tmp_path), cache_key="key")
+    
+    def never_parsed():
+        raise AssertionError("chunks should not be consumed on a cache hit")
+        yield
+    vector_store = get_vector_store(never_parsed(), embeddings, str(tmp_path), cache_key="key")
+    assert vector_store.index.ntotal == 2
+    
+def test_prepare_vector_store_stays_flat(tmp_path, monkeypatch):
+    # Documents are copied into the corpus, which chooses its own index type
+    monkeypatch.setenv("VECTOR_INDEX_TYPE", "ivf-pq")
+    monkeypatch.setattr(data_preparation.resources, "get_embeddings", lambda *args: FakeEmbeddings(size=8))
+    monkeypatch.setattr(data_preparation.resources, "get_embedding_cache", lambda *args: None)
+    monkeypatch.setattr(data_preparation, "get_chunk_tokenizer_dir", lambda: None)
+    monkeypatch.setattr(data_preparation, "get_vector_store_dir", lambda: str(tmp_path / "vector_store"))
+    monkeypatch.setattr(data_preparation, "iter_chunks", lambda *args, **kwargs: iter(["this is", "a test"]))
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"content")
+    vector_store = prepare_vector_store(file_path=str(path))
+    assert type(vector_store.index).__name__ == "IndexFlatL2"
+    assert vector_store.index.ntotal == 2
+
+def test_compute_file_hash(tmp_path):
+    path = tmp_path / "doc.pdf"
+    path.write_bytes(b"content")
+    hash1 = compute_file_hash(str(path), "model-v1")
+    assert hash1 == compute_file_hash(str(path), "model-v1")
+    assert hash1 != compute_file_hash(str(path), "model-v2")
+    # Chunks measured in tokens are indexed separately
+    assert hash1 != compute_file_hash(str(path), "model-v1", tokenizer_dir=str(tmp_path))
+    path.write_bytes(b"new content")
+    assert hash1 != compute_file_hash(str(path), "model-v1")
@@ -0,0 +1,34 @@
+from document_registry import DocumentRegistry
+
+def test_add_and_list(tmp_path):
+    registry = DocumentRegistry(str(tmp_path / "documents.jsonl"))
+    first = registry.add("alice", "uploads/alice_a.pdf")
+    second = registry.add("alice", "uploads/alice_b.pdf")
+    registry.add("bob", "uploads/bob_a.pdf")
+
+    assert [d["doc_id"] for d in registry.list("alice")] == [first["doc_id"], second["doc_id"]]
+    assert registry.latest("alice")["file_name"] == "alice_b.pdf"
+    assert registry.latest("carol") is None
+    assert sorted(registry.users()) == ["alice", "bob"]
+
+def test_reupload_replaces_entry(tmp_path):
+    registry = DocumentRegistry(str(tmp_path / "documents.jsonl"))
+    registry.add("alice", "uploads/alice_a.pdf")
+    document = registry.add("alice", "uploads/alice_a.pdf")
+    assert registry.list("alice") == [document]
+
+def test_persisted_across_restarts(tmp_path):
+    path = str(tmp_path / "documents.jsonl")
+    registry = DocumentRegistry(path)
+    first = registry.add("alice", "uploads/alice_a.pdf")
+    second = registry.add("alice", "uploads/alice_b.pdf")
+    assert registry.get("alice", first["doc_id"]) == first
+    assert registry.remove("alice", first["doc_id"]) == first
+    assert registry.get("alice", first["doc_id"]) is None
+    assert registry.remove("alice", "missing") is None
+
+    # Simulate a line left half-written by a crash
+    with open(path, "a") as f:
+        f.write('{"op": "add", "user_')
+
+    assert DocumentRegistry(path).list("alice") == [second]
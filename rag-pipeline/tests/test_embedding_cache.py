@@ -0,0 +1,53 @@
+import numpy as np
+from embedding_cache import EmbeddingCache
+
+def fake_embed(calls):
+    def embed(texts):
+        calls.append(list(texts))
+        return [[float(len(text)), 1.0, 2.0] for text in texts]
+    return embed
+
+def test_only_missing_chunks_are_embedded(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "org/model")
+    calls = []
+    first = cache.embed(["a", "bb", "ccc"], fake_embed(calls))
+    second = cache.embed(["bb", "dddd", "a", "dddd"], fake_embed(calls))
+
+    assert calls == [["a", "bb", "ccc"], ["dddd"]]
+    assert first[1] == second[0] == [2.0, 1.0, 2.0]
+    assert second[1] == second[3] == [4.0, 1.0, 2.0]
+    assert len(cache) == 4
+
+def test_cache_is_persistent(tmp_path):
+    EmbeddingCache(str(tmp_path), "org/model").embed(["a", "bb"], fake_embed([]))
+
+    # A new instance, e.g. in another process, reads the vectors from disk
+    cache = EmbeddingCache(str(tmp_path), "org/model")
+    vectors = cache.get(["bb", "new"])
+    assert vectors[0].dtype == np.float32
+    assert vectors[0].tolist() == [2.0, 1.0, 2.0]
+    assert vectors[1] is None
+
+    # Embeddings of other models are kept apart
+    assert EmbeddingCache(str(tmp_path), "org/other-model").get(["a"]) == [None]
+
+def test_sees_rows_written_by_another_instance(tmp_path):
+    reader = EmbeddingCache(str(tmp_path), "model")
+    writer = EmbeddingCache(str(tmp_path), "model")
+    writer.embed(["a"], fake_embed([]))
+    assert reader.get(["a"])[0].tolist() == [1.0, 1.0, 2.0]
+    
+    writer.embed(["bb"], fake_embed([]))
+    assert reader.get(["bb"])[0].tolist() == [2.0, 1.0, 2.0]
+
+def test_partial_row_is_dropped(tmp_path):
+    cache = EmbeddingCache(str(tmp_path), "model")
+    cache.embed(["a"], fake_embed([]))
+
+    # Simulate a writer interrupted after writing its vector but not its key
+    with open(cache._vectors_path, "ab") as f:
+        f.write(np.zeros(3, dtype=np.float32).tobytes())
+    cache.embed(["bb"], fake_embed([]))
+
+    cache = EmbeddingCache(str(tmp_path), "model")
+    assert [v.tolist() for v in cache.get(["a", "bb"])] == [[1.0, 1.0, 2.0], [2.0, 1.0, 2.0]]
@@ -0,0 +1,75 @@
+import threading
+import pytest
+import torch
+from unittest.mock import patch
+import data_pipeline
+from data_pipeline import generate_batch, stream_generate
+from generation_controls import (StopCriteria, CancelCriteria, resolve_generation_options, truncate_at_stop, stream_until_stop,
+                                 get_generation_limits)
+
+def test_resolve_generation_options(monkeypatch):
+    monkeypatch.setenv("CHAT_MAX_TOKENS_LIMIT", "100")
+    assert resolve_generation_options() == {}
+    assert resolve_generation_options(max_tokens=500, stop=["\n"], temperature=9.0) == {
+        "max_tokens": 100, "stop": ["\n"], "temperature": get_generation_limits()["temperature"]
+    }
+    for options in ({"max_tokens": 0}, {"temperature": -1.0}, {"stop": [""]}, {"stop": ["x" * 100]}, {"stop": list("abcde")}):
+        with pytest.raises(ValueError):
+            resolve_generation_options(**options)
+
+def test_truncate_and_stream_until_stop():
+    assert truncate_at_stop("Paris\nQuestion: and", ["\nQuestion", "and"]) == "Paris"
+    assert truncate_at_stop("Paris", None) == "Paris"
+    # A stop sequence split over chunks is not streamed
+    chunks = ["Pa", "ri", "s\nQu", "estion", "more"]
+    assert "".join(stream_until_stop(iter(chunks), ["\nQuestion"])) == "Paris"
+    assert "".join(stream_until_stop(iter(chunks), ["never"])) == "".join(chunks)
+
+def test_stop_criteria(stand_in_tokenizer):
+    input_ids = torch.tensor(stand_in_tokenizer(["abXY", "abcd"])["input_ids"])
+    assert StopCriteria(stand_in_tokenizer, 2, [5, 2], [["X"], None])(input_ids).tolist() == [True, True]
+    assert StopCriteria(stand_in_tokenizer, 2, [5, 5], [["Z"], ["c"]])(input_ids).tolist() == [False, True]
+
+    cancel = threading.Event()
+    criteria = CancelCriteria(cancel, StopCriteria(stand_in_tokenizer, 2, [5, 5], [["Z"], ["c"]]))
+    assert criteria(input_ids).tolist() == [False, True]
+    cancel.set()
+    assert criteria(input_ids).tolist() == [True, True]
+
+@pytest.mark.parametrize("decoding", ["off", "prompt_lookup"])
+def test_generate_batch_options(stand_in_model_dir, stand_in_model, monkeypatch, decoding):
+    monkeypatch.setenv("SPECULATIVE_DECODING", decoding)
+    prompt = "Question: what?\nAnswer:"
+    reference = generate_batch(stand_in_model_dir, [prompt], model=stand_in_model, options=[{"max_tokens": 12, "temperature": 0}])[0]
+    stop = next(char for char in reference[2:] if char.strip())
+
+    # Every sequence of the batch stops at its own stop sequence or budget
+    options = [{"max_tokens": 12, "stop": [stop]}, {"max_tokens": 3}, {"max_tokens": 12}, {"max_tokens": 12, "temperature": 1.0}]
+    outputs = generate_batch(stand_in_model_dir, [prompt] * len(options), model=stand_in_model, options=options)
+    assert outputs[0] == truncate_at_stop(reference, [stop])
+    assert reference.startswith(outputs[1]) and len(outputs[1]) < len(reference)
+    assert outputs[2] == reference
+    assert isinstance(outputs[3], str)
+    # A lone prompt stops at its stop sequence too, with or without drafts
+    assert generate_batch(stand_in_model_dir, [prompt], model=stand_in_model, options=[options[0]]) == [outputs[0]]
+
+def test_prompt_lookup_only_when_greedy(stand_in_model_dir, stand_in_model, monkeypatch):
+    monkeypatch.setenv("SPECULATIVE_DECODING", "prompt_lookup")
+    # Requests without a temperature sample like the model's generation config, e.g. Qwen2.5's
+    monkeypatch.setattr(stand_in_model.generation_config, "do_sample", True)
+    prompt = "Question: what?\nAnswer:"
+    with patch.object(data_pipeline, "prompt_lookup_generate", wraps=data_pipeline.prompt_lookup_generate) as lookup:
+        generate_batch(stand_in_model_dir, [prompt], model=stand_in_model, options=[{"max_tokens": 3}])
+        assert not lookup.called
+        generate_batch(stand_in_model_dir, [prompt], model=stand_in_model, options=[{"max_tokens": 3, "temperature": 0}])
+        assert lookup.called
+
+@pytest.mark.parametrize("decoding", ["off", "prompt_lookup"])
+def test_stream_cancel(stand_in_model_dir, stand_in_model, monkeypatch, decoding):
+    monkeypatch.setenv("SPECULATIVE_DECODING", decoding)
+    prompt = "Question: what?\nAnswer:"
+    cancel = threading.Event()
+    cancel.set()
+    # A cancelled answer stops after its first step rather than at its budget
+    answer = "".join(stream_generate(stand_in_model_dir, prompt, model=stand_in_model, options={"max_tokens": 200}, cancel=cancel))
+    assert len(answer) < 20
@@ -0,0 +1,53 @@
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_core.vectorstores import VectorStoreRetriever
+from corpus import CorpusStore
+from hybrid_retrieval import HybridRetriever, build_retriever, reciprocal_rank_fusion
+from utils import RETRIEVAL_STAGE_LATENCY
+
+class ReverseReranker:
+    """Cross-encoder stand-in that prefers the chunks the fusion ranked last."""
+    def predict(self, pairs):
+        return list(range(len(pairs)))
+
+@pytest.fixture
+def corpus(tmp_path):
+    embeddings = DeterministicFakeEmbedding(size=16)
+    store = CorpusStore(str(tmp_path))
+    texts = {
+        "a": ["Section 3.2 covers the retry policy.", "Retries back off exponentially."],
+        "b": ["Error ERR-404 means the document is missing.", "Errors are logged."],
+    }
+    for doc_id, doc_texts in texts.items():
+        store.add_document("user", doc_id, FAISS.from_texts(doc_texts, embeddings), embeddings)
+    return store.load_read_only("user", embeddings)
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([["a", "b", "c"], ["c", "a"]], k=60)
+    assert [item for item, _ in fused] == ["a", "c", "b"]
+    assert fused[0][1] == pytest.approx(1 / 61 + 1 / 62)
+
+def test_build_retriever(corpus, monkeypatch):
+    assert isinstance(build_retriever(corpus), HybridRetriever)
+    monkeypatch.setenv("RETRIEVAL_MODE", "dense")
+    retriever = build_retriever(corpus, k=3)
+    assert isinstance(retriever, VectorStoreRetriever)
+    assert retriever.search_kwargs == {"k": 3}
+
+def test_hybrid_retrieval(corpus):
+    retriever = HybridRetriever(vectorstore=corpus, k=1)
+    # Fake embeddings are random, the exact identifier is found by BM25
+    assert retriever.invoke("What is ERR-404?")[0].page_content.startswith("Error ERR-404")
+    docs = retriever.invoke("section 3.2", filter={"doc_id": ["b"]})
+    assert docs and all(doc.metadata["doc_id"] == "b" for doc in docs)
+    embedding = corpus.embeddings.embed_query("section 3.2")
+    assert retriever.invoke("section 3.2", embedding=embedding)[0].page_content.startswith("Section 3.2")
+
+    stages = {sample.labels["stage"] for metric in RETRIEVAL_STAGE_LATENCY.collect() for sample in metric.samples}
+    assert {"dense", "bm25", "fusion"} <= stages
+
+def test_rerank(corpus):
+    fused = HybridRetriever(vectorstore=corpus, k=4).invoke("ERR-404")
+    reranked = HybridRetriever(vectorstore=corpus, k=4, reranker=ReverseReranker(), rerank_k=4).invoke("ERR-404")
+    assert [doc.page_content for doc in reranked] == [doc.page_content for doc in reversed(fused)]
@@ -0,0 +1,60 @@
+import os
+import pytest
+from unittest.mock import patch
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from index_store import IndexStore, MANIFEST_FILE
+from data_preparation import get_vector_store
+
+class FakeEmbeddings(DeterministicFakeEmbedding):
+    model_name: str = "fake-model"
+
+@pytest.fixture
+def embeddings():
+    return FakeEmbeddings(size=8)
+
+def test_put_and_get(embeddings, tmp_path):
+    store = IndexStore(str(tmp_path))
+    vector_store = FAISS.from_texts(["a test", "chunk"], embedding=embeddings)
+    store.put("abc", vector_store)
+
+    assert store.contains("abc")
+    assert os.path.exists(tmp_path / MANIFEST_FILE)
+    loaded = store.get("abc", embeddings)
+    assert isinstance(loaded, FAISS)
+    assert loaded.index.ntotal == 2
+    assert store.get("missing", embeddings) is None
+
+def test_lru_eviction(embeddings, tmp_path):
+    store = IndexStore(str(tmp_path), max_entries=2)
+    for key in ["first", "second"]:
+        store.put(key, FAISS.from_texts([key], embedding=embeddings))
+
+    # Touch the oldest entry so that "second" becomes least recently used
+    store.get("first", embeddings)
+    store.put("third", FAISS.from_texts(["third"], embedding=embeddings))
+
+    assert store.contains("first")
+    assert not store.contains("second")
+    assert store.contains("third")
+
+def test_put_existing_key(embeddings, tmp_path):
+    store = IndexStore(str(tmp_path))
+    store.put("abc", FAISS.from_texts(["chunk"], embedding=embeddings))
+    store.put("abc", FAISS.from_texts(["chunk"], embedding=embeddings))
+
+    # No temporary directories are left behind
+    assert sorted(os.listdir(tmp_path)) == sorted(["abc", MANIFEST_FILE, ".lock"])
+
+def test_get_vector_store_skips_embedding(embeddings, tmp_path):
+    chunks = ["this is", "a test", "chunk"]
+    get_vector_store(chunks, embeddings, str(tmp_path))
+
+    with patch("data_preparation.build_vector_store") as mock_build:
+        vector_store = get_vector_store(chunks, embeddings, str(tmp_path))
+        mock_build.assert_not_called()
+    assert vector_store.index.ntotal == 3
+
+    # A different document gets its own index next to the first one
+    get_vector_store(["another", "document"], embeddings, str(tmp_path))
+    assert len([d for d in os.listdir(tmp_path) if os.path.isdir(tmp_path / d)]) == 2
@@ -0,0 +1,47 @@
+import threading
+from ingestion import IngestionManager, DONE, FAILED
+
+def test_job_progress_and_result():
+    manager = IngestionManager(max_workers=1)
+    results = {}
+    def ingest(file_path, progress):
+        progress(pages_parsed=2, chunks_total=5)
+        progress(chunks_embedded=5)
+        return f"pipeline for {file_path}"
+
+    job = manager.submit("user", "doc.pdf", ingest, on_done=lambda job, result: results.update({job.user_id: result}))
+    assert job.wait(timeout=5)
+
+    status = manager.get(job.job_id).to_dict()
+    assert status["status"] == DONE
+    assert (status["pages_parsed"], status["chunks_total"], status["chunks_embedded"]) == (2, 5, 5)
+    assert results == {"user": "pipeline for doc.pdf"}
+    assert not manager.is_pending("user")
+
+def test_failed_job():
+    manager = IngestionManager(max_workers=1)
+    def ingest(file_path, progress):
+        raise ValueError("broken pdf")
+
+    job = manager.submit("user", "doc.pdf", ingest)
+    assert job.wait(timeout=5)
+    assert job.to_dict()["status"] == FAILED
+    assert job.to_dict()["error"] == "broken pdf"
+
+def test_outdated_job_does_not_override_newer_upload():
+    manager = IngestionManager(max_workers=2)
+    release = threading.Event()
+    results = []
+    def slow_ingest(file_path, progress):
+        release.wait(timeout=5)
+        return file_path
+
+    on_done = lambda job, result: results.append(result)
+    old_job = manager.submit("user", "old.pdf", slow_ingest, on_done=on_done)
+    assert manager.is_pending("user")
+    new_job = manager.submit("user", "new.pdf", lambda file_path, progress: file_path, on_done=on_done)
+    assert new_job.wait(timeout=5)
+    release.set()
+    assert old_job.wait(timeout=5)
+
+    assert results == ["new.pdf"]
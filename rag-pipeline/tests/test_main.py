@@ -1,9 +1,18 @@
 import os
 import pytest
+from concurrent.futures import Future
 from fastapi.testclient import TestClient
 from unittest.mock import MagicMock, patch
 from unittest import TestCase
-from main import app, model_state, load_llm
+import main
+from main import app, model_state, ingestion_manager, load_llm
+from batching import QueueFullError
+from document_registry import DocumentRegistry
+from pipeline_cache import PipelineCache
+from answer_cache import AnswerCache
+from corpus import CorpusStore
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding
 from opentelemetry import trace
 from opentelemetry.sdk.trace import TracerProvider
 from opentelemetry.sdk.trace.export import SimpleSpanProcessor, ConsoleSpanExporter
@@ -22,11 +31,15 @@ def test_client():
     return TestClient(app)
 
 @pytest.fixture(autouse=True)
-def reset_mocks():
+def reset_mocks(tmp_path, monkeypatch):
     # Reset model state before each test
     model_state.llm_loaded = False
-    model_state.qa_pipelines = {}
+    model_state.qa_pipelines = PipelineCache()
     model_state.model = MagicMock()
+    monkeypatch.setattr(main, "document_registry", DocumentRegistry(str(tmp_path / "documents.jsonl")))
+    monkeypatch.setattr(main, "answer_cache", AnswerCache())
+    monkeypatch.setattr(main, "corpus_store", CorpusStore(str(tmp_path / "corpora")))
+    monkeypatch.setattr(main.resources, "get_embeddings", lambda: DeterministicFakeEmbedding(size=8))
     yield
     
 def test_get_config(test_client):
@@ -62,9 +75,11 @@ def test_health_check(test_client):
     assert response.status_code == 503
     assert response.json() == {"status": "unhealthy"}
     
+@patch("main.prepare_vector_store")
 @patch("main.setup_pipeline")
-def test_upload_pdf(mock_setup, test_client):
+def test_upload_pdf(mock_setup, mock_prepare, test_client):
     mock_setup.return_value = MagicMock()
+    mock_prepare.return_value = FAISS.from_texts(["Paris is the capital of France."], DeterministicFakeEmbedding(size=8))
     model_state.llm_loaded = True
     test_file = ("test.pdf", b"fake pdf content")
     response = test_client.post(
@@ -73,12 +88,63 @@ def test_upload_pdf(mock_setup, test_client):
     )
     assert response.status_code == 200
     assert "file_path" in response.json()
+    
+    # Ingestion runs in the background
+    job_id = response.json()["job_id"]
+    assert ingestion_manager.get(job_id).wait(timeout=5)
     mock_setup.assert_called_once()
+    assert model_state.qa_pipelines["test_user"] is mock_setup.return_value
+    
+    documents = test_client.get("/api/documents?user_id=test_user").json()["documents"]
+    assert [d["doc_id"] for d in documents] == [response.json()["doc_id"]]
+    corpus = main.corpus_store.load("test_user", DeterministicFakeEmbedding(size=8))
+    assert corpus.document_ids() == {response.json()["doc_id"]}
+    
+    status = test_client.get(f"/api/upload_status/{job_id}")
+    assert status.status_code == 200
+    assert status.json()["status"] == "done"
+    assert test_client.get("/api/upload_status/unknown").status_code == 404
+    
+    # The ingested upload is deleted, and uploading the same name again replaces the document
+    assert not os.path.exists(response.json()["file_path"])
+    second = test_client.post("/api/upload_pdf?user_id=test_user", files={"file": test_file}).json()
+    assert second["file_path"] != response.json()["file_path"]
+    assert ingestion_manager.get(second["job_id"]).wait(timeout=5)
+    documents = test_client.get("/api/documents?user_id=test_user").json()["documents"]
+    assert [(d["doc_id"], d["file_name"]) for d in documents] == [(second["doc_id"], "test.pdf")]
+    
+@patch("main.prepare_vector_store")
+@patch("main.setup_pipeline")
+def test_delete_document(mock_setup, mock_prepare, test_client, tmp_path):
+    mock_prepare.return_value = FAISS.from_texts(["Paris is the capital of France."], DeterministicFakeEmbedding(size=8))
+    file_path = tmp_path / "test_user_test.pdf"
+    file_path.write_bytes(b"fake pdf content")
+    document = main.document_registry.add("test_user", str(file_path), content_hash="abc")
+    main.ingest_document("test_user", document["doc_id"], str(file_path))
+    
+    # A failed save keeps the document, so the deletion can be retried
+    with patch.object(main.corpus_store, "delete_document", side_effect=OSError("disk full")):
+        response = TestClient(app, raise_server_exceptions=False).delete(f"/api/documents/{document['doc_id']}?user_id=test_user")
+    assert response.status_code == 500
+    assert main.document_registry.get("test_user", document["doc_id"]) == document
+    
+    response = test_client.delete(f"/api/documents/{document['doc_id']}?user_id=test_user")
+    assert response.status_code == 200
+    assert not file_path.exists()
+    assert main.document_registry.list("test_user") == []
+    assert main.corpus_store.load("test_user", DeterministicFakeEmbedding(size=8)).document_ids() == set()
+    
+    response = test_client.delete(f"/api/documents/{document['doc_id']}?user_id=test_user")
+    assert response.status_code == 404
     
-def test_chat_endpoint(test_client):
+@patch("main.chat_batcher.submit")
+def test_chat_endpoint(mock_submit, test_client):
     model_state.llm_loaded = True
+    main.document_registry.add("test_user", "uploaded_pdfs/test_user_test.pdf", content_hash="abc")
     model_state.qa_pipelines['test_user'] = MagicMock()
-    model_state.qa_pipelines.get('test_user').invoke.return_value = {"result": "Answer: Paris"}
+    future = Future()
+    future.set_result(" Paris")
+    mock_submit.return_value = future
     
     response = test_client.post(
         "/api/chat?user_id=test_user",
@@ -87,9 +153,112 @@ def test_chat_endpoint(test_client):
     
     assert response.status_code == 200
     assert response.json() == {"response": "Paris"}
+    assert "Question: Capital of France?" in mock_submit.call_args.args[0]
+    assert mock_submit.call_args.args[1] == {}
+    
+@patch("main.chat_batcher.submit")
+def test_chat_generation_options(mock_submit, test_client, monkeypatch):
+    model_state.llm_loaded = True
+    main.document_registry.add("test_user", "uploaded_pdfs/test_user_test.pdf", content_hash="abc")
+    model_state.qa_pipelines['test_user'] = MagicMock()
+    future = Future()
+    future.set_result("Paris")
+    mock_submit.return_value = future
+    monkeypatch.setenv("CHAT_MAX_TOKENS_LIMIT", "64")
+    
+    request = {"messages": "Capital of France?", "max_tokens": 1000, "stop": ["\n"], "temperature": 0}
+    for _ in range(2):
+        response = test_client.post("/api/chat?user_id=test_user", json=request)
+        assert response.json() == {"response": "Paris"}
+    # The budget is capped, and answers to custom options are not cached
+    assert mock_submit.call_args.args[1] == {"max_tokens": 64, "stop": ["\n"], "temperature": 0}
+    assert mock_submit.call_count == 2
+    
+    response = test_client.post(
+        "/api/chat?user_id=test_user",
+        json={"messages": "Capital of France?", "stop": ["a", "b", "c", "d", "e"]}
+    )
+    assert response.status_code == 422
+    assert mock_submit.call_count == 2
+    
+@patch("main.chat_batcher.submit")
+def test_chat_queue_full(mock_submit, test_client):
+    model_state.llm_loaded = True
+    main.document_registry.add("test_user", "uploaded_pdfs/test_user_test.pdf", content_hash="abc")
+    model_state.qa_pipelines['test_user'] = MagicMock()
+    mock_submit.side_effect = QueueFullError(3)
+    
+    response = test_client.post("/api/chat?user_id=test_user", json={"messages": "Capital of France?"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    assert mock_submit.call_args.kwargs["user_id"] == "test_user"
+    
+@patch("main.stream_generate")
+def test_chat_stream_endpoint(mock_stream, test_client):
+    model_state.llm_loaded = True
+    main.document_registry.add("test_user", "uploaded_pdfs/test_user_test.pdf", content_hash="abc")
+    model_state.qa_pipelines['test_user'] = MagicMock()
+    mock_stream.return_value = iter(["Pa", "ris", ""])
+    
+    response = test_client.post(
+        "/api/chat/stream?user_id=test_user",
+        json={"messages": "Capital of France?"}
+    )
+    
+    assert response.status_code == 200
+    assert response.text == "Paris"
+    assert "chatbot_time_to_first_token_seconds_count" in test_client.get("/metrics").text
     
-@patch("utils.snapshot_download")
-@patch("utils.AutoModelForCausalLM.from_pretrained")
+@patch("main.stream_generate")
+def test_chat_stream_failure_is_not_cached(mock_stream):
+    model_state.llm_loaded = True
+    main.document_registry.add("test_user", "uploaded_pdfs/test_user_test.pdf", content_hash="abc")
+    model_state.qa_pipelines['test_user'] = MagicMock()
+
+    def failing_stream():
+        yield "Pa"
+        raise RuntimeError("Generation failed")
+    mock_stream.side_effect = lambda *args, **kwargs: failing_stream()
+    
+    client = TestClient(app, raise_server_exceptions=False)
+    for _ in range(2):
+        client.post("/api/chat/stream?user_id=test_user", json={"messages": "Capital of France?"})
+    # The partial answer was not cached, so the second request generated again
+    assert mock_stream.call_count == 2
+    
+@patch("main.chat_batcher.submit")
+def test_chat_answer_cache(mock_submit, test_client):
+    model_state.llm_loaded = True
+    main.document_registry.add("test_user", "uploaded_pdfs/test_user_test.pdf", content_hash="abc")
+    model_state.qa_pipelines['test_user'] = MagicMock()
+    future = Future()
+    future.set_result(" Paris")
+    mock_submit.return_value = future
+    
+    for _ in range(2):
+        response = test_client.post("/api/chat?user_id=test_user", json={"messages": "Capital of France?"})
+        assert response.json() == {"response": "Paris"}
+    # The second answer came from the cache
+    assert mock_submit.call_count == 1
+    
+    response = test_client.post(
+        "/api/chat?user_id=test_user",
+        json={"messages": "Capital of France?", "bypass_cache": True}
+    )
+    assert response.json() == {"response": "Paris"}
+    assert mock_submit.call_count == 2
+    assert "chatbot_answer_cache_hits_total" in test_client.get("/metrics").text
+    
+def test_chat_without_document(test_client):
+    model_state.llm_loaded = True
+    response = test_client.post(
+        "/api/chat?user_id=unknown_user",
+        json={"messages": "Capital of France?"}
+    )
+    assert response.status_code == 400
+    
+@patch("huggingface_hub.snapshot_download")
+@patch("transformers.AutoModelForCausalLM.from_pretrained")
 def test_load_llm(mock_from_pretrained, mock_snapshot):
     # Mock model loading
     mock_from_pretrained.return_value = MagicMock()
@@ -102,4 +271,41 @@ def test_load_llm(mock_from_pretrained, mock_snapshot):
 
     mock_from_pretrained.side_effect = Exception("Load failed")
     load_llm()
-    assert model_state.llm_loaded is False
\ No newline at end of file
+    assert model_state.llm_loaded is False
+
+@patch("main.model_client")
+def test_chat_stream_with_inference_workers(mock_client, test_client):
+    model_state.llm_loaded = True
+    main.document_registry.add("test_user", "uploaded_pdfs/test_user_test.pdf", content_hash="abc")
+    model_state.qa_pipelines['test_user'] = MagicMock()
+    mock_client.stream.return_value = iter(["Pa", "ris"])
+    
+    response = test_client.post(
+        "/api/chat/stream?user_id=test_user",
+        json={"messages": "Capital of France?"}
+    )
+    
+    assert response.status_code == 200
+    assert response.text == "Paris"
+    assert "Question: Capital of France?" in mock_client.stream.call_args.args[0]
+
+def test_threads_per_batch_without_affinity(monkeypatch):
+    # macOS has no sched_getaffinity, so the slots split the cpu count
+    monkeypatch.delattr(os, "sched_getaffinity", raising=False)
+    monkeypatch.setattr(os, "cpu_count", lambda: 8)
+    monkeypatch.setenv("CHAT_MAX_CONCURRENT_BATCHES", "2")
+    monkeypatch.delenv("CHAT_THREADS_PER_BATCH", raising=False)
+    with patch.object(main, "model_client", None):
+        assert main.get_threads_per_batch() == 4
+
+def test_index_hash_of_document_without_file(tmp_path):
+    # Documents registered without a content hash whose upload was deleted after ingestion
+    file_path = tmp_path / "gone.pdf"
+    file_path.write_bytes(b"content")
+    document = main.document_registry.add("test_user", str(file_path))
+    qa_pipeline = MagicMock()
+    index_hash = main.get_index_hash("test_user", qa_pipeline)
+    file_path.unlink()
+    assert main.get_content_hash(document) == document["doc_id"]
+    assert main.get_index_hash("test_user", qa_pipeline) != index_hash
+    assert main.get_index_hash("test_user", qa_pipeline) == main.get_index_hash("test_user", qa_pipeline)
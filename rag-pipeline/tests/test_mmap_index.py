@@ -0,0 +1,79 @@
+import os
+import faiss
+import numpy as np
+import pytest
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from mmap_index import CHUNKS_FILE, IVF_DATA_FILE, ChunkFile, read_mmap_index, write_mmap_index
+
+@pytest.fixture
+def embeddings():
+    return DeterministicFakeEmbedding(size=16)
+
+def make_store(embeddings, num_chunks: int = 50) -> FAISS:
+    texts = [f"chunk {i} ünïcode" for i in range(num_chunks)]
+    metadatas = [{"doc_id": "b" if i % 2 else "a", "page": i} for i in range(num_chunks)]
+    return FAISS.from_texts(texts, embeddings, metadatas=metadatas)
+
+def test_chunk_file(tmp_path, embeddings):
+    store = make_store(embeddings)
+    doc_ranges = write_mmap_index(str(tmp_path), store)
+    # Chunks are grouped by document
+    assert doc_ranges == {"a": [0, 25], "b": [25, 50]}
+
+    chunks = ChunkFile(str(tmp_path))
+    assert len(chunks) == 50
+    assert chunks.search(0).page_content == "chunk 0 ünïcode"
+    assert chunks.search(25).metadata == {"doc_id": "b", "page": 1}
+    assert chunks.search(50) == "ID 50 not found."
+
+@pytest.mark.parametrize("index_type", ["flat", "ivf"])
+def test_read_mmap_index(tmp_path, embeddings, index_type):
+    store = make_store(embeddings, 200)
+    if index_type == "ivf":
+        vectors = store.index.reconstruct_n(0, store.index.ntotal)
+        store.index = faiss.index_factory(16, "IVF4,Flat")
+        store.index.train(vectors)
+        store.index.add(vectors)
+    write_mmap_index(str(tmp_path), store)
+    assert os.path.exists(tmp_path / IVF_DATA_FILE)
+
+    index, chunks, doc_ranges = read_mmap_index(str(tmp_path))
+    assert index.ntotal == 200
+    faiss.extract_index_ivf(index).nprobe = faiss.extract_index_ivf(index).nlist
+    # The exact text of a chunk is its own nearest neighbour
+    query = np.array([embeddings.embed_query("chunk 7 ünïcode")], dtype=np.float32)
+    _, labels = index.search(query, 1)
+    assert chunks.search(labels[0][0]).page_content == "chunk 7 ünïcode"
+
+def test_empty_index(tmp_path, embeddings):
+    store = make_store(embeddings, 1)
+    store.delete(list(store.index_to_docstore_id.values()))
+    write_mmap_index(str(tmp_path), store)
+    index, chunks, doc_ranges = read_mmap_index(str(tmp_path))
+    assert index.ntotal == 0
+    assert len(chunks) == 0
+    assert doc_ranges == {}
+    assert os.path.getsize(tmp_path / CHUNKS_FILE) == 0
+
+def test_ivf_with_removed_ids(tmp_path, embeddings):
+    store = make_store(embeddings, 200)
+    vectors = store.index.reconstruct_n(0, store.index.ntotal)
+    store.index = faiss.index_factory(16, "IVF4,Flat")
+    store.index.train(vectors)
+    store.index.add_with_ids(vectors, np.arange(200, dtype=np.int64))
+    # Removing chunks leaves gaps in the ids, as when a document is deleted from a corpus
+    removed = np.arange(0, 200, 3, dtype=np.int64)
+    store.index.remove_ids(removed)
+    for label in removed.tolist():
+        store.docstore.delete([store.index_to_docstore_id.pop(label)])
+    write_mmap_index(str(tmp_path), store)
+
+    index, chunks, doc_ranges = read_mmap_index(str(tmp_path))
+    assert index.ntotal == len(chunks) == 200 - len(removed)
+    faiss.extract_index_ivf(index).nprobe = faiss.extract_index_ivf(index).nlist
+    query = np.array([embeddings.embed_query("chunk 7 ünïcode")], dtype=np.float32)
+    _, labels = index.search(query, 1)
+    assert chunks.search(labels[0][0]).page_content == "chunk 7 ünïcode"
+    # The source index can still be updated
+    store.index.remove_ids(np.array([1], dtype=np.int64))
@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from model_server import READY, ModelClient, ModelServer, plan_core_sets
+
+@pytest.fixture(scope="module")
+def server(stand_in_model_dir):
+    server = ModelServer(2, "stand-in", stand_in_model_dir, precision="fp32").start()
+    assert server.wait_ready(timeout=300), server.status()
+    yield server
+    server.stop()
+
+@pytest.fixture
+def client(server):
+    client = ModelClient(server.address, server.authkey)
+    yield client
+    client.close()
+
+def test_plan_core_sets():
+    assert plan_core_sets(2, [0, 1, 2, 3, 4]) == [[0, 1, 2], [3, 4]]
+    assert plan_core_sets(1, [2, 3]) == [[2, 3]]
+    # Fewer cores than workers
+    assert plan_core_sets(3, [0, 1]) == [[0], [1], [0]]
+
+
+def test_plan_core_sets_without_affinity(monkeypatch):
+    # macOS has no sched_getaffinity, so the cpu count is split
+    monkeypatch.delattr("os.sched_getaffinity", raising=False)
+    monkeypatch.setattr("os.cpu_count", lambda: 4)
+    assert plan_core_sets(2) == [[0, 1], [2, 3]]
+
+def test_workers_are_pinned(server, client):
+    assert client.num_workers == 2
+    assert client.ready()
+    status = server.status()
+    assert {worker["pid"] for worker in status.values()}.isdisjoint({os.getpid()})
+    for worker_index, cores in enumerate(plan_core_sets(2)):
+        assert status[worker_index]["state"] == READY
+        assert status[worker_index]["cores"] == cores
+        assert status[worker_index]["num_threads"] == len(cores)
+
+def test_generate_and_stream(client):
+    prompts = ["Question: a?\nAnswer:", "Question: b?\nAnswer:"]
+    # Concurrent requests are spread over the workers
+    with ThreadPoolExecutor(2) as executor:
+        outputs = list(executor.map(lambda prompt: client.generate([prompt])[0], prompts))
+    # Only the answers come back, not the prompts
+    assert all(output and not output.startswith(prompt) for prompt, output in zip(prompts, outputs))
+    assert len(client.generate(prompts)) == 2
+    # Each sequence of a batch stops at its own budget
+    short, longer = client.generate([prompts[0]] * 2, [{"max_tokens": 2}, {"max_tokens": 3}])
+    assert longer.startswith(short) and len(longer) > len(short)
+
+    assert "".join(client.stream(prompts[0]))
+    answer = client.get_llm().invoke(prompts[0])
+    assert answer and not answer.startswith(prompts[0])
+
+def test_stream_cancel(server, client):
+    prompt = "Question: a?\nAnswer:"
+    cancel = threading.Event()
+    tokens = client.stream(prompt, {"max_tokens": 1000}, cancel=cancel)
+    next(tokens)
+    cancel.set()
+    assert list(tokens) == []
+    # The worker saw the cancellation and stopped the answer
+    deadline = time.monotonic() + 10
+    while server._cancelled and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not server._cancelled and not client._pending
+    assert client.generate([prompt], [{"max_tokens": 2}])[0]
+
+def test_generation_error(client):
+    with pytest.raises(RuntimeError):
+        client.generate([None])
+    # The workers keep serving
+    assert client.generate(["Answer:"])[0]
+
+def test_timeout(server, client):
+    # Both workers are busy, so new requests wait in the queue
+    cancel = threading.Event()
+    busy = [client.stream("Answer:", {"max_tokens": 1000}, cancel=cancel) for _ in range(2)]
+    for tokens in busy:
+        next(tokens)
+    impatient = ModelClient(server.address, server.authkey, timeout=0.2)
+    try:
+        with pytest.raises(TimeoutError):
+            impatient.generate(["Answer:"])
+        with pytest.raises(TimeoutError):
+            list(impatient.stream("Answer:"))
+    finally:
+        cancel.set()
+        for tokens in busy:
+            list(tokens)
+        impatient.close()
+
+def test_dead_worker(stand_in_model_dir):
+    server = ModelServer(1, "stand-in", stand_in_model_dir, precision="fp32").start()
+    assert server.wait_ready(timeout=300), server.status()
+    client = ModelClient(server.address, server.authkey)
+    tokens = client.stream("Answer:", {"max_tokens": 1000})
+    next(tokens)
+    queued = ThreadPoolExecutor(1).submit(client.generate, ["Answer:"])
+    server.workers[0].kill()
+    # The request of the dead worker and the queued one fail instead of waiting forever
+    with pytest.raises(RuntimeError, match="died"):
+        list(tokens)
+    with pytest.raises(RuntimeError, match="No inference worker"):
+        queued.result(timeout=10)
+    assert server.status()[0]["state"] != READY
+
+    client.close()
+    server.stop()
+    assert not os.path.exists(server.address)
@@ -1,7 +1,8 @@
 import os
 import pytest
 from unittest.mock import patch, MagicMock
-from model_setup import load_model
+import torch
+from model_setup import load_model, get_precision_dir
 
 @pytest.fixture
 def mock_dependencies(mocker):
@@ -10,11 +11,11 @@ def mock_dependencies(mocker):
     mocker.patch("model_setup.get_hardware", return_value="cpu")
 
     # Mock snapshot_download to prevent real downloading
-    mock_snapshot = mocker.patch("model_setup.snapshot_download")
+    mock_snapshot = mocker.patch("huggingface_hub.snapshot_download")
 
     # Mock AutoModelForCausalLM.from_pretrained to prevent real model loading
     mock_model = MagicMock()
-    mock_load = mocker.patch("model_setup.AutoModelForCausalLM.from_pretrained", return_value=mock_model)
+    mock_load = mocker.patch("transformers.AutoModelForCausalLM.from_pretrained", return_value=mock_model)
 
     return mock_snapshot, mock_load
 
@@ -49,3 +50,41 @@ def test_load_model_not_existing(mock_dependencies, tmp_path):
     # Ensure the model is loaded
     mock_load.assert_called_once_with(pretrained_model_name_or_path=str(local_dir), device_map="cpu")
     assert model is not None
+
+def test_load_model_bf16_cached(mock_dependencies, tmp_path):
+    """bf16 weights are saved next to the model directory and reused on the next load."""
+    _, mock_load = mock_dependencies
+    local_dir = tmp_path / "model"
+    os.makedirs(local_dir, exist_ok=True)
+    (local_dir / "config.json").write_text("{}")
+
+    load_model("dummy_model", str(local_dir), precision="bf16")
+    mock_load.return_value.save_pretrained.assert_called_once()
+    assert os.path.exists(get_precision_dir(str(local_dir), "bf16"))
+
+    load_model("dummy_model", str(local_dir), precision="bf16")
+    assert mock_load.call_args.kwargs == {
+        "pretrained_model_name_or_path": get_precision_dir(str(local_dir), "bf16"),
+        "device_map": "cpu",
+        "torch_dtype": torch.bfloat16
+    }
+
+def test_load_model_dynamic_int8(mock_dependencies, tmp_path):
+    """Linear layers are quantized once, later loads read the cached quantized model."""
+    _, mock_load = mock_dependencies
+    mock_load.return_value = torch.nn.Sequential(torch.nn.Linear(4, 4))
+    local_dir = tmp_path / "model"
+    os.makedirs(local_dir, exist_ok=True)
+    (local_dir / "config.json").write_text("{}")
+
+    model = load_model("dummy_model", str(local_dir), precision="dynamic-int8")
+    assert isinstance(model[0], torch.ao.nn.quantized.dynamic.Linear)
+
+    mock_load.reset_mock()
+    cached_model = load_model("dummy_model", str(local_dir), precision="dynamic-int8")
+    mock_load.assert_not_called()
+    assert isinstance(cached_model[0], torch.ao.nn.quantized.dynamic.Linear)
+
+def test_load_model_unknown_precision(mock_dependencies, tmp_path):
+    with pytest.raises(ValueError):
+        load_model("dummy_model", str(tmp_path / "model"), precision="int4")
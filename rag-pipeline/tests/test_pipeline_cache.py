@@ -0,0 +1,71 @@
+import time
+import pytest
+from unittest.mock import MagicMock
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from corpus import CorpusStore
+from mmap_index import ChunkFile
+from pipeline_cache import PipelineCache, estimate_pipeline_bytes
+
+def test_lru_eviction_and_reload():
+    loader = MagicMock(side_effect=lambda source: f"reloaded {source}")
+    cache = PipelineCache(loader=loader, max_entries=2)
+    cache.put("alice", "pipeline alice", source="alice.pdf")
+    cache.put("bob", "pipeline bob", source="bob.pdf")
+    cache.get("alice")
+    cache.put("carol", "pipeline carol", source="carol.pdf")
+
+    # Bob was least recently used
+    assert "bob" not in cache and len(cache) == 2
+    loader.assert_not_called()
+    assert cache.get("bob") == "reloaded bob.pdf"
+    loader.assert_called_once_with("bob.pdf")
+    assert cache.get("unknown") is None
+    # Reload locks are not kept for every user ever served
+    assert len(cache._load_locks) == 0
+
+def test_ttl_eviction():
+    cache = PipelineCache(ttl_seconds=0.05)
+    cache["alice"] = "pipeline alice"
+    assert cache.get("alice") == "pipeline alice"
+    time.sleep(0.1)
+    assert cache.get("alice") is None
+    with pytest.raises(KeyError):
+        cache["alice"]
+
+def test_memory_bound():
+    embeddings = DeterministicFakeEmbedding(size=8)
+    def make_pipeline(n):
+        pipeline = MagicMock()
+        pipeline.retriever.vectorstore = FAISS.from_texts([f"text {i}" for i in range(n)], embedding=embeddings)
+        return pipeline
+
+    small, large = make_pipeline(2), make_pipeline(20)
+    assert 0 < estimate_pipeline_bytes(small) < estimate_pipeline_bytes(large)
+
+    cache = PipelineCache(max_bytes=estimate_pipeline_bytes(large) + 1)
+    cache.put("alice", small)
+    cache.put("bob", large)
+    assert "alice" not in cache and "bob" in cache
+    assert cache.total_bytes == estimate_pipeline_bytes(large)
+
+def test_memory_mapped_size(tmp_path):
+    embeddings = DeterministicFakeEmbedding(size=8)
+    store = CorpusStore(str(tmp_path))
+    def make_pipeline(user_id, n):
+        document = FAISS.from_texts([f"text {i}" for i in range(n)], embedding=embeddings)
+        store.add_document(user_id, "doc", document, embeddings)
+        pipeline = MagicMock()
+        pipeline.retriever.vectorstore = store.load_read_only(user_id, embeddings)
+        return pipeline
+
+    small, large = make_pipeline("alice", 2), make_pipeline("bob", 20)
+    assert isinstance(large.retriever.vectorstore.docstore, ChunkFile)
+    assert 0 < estimate_pipeline_bytes(small) < estimate_pipeline_bytes(large)
+    assert estimate_pipeline_bytes(large) >= 20 * 8 * 4 + len("text 0") * 20
+
+def test_pop_forgets_source():
+    cache = PipelineCache(loader=lambda source: "reloaded")
+    cache.put("alice", "pipeline", source="alice.pdf")
+    assert cache.pop("alice") == "pipeline"
+    assert cache.get("alice") is None
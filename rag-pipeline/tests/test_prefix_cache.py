@@ -0,0 +1,77 @@
+import gc
+import weakref
+import pytest
+import torch
+from transformers import DynamicCache
+from prefix_cache import PrefixCache
+from resources import PROMPT_TEMPLATE
+import data_pipeline
+from data_pipeline import get_prefix_lengths, generate_with_prefix_cache
+
+def make_cache(num_tokens):
+    cache = DynamicCache()
+    cache.update(torch.rand(1, 2, num_tokens, 4), torch.rand(1, 2, num_tokens, 4), layer_idx=0)
+    return cache
+
+def test_lookup_longest_prefix():
+    cache = PrefixCache(max_entries=4, max_tokens=100)
+    input_ids = list(range(10))
+    cache.store("model", input_ids, [3, 6], make_cache(10))
+
+    length, past_key_values = cache.lookup("model", input_ids, [3, 6])
+    assert length == 6
+    assert past_key_values.get_seq_length() == 6
+    # Another model or another prompt does not hit
+    assert cache.lookup("other", input_ids, [3, 6]) == (0, None)
+    assert cache.lookup("model", [0, 1, 2, 9, 9, 9, 9], [3, 6])[0] == 3
+
+def test_reloaded_model_misses():
+    class Model:
+        pass
+
+    cache = PrefixCache(max_entries=4, max_tokens=100)
+    input_ids = list(range(10))
+    model = Model()
+    cache.store(weakref.ref(model), input_ids, [6], make_cache(10))
+    assert cache.lookup(weakref.ref(model), input_ids, [6])[0] == 6
+    del model
+    gc.collect()
+    # A new model does not hit, even if it reuses the id of the collected one
+    reloaded = Model()
+    assert cache.lookup(weakref.ref(reloaded), input_ids, [6]) == (0, None)
+
+def test_eviction_by_tokens():
+    cache = PrefixCache(max_entries=10, max_tokens=10)
+    cache.store("model", list(range(8)), [6], make_cache(8))
+    cache.store("model", list(range(100, 108)), [6], make_cache(8))
+
+    assert len(cache) == 1
+    assert cache.num_tokens == 6
+    assert cache.lookup("model", list(range(8)), [6]) == (0, None)
+
+def test_get_prefix_lengths(stand_in_tokenizer):
+    prompt = PROMPT_TEMPLATE.format(context="some context", question="a question?")
+    input_ids, prefix_lengths = get_prefix_lengths(stand_in_tokenizer, prompt)
+
+    header = PROMPT_TEMPLATE.split("{context}")[0]
+    assert prefix_lengths == [len(header), len(header) + len("some context")]
+    assert len(input_ids) == len(prompt)
+
+@pytest.mark.parametrize("decoding", ["off", "prompt_lookup"])
+def test_generate_with_prefix_cache_matches_full_prefill(stand_in_model, stand_in_tokenizer, monkeypatch, decoding):
+    monkeypatch.setenv("SPECULATIVE_DECODING", decoding)
+    monkeypatch.setattr(data_pipeline, "prefix_cache", PrefixCache(max_entries=8, max_tokens=1000))
+    monkeypatch.setitem(data_pipeline.GENERATION_KWARGS, "max_new_tokens", 8)
+    context = "The quick brown fox jumps over the lazy dog. " * 4
+
+    for question in ["What does the fox do?", "Who is lazy?"]:
+        prompt = PROMPT_TEMPLATE.format(context=context, question=question)
+        input_ids = stand_in_tokenizer(prompt, return_tensors="pt")["input_ids"]
+        expected = stand_in_model.generate(
+            input_ids=input_ids, attention_mask=torch.ones_like(input_ids), do_sample=False,
+            pad_token_id=stand_in_tokenizer.pad_token_id, **data_pipeline.GENERATION_KWARGS
+        )[0, input_ids.shape[1]:].tolist()
+        assert generate_with_prefix_cache(stand_in_model, stand_in_tokenizer, prompt) == expected
+
+    # The follow-up question reused the prefill of the template header and the context
+    assert len(data_pipeline.prefix_cache) == 2
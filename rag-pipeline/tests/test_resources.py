@@ -0,0 +1,48 @@
+import pytest
+from unittest.mock import MagicMock
+from langchain.prompts import PromptTemplate
+from resources import ResourceRegistry
+
+@pytest.fixture
+def mock_hf(mocker):
+    """Mock Hugging Face loaders to avoid real downloads."""
+    mocks = {
+        "tokenizer": mocker.patch("transformers.AutoTokenizer.from_pretrained", return_value=MagicMock()),
+        "embeddings": mocker.patch("langchain_huggingface.HuggingFaceEmbeddings", return_value=MagicMock()),
+        "pipeline": mocker.patch("transformers.pipelines.pipeline", return_value=MagicMock()),
+        "llm": mocker.patch("langchain_huggingface.HuggingFacePipeline", return_value=MagicMock()),
+        "load_model": mocker.patch("resources.load_model", return_value=MagicMock()),
+    }
+    mocker.patch("resources.get_hardware", return_value="cpu")
+    return mocks
+
+def test_resources_loaded_once(mock_hf):
+    registry = ResourceRegistry()
+    for _ in range(3):
+        registry.get_tokenizer("model_dir")
+        registry.get_embeddings()
+        registry.get_llm("model_dir")
+
+    mock_hf["tokenizer"].assert_called_once_with("model_dir")
+    mock_hf["embeddings"].assert_called_once()
+    mock_hf["pipeline"].assert_called_once()
+    mock_hf["load_model"].assert_called_once()
+
+def test_get_llm_with_preloaded_model(mock_hf):
+    registry = ResourceRegistry()
+    model = MagicMock()
+    llm = registry.get_llm("model_dir", model)
+
+    assert registry.get_llm("model_dir", model) is llm
+    mock_hf["load_model"].assert_not_called()
+    assert mock_hf["pipeline"].call_args.kwargs["model"] is model
+    # Another model gets its own pipeline
+    registry.get_llm("model_dir", MagicMock())
+    assert mock_hf["pipeline"].call_count == 2
+
+def test_get_prompt():
+    registry = ResourceRegistry()
+    prompt = registry.get_prompt()
+    assert isinstance(prompt, PromptTemplate)
+    assert registry.get_prompt() is prompt
+    assert set(prompt.input_variables) == {"context", "question"}
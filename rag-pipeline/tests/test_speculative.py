@@ -0,0 +1,71 @@
+import torch
+import pytest
+from transformers import DynamicCache
+from speculative import find_draft, prompt_lookup_generate, speculative_decoding_enabled
+from utils import SPECULATIVE_DRAFT_TOKENS
+
+def greedy_generate(model, input_ids: list, max_new_tokens: int, repetition_penalty: float) -> list:
+    inputs = torch.tensor([input_ids])
+    output = model.generate(
+        input_ids=inputs, attention_mask=torch.ones_like(inputs), max_new_tokens=max_new_tokens,
+        do_sample=False, repetition_penalty=repetition_penalty, pad_token_id=0
+    )
+    return output[0, len(input_ids):].tolist()
+
+def test_find_draft():
+    tokens = [1, 2, 3, 4, 5, 9, 2, 3, 7, 8, 2, 3]
+    # The latest earlier occurrence of the longest matching n-gram wins
+    assert find_draft(tokens, 2) == [7, 8]
+    assert find_draft(tokens, 10, max_ngram=1) == [7, 8, 2, 3]
+    assert find_draft([1, 2, 3, 4], 3) == []
+    assert find_draft([5], 3) == []
+
+def test_speculative_decoding_enabled(monkeypatch):
+    monkeypatch.delenv("SPECULATIVE_DECODING", raising=False)
+    assert not speculative_decoding_enabled()
+    monkeypatch.setenv("SPECULATIVE_DECODING", "prompt_lookup")
+    assert speculative_decoding_enabled()
+
+@pytest.mark.parametrize("repetition_penalty", [1.0, 1.2])
+def test_matches_greedy_generation(stand_in_model, repetition_penalty):
+    # A prompt repeating a span, as a context copied into the answer would
+    span = [5, 17, 33, 8, 41, 12, 29, 3]
+    input_ids = [1, 2] + span + [9, 10, 11] + span[:3]
+    drafted_before = SPECULATIVE_DRAFT_TOKENS._value.get()
+    answer_ids, cache, stats = prompt_lookup_generate(
+        stand_in_model, input_ids, 24, repetition_penalty=repetition_penalty, num_draft_tokens=5
+    )
+    assert answer_ids == greedy_generate(stand_in_model, input_ids, 24, repetition_penalty)
+    assert stats["draft_tokens"] > 0
+    assert 0 <= stats["accepted_tokens"] <= stats["draft_tokens"]
+    assert stats["forward_passes"] == len(answer_ids) - stats["accepted_tokens"]
+    assert cache.get_seq_length() == len(input_ids) + len(answer_ids) - 1
+    assert SPECULATIVE_DRAFT_TOKENS._value.get() == drafted_before + stats["draft_tokens"]
+
+def test_prefix_cache_and_streamer(stand_in_model):
+    input_ids = [1, 2, 3, 4, 5, 6, 1, 2, 3]
+    expected = greedy_generate(stand_in_model, input_ids, 12, 1.2)
+
+    # Start from the key/value cache of the first tokens of the prompt
+    prefix_cache = DynamicCache()
+    with torch.no_grad():
+        stand_in_model(input_ids=torch.tensor([input_ids[:5]]), past_key_values=prefix_cache, use_cache=True)
+
+    class TokenStreamer:
+        def __init__(self):
+            self.puts, self.ended = [], False
+
+        def put(self, value):
+            self.puts.append(value.flatten().tolist())
+
+        def end(self):
+            self.ended = True
+
+    streamer = TokenStreamer()
+    answer_ids, _, _ = prompt_lookup_generate(
+        stand_in_model, input_ids, 12, past_key_values=prefix_cache, repetition_penalty=1.2, streamer=streamer
+    )
+    assert answer_ids == expected
+    # The prompt comes first, as `TextIteratorStreamer(skip_prompt=True)` expects
+    assert streamer.puts[0] == input_ids
+    assert sum(streamer.puts[1:], []) == expected and streamer.ended
@@ -1,8 +1,14 @@
+import os
+import sys
+import json
 import pytest
 import time
+import subprocess
 from threading import Thread
 from unittest.mock import patch, MagicMock
-from utils import get_hardware, get_model_dir, get_doc_dir, monitor_memory_usage
+import utils
+from prometheus_client import CollectorRegistry, Histogram
+from utils import get_hardware, get_model_dir, get_doc_dir, monitor_memory_usage, timed_stage, StageTimer
 
 
 @pytest.fixture(autouse=True)
@@ -37,4 +43,55 @@ def test_monitor_memory_usage():
     thread.start()
     time.sleep(0.5)
     assert thread.is_alive()
-    
\ No newline at end of file
+
+def test_lazy_imports():
+    # Importing the server modules neither loads torch nor starts a span exporter
+    code = (
+        "import sys, json, main, model_server; from opentelemetry import trace; "
+        "print(json.dumps(['torch' in sys.modules, type(trace.get_tracer_provider()).__name__]))"
+    )
+    env = {**os.environ, "PYTHONPATH": os.path.dirname(utils.__file__)}
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    torch_loaded, tracer_provider = json.loads(result.stdout.strip().splitlines()[-1])
+    assert not torch_loaded
+    assert tracer_provider == "ProxyTracerProvider"
+
+def test_stage_latency():
+    histogram = Histogram("test_stage_seconds", "Test stages", ["stage"], registry=CollectorRegistry())
+    with timed_stage(histogram, "tokenize"):
+        time.sleep(0.01)
+    stages = StageTimer(histogram)
+    for _ in range(3):
+        with stages.stage("extract"):
+            time.sleep(0.01)
+        with stages.stage("embed"):
+            pass
+    stages.observe()
+
+    def observations(stage):
+        return sum(bucket.get() for bucket in histogram.labels(stage=stage)._buckets), histogram.labels(stage=stage)._sum.get()
+
+    assert observations("tokenize")[0] == 1 and observations("tokenize")[1] >= 0.01
+    # Alternating stages are recorded once, with their total time
+    assert observations("extract")[0] == 1 and observations("extract")[1] >= 0.03
+    assert observations("embed")[0] == 1
+
+def test_torch_threads():
+    import torch
+    previous = torch.get_num_threads()
+    seen = []
+
+    def set_threads():
+        utils.set_torch_threads(3)
+        seen.append(torch.get_num_threads())
+
+    with utils.torch_threads(2):
+        # Another thread setting its count waits until the block restores the previous one
+        setter = Thread(target=set_threads)
+        setter.start()
+        setter.join(0.1)
+        assert setter.is_alive()
+        assert torch.get_num_threads() == 2
+    setter.join()
+    assert seen == [3]
+    assert torch.get_num_threads() == previous
@@ -1,3 +1,4 @@
+import time
 import streamlit as st
 import requests
 
@@ -26,7 +27,26 @@ if uploaded_file is not None:
             response = requests.post(f"http://rag-pipeline:8000/api/upload_pdf?user_id={user_id}", files=files)
 
             if response.status_code == 200:
-                st.success("✅ PDF uploaded and processed successfully! You can now ask questions.")
+                # Poll the ingestion job until the document is indexed
+                job_id = response.json()["job_id"]
+                progress_bar = st.progress(0.0, text="Parsing PDF ...")
+                while True:
+                    status = requests.get(f"http://rag-pipeline:8000/api/upload_status/{job_id}").json()
+                    if status["status"] in ("done", "failed"):
+                        break
+                    if status["pages_total"]:
+                        progress_bar.progress(
+                            status["pages_parsed"] / status["pages_total"],
+                            text=f"Parsed {status['pages_parsed']}/{status['pages_total']} pages, "
+                                 f"embedded {status['chunks_embedded']} chunks ..."
+                        )
+                    time.sleep(1)
+                progress_bar.empty()
+
+                if status["status"] == "done":
+                    st.success("✅ PDF uploaded and processed successfully! You can now ask questions.")
+                else:
+                    st.error(f"❌ Error processing PDF, please try again in a few seconds. Error: {status['error']}")
             else:
                 st.error(f"❌ Error processing PDF, please try again in a few seconds. Error: {response.text}")
 
@@ -49,20 +69,23 @@ if prompt:
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Send Prompt to Backend
-    with st.spinner("Thinking ... 💭"):
-        response = requests.post(
-            url=f"http://rag-pipeline:8000/api/chat?user_id={user_id}",
-            json={"messages": prompt}
-        )
+    # Send Prompt to Backend and stream the answer as it is generated
+    with st.chat_message("assistant"):
+        try:
+            response = requests.post(
+                url=f"http://rag-pipeline:8000/api/chat/stream?user_id={user_id}",
+                json={"messages": prompt},
+                stream=True
+            )
+        except requests.RequestException:
+            response = None
 
         # Handle Response
-        if response.status_code == 200:
-            ai_response = response.json()["response"]
+        if response is not None and response.status_code == 200:
+            ai_response = st.write_stream(response.iter_content(chunk_size=None, decode_unicode=True))
         else:
             ai_response = "❌ Error fetching response from API. Please try to reload the LLM model."
+            st.markdown(ai_response)
 
-    # Store & Display AI Response
+    # Store AI Response
     st.session_state.messages.append({"role": "assistant", "content": ai_response})
-    with st.chat_message("assistant"):
-        st.markdown(ai_response)